@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+缓存存储模式基准测试
+对比 --cache-storage tar / blob / zstd 的磁盘占用和从缓存拉取（写出镜像tar）的耗时
+"""
+
+import sys
+import time
+import shutil
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+DOCKER_PULL = Path(__file__).resolve().parent / 'docker_pull.py'
+
+def format_size(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size:.0f} B"
+        size /= 1024
+
+def disk_usage(path: Path) -> int:
+    """Bytes allocated on disk under path, counting hard-linked files once"""
+    seen = set()
+    total = 0
+    for file_path in path.rglob('*'):
+        stat = file_path.lstat()
+        if not file_path.is_file() or (stat.st_dev, stat.st_ino) in seen:
+            continue
+        seen.add((stat.st_dev, stat.st_ino))
+        total += stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size
+    return total
+
+def drop_page_cache() -> bool:
+    """Drop the Linux page cache so cached pulls really read from disk (needs root)"""
+    try:
+        subprocess.run(['sync'], check=False)
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except OSError:
+        return False
+
+def pull(images: list, cache_dir: Path, work_dir: Path, storage: str, level: int, extra_args: list, offline: bool) -> float:
+    """Pull every image into the cache and an archive; returns the elapsed seconds"""
+    start_time = time.time()
+    for index, image in enumerate(images):
+        output = work_dir / f'output_{index}.tar'
+        cmd = [sys.executable, str(DOCKER_PULL), image, '--cache-dir', str(cache_dir), '-o', str(output),
+               '--cache-storage', storage, '--cache-zstd-level', str(level)] + extra_args
+        if offline:
+            cmd.append('--offline')
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            sys.stdout.write(result.stdout.decode(errors='replace'))
+            raise RuntimeError(f"docker_pull.py failed for {image} ({storage})")
+        output.unlink()
+    return time.time() - start_time
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='对比不同 --cache-storage 模式的缓存磁盘占用和从缓存拉取的耗时',
+        epilog='Arguments after -- are passed to docker_pull.py, e.g. -- --platform linux/amd64',
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('images', nargs='+', help='镜像名称')
+    parser.add_argument('--modes', default='tar,blob,zstd:1,zstd:3,zstd:9',
+                        help='要对比的模式，zstd:N 指定压缩级别 (默认: tar,blob,zstd:1,zstd:3,zstd:9)')
+    parser.add_argument('--runs', type=int, default=3, help='每个模式从缓存拉取的次数，取中位数 (默认: 3)')
+    parser.add_argument('--work-dir', default='./cache_storage_benchmark', help='缓存和输出的工作目录 (默认: ./cache_storage_benchmark)')
+    parser.add_argument('--drop-caches', action='store_true', help='每次从缓存拉取前清空页缓存（Linux，需要root）')
+
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        argv, extra = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+
+    work_dir = Path(args.work_dir).expanduser().resolve()
+    work_dir.mkdir(parents=True, exist_ok=True)
+    if args.drop_caches and not drop_page_cache():
+        print("⚠️  Can't drop the page cache (Linux and root only), cached pulls will read from memory")
+        args.drop_caches = False
+
+    print("="*60)
+    print("🐳 缓存存储模式基准测试")
+    print(f"📦 {', '.join(args.images)}")
+    print("="*60)
+
+    results = []
+    for mode in args.modes.split(','):
+        storage, _, level = mode.strip().partition(':')
+        level = int(level or 3)
+        cache_dir = work_dir / f"cache_{mode.strip().replace(':', '_')}"
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+        print(f"\n🔄 {mode}: populating the cache...")
+        populate_time = pull(args.images, cache_dir, work_dir, storage, level, extra, offline=False)
+        layer_usage = sum(disk_usage(cache_dir / name) for name in ('layers', 'blobs') if (cache_dir / name).exists())
+
+        times = []
+        for _ in range(args.runs):
+            if args.drop_caches:
+                drop_page_cache()
+            times.append(pull(args.images, cache_dir, work_dir, storage, level, extra, offline=True))
+        results.append((mode.strip(), layer_usage, populate_time, statistics.median(times)))
+        print(f"   💾 {format_size(layer_usage)} on disk, cold pull {populate_time:.1f}s, from cache {statistics.median(times):.2f}s")
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    baseline = next((usage for mode, usage, _, _ in results if mode == 'tar'), results[0][1]) or 1
+    print(f"\n📊 Results ({args.runs} cached pulls per mode, median{', page cache dropped' if args.drop_caches else ''}):")
+    print(f"   {'MODE':<10} {'DISK':>10} {'VS TAR':>7} {'COLD PULL':>10} {'FROM CACHE':>11}")
+    for mode, usage, populate_time, cached_time in results:
+        print(f"   {mode:<10} {format_size(usage):>10} {usage / baseline:>6.0%} {populate_time:>9.1f}s {cached_time:>10.2f}s")
+
+if __name__ == '__main__':
+    main()
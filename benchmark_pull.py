@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线拉取性能基准测试
+启动本地模拟镜像仓库 (mock_registry.py)，在并发数、缓存状态、输出格式和下载引擎的组合下
+拉取合成镜像，报告吞吐量、峰值内存和CPU时间；不需要网络，可在CI中发现下载路径的性能回退
+"""
+
+import os
+import re
+import ssl
+import sys
+import json
+import time
+import shutil
+import argparse
+import itertools
+import statistics
+import subprocess
+import urllib.request
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+DOCKER_PULL = HERE / 'docker_pull.py'
+MOCK_REGISTRY = HERE / 'mock_registry.py'
+
+# `layers` stage: only resolve the image and download its layers (Puller.fetch_layers), no archive
+LAYERS_SCRIPT = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+import docker_pull
+options = vars(docker_pull.parser.parse_args(sys.argv[2:]))
+with docker_pull.Puller(**options) as puller:
+    for image in options['image']:
+        for target in puller.resolve(image):
+            puller.fetch_layers(target)
+'''
+
+CACHE_STATES = ('cold', 'warm', 'imported', 'none')
+
+def format_size(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size:.0f} B"
+        size /= 1024
+
+def start_mock_registry(args) -> tuple:
+    """Start mock_registry.py on a free port; returns (process, base_url)"""
+    cmd = [sys.executable, str(MOCK_REGISTRY), '--port', '0', '--tls', '--layers', str(args.layers), '--layer-size', args.layer_size,
+           '--seed', str(args.seed), '--latency', str(args.latency), '--rate', args.rate, '--fail-rate', str(args.fail_rate),
+           '--throttle-rate', str(args.throttle_rate), '--retry-after', str(args.retry_after)]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    line = process.stdout.readline()
+    match = re.search(r'(https?://[\w.]+:\d+)', line)
+    if not match:
+        process.kill()
+        raise RuntimeError(f"mock_registry.py did not start: {line.strip() or process.stdout.read()}")
+    print(line.strip())
+    return process, match.group(1)
+
+def mock_stats(base_url: str) -> dict:
+    """Request counters of the mock registry (429s sent, connections cut...)"""
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    try:
+        with urllib.request.urlopen(f'{base_url}/stats', context=context, timeout=10) as resp:
+            return json.loads(resp.read())
+    except (OSError, ValueError):
+        return {}
+
+def run_measured(cmd: list, log_path: Path) -> dict:
+    """Run a command; returns its exit code, wall time and (Unix) peak RSS and CPU time"""
+    start_time = time.perf_counter()
+    with open(log_path, 'w') as log_file:
+        process = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in KB on Linux, bytes on macOS
+            rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+            cpu = usage.ru_utime + usage.ru_stime
+        else:
+            process.wait()
+            rss = cpu = None
+    return {'returncode': process.returncode, 'wall': time.perf_counter() - start_time, 'rss': rss, 'cpu': cpu}
+
+def pull_command(stage: str, image: str, options: list) -> list:
+    if stage == 'layers':
+        return [sys.executable, '-c', LAYERS_SCRIPT, str(HERE), image] + options
+    return [sys.executable, str(DOCKER_PULL), image] + options
+
+def prepare_cache(state: str, image: str, cache_dir: Path, work_dir: Path, output_format: str, seed_tar: Path, extra: list):
+    """Bring a fresh cache directory into the requested state before a measured run"""
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    if state == 'warm':
+        output = work_dir / 'warmup.out'
+        cmd = [sys.executable, str(DOCKER_PULL), image, '--cache-dir', str(cache_dir), '--format', output_format, '-o', str(output)] + extra
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        remove_output(output)
+        if result.returncode != 0:
+            sys.stdout.write(result.stdout.decode(errors='replace'))
+            raise RuntimeError('warm-up pull failed')
+    elif state == 'imported':
+        cmd = [sys.executable, str(DOCKER_PULL), '--import-tar', str(seed_tar), '--cache-dir', str(cache_dir)]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            sys.stdout.write(result.stdout.decode(errors='replace'))
+            raise RuntimeError('cache import failed')
+
+def remove_output(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    elif path.exists():
+        path.unlink()
+
+def run_case(args, case: dict, image: str, base_url: str, work_dir: Path, seed_tar: Path) -> dict:
+    """Run one combination of the matrix args.runs times; returns the median run and the injected faults"""
+    cache_dir = work_dir / 'cache'
+    runs = []
+    stats_before = mock_stats(base_url)
+    for index in range(args.runs):
+        prepare_cache(case['cache'], image, cache_dir, work_dir, case['format'], seed_tar, args.extra)
+        output = work_dir / f"output_{case['format']}"
+        metrics_path = work_dir / 'metrics.json'
+        options = ['--format', case['format'], '-o', str(output), '--max-concurrent-downloads', case['concurrency'],
+                   '--engine', case['engine'], '--metrics-json', str(metrics_path)]
+        options += ['--no-cache'] if case['cache'] == 'none' else ['--cache-dir', str(cache_dir)]
+        log_path = work_dir / f"{case['stage']}_{case['format']}_{case['cache']}_{case['concurrency']}_{case['engine']}_{index}.log"
+        result = run_measured(pull_command(case['stage'], image, options + args.extra), log_path)
+        if result['returncode'] != 0:
+            raise RuntimeError(f"pull failed ({', '.join(f'{key}={value}' for key, value in case.items())}), see {log_path}")
+        with open(metrics_path) as f:
+            metrics = json.load(f)
+        result['image_bytes'] = sum(layer['size'] or 0 for layer in metrics['layers'])
+        result['downloaded'] = metrics['bytes_downloaded']
+        runs.append(result)
+        remove_output(output)
+        metrics_path.unlink()
+        log_path.unlink()
+    stats_after = mock_stats(base_url)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    median = sorted(runs, key=lambda run: run['wall'])[len(runs) // 2]
+    return dict(case, wall=median['wall'], throughput=median['image_bytes'] / median['wall'] if median['wall'] > 0 else 0,
+                downloaded=median['downloaded'], rss=median['rss'], cpu=median['cpu'],
+                wall_stdev=statistics.stdev(run['wall'] for run in runs) if len(runs) > 1 else 0.0,
+                throttled=stats_after.get('throttled', 0) - stats_before.get('throttled', 0),
+                disconnects=stats_after.get('disconnects', 0) - stats_before.get('disconnects', 0))
+
+def case_key(result: dict) -> str:
+    return '/'.join(str(result[key]) for key in ('stage', 'format', 'cache', 'concurrency', 'engine'))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='离线拉取性能基准测试：本地模拟仓库 + 并发数/缓存状态/输出格式/引擎组合，报告吞吐量、峰值内存和CPU时间',
+        epilog='Arguments after -- are passed to docker_pull.py, e.g. -- --connections-per-blob 1',
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--stages', default='pull', help='pull (full pull with archive) and/or layers (only resolve and download layers, via the Puller API) (默认: pull)')
+    parser.add_argument('--concurrency', default='1,3,8', help='--max-concurrent-downloads values, auto allowed (默认: 1,3,8)')
+    parser.add_argument('--cache-states', default='cold,warm', help=f'Cache state before each run: {", ".join(CACHE_STATES)} (none = --no-cache) (默认: cold,warm)')
+    parser.add_argument('--formats', default='docker', help='Output formats: docker, oci, oci-archive (默认: docker)')
+    parser.add_argument('--engines', default='thread', help='Download engines: thread, async (默认: thread)')
+    parser.add_argument('--runs', type=int, default=3, help='每个组合运行次数，取中位数 (默认: 3)')
+    parser.add_argument('--layers', type=int, default=8, help='合成镜像层数 (默认: 8)')
+    parser.add_argument('--layer-size', default='8M', help='每层解压后的大小 (默认: 8M)')
+    parser.add_argument('--seed', type=int, default=0, help='合成镜像内容随机种子 (默认: 0)')
+    parser.add_argument('--latency', type=float, default=0, help='模拟仓库每个请求的延迟，毫秒 (默认: 0)')
+    parser.add_argument('--rate', default='0', help='模拟仓库每个连接的带宽上限，例如 20M (默认: 不限)')
+    parser.add_argument('--fail-rate', type=float, default=0, help='层下载中途断开连接的概率 0-1 (默认: 0)')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='请求返回429的概率 0-1 (默认: 0)')
+    parser.add_argument('--retry-after', type=float, default=0.2, help='429响应的Retry-After秒数 (默认: 0.2)')
+    parser.add_argument('--work-dir', default='./pull_benchmark', help='缓存、输出和日志的工作目录 (默认: ./pull_benchmark)')
+    parser.add_argument('--json', metavar='FILE', help='将结果写入JSON文件，可作为之后运行的 --compare 基线')
+    parser.add_argument('--compare', metavar='FILE', help='与之前 --json 保存的基线比较吞吐量')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='--compare 时吞吐量允许下降的比例，超过则以1退出 (默认: 0.2)')
+
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        argv, extra = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+    args.extra = extra
+
+    split = lambda value: [item.strip() for item in value.split(',') if item.strip()]
+    cache_states = split(args.cache_states)
+    unknown = [state for state in cache_states if state not in CACHE_STATES]
+    if unknown:
+        parser.error(f"unknown cache state(s): {', '.join(unknown)}")
+    cases = [dict(zip(('stage', 'format', 'cache', 'concurrency', 'engine'), combination))
+             for combination in itertools.product(split(args.stages), split(args.formats), cache_states,
+                                                  split(args.concurrency), split(args.engines))]
+
+    work_dir = Path(args.work_dir).expanduser().resolve()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    work_dir.mkdir(parents=True)
+
+    print("="*60)
+    print("🐳 离线拉取性能基准测试")
+    print(f"📦 {args.layers} layers × {args.layer_size}, {len(cases)} combinations × {args.runs} runs")
+    print("="*60)
+
+    mock, base_url = start_mock_registry(args)
+    image = base_url.split('://', 1)[1] + '/bench/image:latest'
+    results = []
+    try:
+        seed_tar = work_dir / 'seed.tar'
+        if 'imported' in cache_states:
+            # The archive --import-tar preheats the cache from
+            cmd = [sys.executable, str(DOCKER_PULL), image, '--no-cache', '-o', str(seed_tar)] + args.extra
+            if subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+                raise RuntimeError('could not pull the archive for the imported cache state')
+
+        for case in cases:
+            print(f"\n🔄 {case_key(case)}")
+            result = run_case(args, case, image, base_url, work_dir, seed_tar)
+            results.append(result)
+            print(f"   ⏱️  {result['wall']:.2f}s, {format_size(result['throughput'])}/s"
+                  + (f", peak RSS {format_size(result['rss'])}, CPU {result['cpu']:.2f}s" if result['rss'] is not None else ''))
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    print(f"\n📊 Results (median of {args.runs} runs):")
+    print(f"   {'STAGE/FORMAT/CACHE/CONC/ENGINE':<36} {'TIME':>8} {'THROUGHPUT':>12} {'DOWNLOADED':>11} {'PEAK RSS':>10} {'CPU':>7} {'429':>4} {'CUT':>4}")
+    for result in results:
+        rss = format_size(result['rss']) if result['rss'] is not None else 'n/a'
+        cpu = f"{result['cpu']:.2f}s" if result['cpu'] is not None else 'n/a'
+        print(f"   {case_key(result):<36} {result['wall']:>7.2f}s {format_size(result['throughput']) + '/s':>12} "
+              f"{format_size(result['downloaded']):>11} {rss:>10} {cpu:>7} {result['throttled']:>4} {result['disconnects']:>4}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'layers': args.layers, 'layer_size': args.layer_size, 'runs': args.runs, 'results': results}, f, indent=2)
+        print(f"\n💾 Results written to {args.json}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {case_key(result): result for result in json.load(f)['results']}
+        regressions = []
+        print(f"\n📈 Compared with {args.compare}:")
+        for result in results:
+            before = baseline.get(case_key(result))
+            if not before or not before['throughput']:
+                continue
+            change = result['throughput'] / before['throughput'] - 1
+            print(f"   {case_key(result):<36} {change:>+7.1%}")
+            if change < -args.max_regression:
+                regressions.append(case_key(result))
+        if regressions:
+            print(f"\n❌ Throughput dropped more than {args.max_regression:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print(f"\n🎉 No regression beyond {args.max_regression:.0%}")
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,72 @@
 import os
+import re
 import sys
-import gzip
+import zlib
 from io import BytesIO
 import json
 import hashlib
 import shutil
-import requests
 import tarfile
-import urllib3
+import tempfile
 import argparse
 import threading
 import time
 import base64
 import signal
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import socket
+import inspect
+import builtins
+import importlib
+import importlib.util
+import contextvars
+import queue
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from functools import wraps
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterable
 import urllib.parse
 from pathlib import Path
-urllib3.disable_warnings()
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# requests (and urllib3 under it) is by far the slowest import, and asyncio/aiohttp are only needed by
+# --engine async: they are imported once something is going to be downloaded, so --help, --version,
+# `cache` and --import-tar start instantly
+requests = None
+urllib3 = None
+asyncio = None
+httpx = None
+timed_pool_classes = None
+
+def load_network_modules():
+    """Import requests and urllib3 into the module namespace"""
+    global requests, urllib3, timed_pool_classes
+    if requests is None:
+        import requests
+        import urllib3
+        urllib3.disable_warnings()
+        # Connection pools whose new connections report their setup times (see TimedConnectionMixin)
+        timed_pool_classes = {
+            'http': type('TimedHTTPConnectionPool', (urllib3.HTTPConnectionPool,), {'ConnectionCls':
+                type('TimedHTTPConnection', (TimedConnectionMixin, urllib3.connection.HTTPConnection), {})}),
+            'https': type('TimedHTTPSConnectionPool', (urllib3.HTTPSConnectionPool,), {'ConnectionCls':
+                type('TimedHTTPSConnection', (TimedConnectionMixin, urllib3.connection.HTTPSConnection), {})}),
+        }
+
+def print(*args, file=None, **kwargs):
+    """The messages of this module: stdout on the command line, the log= stream (or nowhere) of an active Puller.
+    A message and its line end are written under progress_lock, so messages of other threads can't split them"""
+    if file is None and active_puller is not None:
+        file = active_puller.log
+        if file is None:
+            return
+    with progress_lock:
+        builtins.print(*args, file=file, **kwargs)
 
 # 全局变量用于优雅退出
 shutdown_event = threading.Event()
@@ -40,11 +88,6 @@ def signal_handler(signum, frame):
     print("✅ 清理完成，程序退出")
     sys.exit(0)
 
-# 注册信号处理器
-signal.signal(signal.SIGINT, signal_handler)
-if hasattr(signal, 'SIGTERM'):
-    signal.signal(signal.SIGTERM, signal_handler)
-
 # 版本和版权信息
 __version__ = "1.24"
 __author__ = "luckfu"
@@ -70,110 +113,220 @@ def show_banner():
     print("="*60)
     print()
 
+def parse_size(value):
+    """Parse a human-readable size such as 512K, 16M or 2G into bytes"""
+    units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = str(value).strip().upper()
+    for suffix in ('IB', 'B'):
+        if text.endswith(suffix) and len(text) > len(suffix):
+            text = text[:-len(suffix)]
+            break
+    unit = text[-1:] if text[-1:] in units else ''
+    number = text[:-1] if unit else text
+    try:
+        return int(float(number) * units[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value}")
+
+ADAPTIVE_INITIAL_CONCURRENCY = 3
+ADAPTIVE_MAX_CONCURRENCY = 32
+
+def parse_concurrency(value):
+    """Parse --max-concurrent-downloads: a positive number, or auto for adaptive concurrency"""
+    if str(value).strip().lower() == 'auto':
+        return 'auto'
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive number or auto: {value}")
+    return number
+
+# gzip inflate implementations besides zlib: python-zlib-ng and python-isal are drop-in replacements
+# that inflate several times faster; --inflate-backend auto takes the first one installed
+INFLATE_BACKENDS = {'zlib-ng': 'zlib_ng.zlib_ng', 'isal': 'isal.isal_zlib'}
+
+def load_inflate_backend(name: str):
+    """Return (name, module) of the zlib-compatible inflate implementation for --inflate-backend"""
+    for candidate in (list(INFLATE_BACKENDS) if name == 'auto' else [name]):
+        if candidate == 'zlib':
+            break
+        try:
+            return candidate, importlib.import_module(INFLATE_BACKENDS[candidate])
+        except ImportError:
+            if name != 'auto':
+                raise ValueError(f"--inflate-backend {name} 需要 {candidate}，请先安装: pip install {candidate}")
+    return 'zlib', zlib
+
 # Parse command line arguments
 parser = argparse.ArgumentParser(
     description='不需要Docker环境的镜像下载工具，支持多平台、并发下载、智能缓存',
     epilog=f'开源项目: {__url__}',
     formatter_class=argparse.RawDescriptionHelpFormatter
 )
-parser.add_argument('image', nargs='?', help='[registry/][repository/]image[:tag|@digest]')
-parser.add_argument('--platform', help='Target platform (e.g., linux/amd64, linux/arm64, linux/arm/v7)')
-parser.add_argument('--max-concurrent-downloads', type=int, default=3, help='Maximum number of concurrent layer downloads (default: 3)')
+parser.add_argument('image', nargs='*', help='[registry/][repository/]image[:tag|@digest], several images are pulled in one run')
+parser.add_argument('--images-file', help='File with one image reference per line (# comments allowed), pulled together with shared layer downloads')
+parser.add_argument('--platform', help='Target platform (e.g., linux/amd64, linux/arm64, linux/arm/v7), comma separated to pull several')
+parser.add_argument('--all-platforms', action='store_true', help='Pull every platform of a multi-platform image')
+parser.add_argument('--max-concurrent-downloads', type=parse_concurrency, default=3, help=f'Maximum number of concurrent layer downloads, or auto to tune it from the measured throughput (up to {ADAPTIVE_MAX_CONCURRENCY}) (default: 3)')
+parser.add_argument('--max-concurrent-images', type=int, default=4, help='Maximum number of images processed at once in batch mode, layer downloads share one pool (default: 4)')
+parser.add_argument('--engine', choices=['thread', 'async'], default='thread', help='Download engine: thread pool, or one asyncio event loop for many concurrent streams (needs aiohttp) (default: thread)')
+parser.add_argument('--limit-rate', type=parse_size, default=0, help='Cap the total download bandwidth of all workers, e.g. 50M (bytes per second, default: unlimited)')
+parser.add_argument('--max-connections-per-registry', metavar='N[,REGISTRY=N...]', help='Cap concurrent blob connections per registry, e.g. 8 or 8,harbor.example.com=5 (default: unlimited)')
+parser.add_argument('--registry-mirror', action='append', default=[], metavar='[REGISTRY=]URL', help='Pull-through mirror of a registry (Docker Hub when REGISTRY is omitted), tried before the registry itself; repeat or comma separate for several')
+parser.add_argument('--mirror-strategy', choices=['spread', 'fastest', 'order'], default='spread', help='How layers are assigned to the mirrors and the registry: spread by measured throughput, all to the fastest, or in the configured order without probing (default: spread)')
+parser.add_argument('--chunk-size', type=parse_size, default='16M', help='Range request size for segmented downloads of large layers (default: 16M)')
+parser.add_argument('--connections-per-blob', type=int, default=4, help='Parallel range connections per large layer, 1 disables segmented downloads (default: 4)')
+parser.add_argument('--http2', action='store_true', help='Send registry, auth and CDN requests over HTTP/2 where the server supports it, multiplexing them over a few pooled connections per host (needs httpx[http2]; --engine async keeps aiohttp for blobs)')
+parser.add_argument('--inflate-backend', choices=['auto', 'zlib', 'zlib-ng', 'isal'], default='auto', help='gzip decompression library: auto uses zlib-ng or isal when installed (several times faster than zlib) (default: auto)')
 parser.add_argument('--username', help='Username for registry authentication (supports Docker Hub, GCR, ECR, Harbor, etc.)')
 parser.add_argument('--password', help='Password for registry authentication')
 parser.add_argument('--cache-dir', help='Layer cache directory (default: ./docker_images_cache)', default=None)
 parser.add_argument('--no-cache', action='store_true', help='Disable layer caching')
+parser.add_argument('--cache-max-size', type=parse_size, default=0, help='Evict least recently used cache entries after each run to keep layers and blobs under this size, e.g. 200G (default: unlimited)')
+parser.add_argument('--cache-policy', choices=['lru', 'lfu'], default='lru', help='Eviction order for --cache-max-size: least recently or least frequently used (default: lru)')
+parser.add_argument('--cache-storage', choices=['tar', 'blob', 'zstd'], default='tar', help='How docker-format pulls keep layers in the cache: uncompressed layer.tar (fastest reuse), the compressed registry blob, or layer.tar recompressed with zstd (needs zstandard); compressed layers are expanded while the archive is written (default: tar)')
+parser.add_argument('--cache-zstd-level', type=int, default=3, help='zstd level for --cache-storage zstd, 1 (fast) to 19 (small) (default: 3)')
+parser.add_argument('-o', '--output', help='Output tar path, or - to stream the image to stdout for docker load (default: <repo>_<image>.tar)')
+parser.add_argument('--format', choices=['docker', 'oci', 'oci-archive'], default='docker', help='Output format: docker save tar, OCI image layout directory, or OCI layout tar; OCI formats keep layers compressed (default: docker)')
+parser.add_argument('--offline', action='store_true', help='Use only cached manifests and layers, never contact the registry')
+parser.add_argument('--metrics-json', metavar='FILE', help='Write per-layer timings (connection setup, first byte, transfer, decompress, cache publish, bytes, retries, source URL) and run phases to a JSON file')
+parser.add_argument('--metrics-prometheus', metavar='FILE', help='Write run metrics in the Prometheus text format, e.g. for the node_exporter textfile collector (name it *.prom)')
+parser.add_argument('--progress', choices=['auto', 'tty', 'log', 'none'], default='auto', help='Download progress: live per-layer bars with total speed and ETA (tty), a summary line every 10s (log), or nothing; auto picks tty on a terminal and log otherwise (default: auto)')
 parser.add_argument('--import-tar', help='Import layers from existing Docker tar file to cache')
 parser.add_argument('--version', action='store_true', help='Show version information and exit')
-args = parser.parse_args()
+parser.set_defaults(cache_command=None, serve=False)
 
-# 处理版本信息显示
-if args.version:
-    show_version()
-    sys.exit(0)
+# `docker_pull.py cache gc|ls|stats` manages the layer cache instead of pulling
+cache_common_parser = argparse.ArgumentParser(add_help=False)
+cache_common_parser.add_argument('--cache-dir', help='Layer cache directory (default: ./docker_images_cache)', default=None)
+cache_parser = argparse.ArgumentParser(prog='docker_pull.py cache', description='管理本地层缓存 (layers and compressed blobs)')
+cache_subparsers = cache_parser.add_subparsers(dest='cache_command')
+cache_gc_parser = cache_subparsers.add_parser('gc', parents=[cache_common_parser], help='Evict entries down to a size limit and drop stale partial downloads')
+cache_gc_parser.add_argument('--max-size', type=parse_size, default=0, help='Target size of layers and blobs, e.g. 200G (default: only remove dangling entries)')
+cache_gc_parser.add_argument('--policy', choices=['lru', 'lfu'], default='lru', help='Evict least recently or least frequently used entries first (default: lru)')
+cache_gc_parser.add_argument('--dry-run', action='store_true', help='Show what would be evicted without deleting anything')
+cache_gc_parser.add_argument('--rescan', action='store_true', help='Rebuild the index from the cache directories first')
+cache_ls_parser = cache_subparsers.add_parser('ls', parents=[cache_common_parser], help='List cached layers and blobs')
+cache_ls_parser.add_argument('--sort', choices=['access', 'size', 'hits'], default='access', help='Sort order, most recent/largest/most used first (default: access)')
+cache_subparsers.add_parser('stats', parents=[cache_common_parser], help='Show cache size and usage statistics')
 
-# 检查是否提供了镜像参数或导入tar文件
-if not args.image and not args.import_tar:
-    show_banner()
-    parser.print_help()
-    print(f"\n💡 示例用法:")
-    print(f"   python docker_pull.py nginx:latest")
-    print(f"   python docker_pull.py --platform linux/arm64 ubuntu:20.04")
-    print(f"   python docker_pull.py --import-tar xxx.tar")
-    print(f"   python docker_pull.py --version")
-    sys.exit(1)
-
-# 处理导入tar文件功能（提前处理以避免执行镜像下载逻辑）
-if args.import_tar:
-    # 设置缓存相关变量
-    if args.cache_dir:
-        cache_dir = Path(args.cache_dir).expanduser().resolve()
-    else:
-        cache_dir = Path.cwd() / 'docker_images_cache'
-    
-    layers_cache_dir = cache_dir / 'layers'
-    use_cache = True  # 导入功能需要启用缓存
-    
-    print(f"\n🔄 Docker tar文件导入模式")
-    # 跳转到函数定义后的导入处理
-    import_tar_file = args.import_tar
-else:
-    import_tar_file = None
-
-# 显示启动横幅（仅在非导入模式下）
-if not args.import_tar:
-    show_banner()
+# `docker_pull.py serve` exposes the cache as a read-only registry, fetching what it lacks from upstream
+serve_parser = argparse.ArgumentParser(
+    prog='docker_pull.py serve',
+    description='把本地层缓存作为只读镜像仓库 (Registry v2) 提供给其他机器，缓存未命中时从上游拉取并写入缓存',
+    epilog='Example: python docker_pull.py serve --listen 0.0.0.0:5000, then elsewhere: docker pull <host>:5000/library/nginx:latest',
+    formatter_class=argparse.RawDescriptionHelpFormatter
+)
+serve_parser.add_argument('--listen', default='127.0.0.1:5000', metavar='[HOST:]PORT', help='Address to listen on, e.g. 0.0.0.0:5000 to serve other machines (default: 127.0.0.1:5000)')
+serve_parser.add_argument('--upstream', default='registry-1.docker.io', help='Registry proxied for repository names without a registry host, e.g. library/nginx (default: registry-1.docker.io)')
+serve_parser.add_argument('--allow-registry', action='append', default=[], metavar='REGISTRY', help='Also proxy this registry for repository names starting with it, e.g. quay.io/org/app (repeatable; default: only --upstream)')
+serve_parser.add_argument('--tls-cert', help='Serve HTTPS with this PEM certificate (docker pulls plain HTTP only from its insecure-registries)')
+serve_parser.add_argument('--tls-key', help='Private key of --tls-cert')
+serve_parser.add_argument('--cache-dir', help='Layer cache directory (default: ./docker_images_cache)', default=None)
+serve_parser.add_argument('--offline', action='store_true', help='Serve only what is cached, never contact the upstream registries')
+serve_parser.add_argument('--max-concurrent-downloads', type=parse_concurrency, default=3, help='Maximum number of concurrent upstream blob downloads (default: 3)')
+serve_parser.add_argument('--limit-rate', type=parse_size, default=0, help='Cap the total upstream download bandwidth, e.g. 50M (default: unlimited)')
+serve_parser.add_argument('--max-connections-per-registry', metavar='N[,REGISTRY=N...]', help='Cap concurrent blob connections per upstream registry (default: unlimited)')
+serve_parser.add_argument('--registry-mirror', action='append', default=[], metavar='[REGISTRY=]URL', help='Pull-through mirror of an upstream registry, see docker_pull.py --help')
+serve_parser.add_argument('--mirror-strategy', choices=['spread', 'fastest', 'order'], default='spread', help='How blobs are assigned to the mirrors (default: spread)')
+serve_parser.add_argument('--username', help='Username for the upstream registry (only sent to --upstream)')
+serve_parser.add_argument('--password', help='Password for the upstream registry (only sent to --upstream)')
+serve_parser.add_argument('--cache-max-size', type=parse_size, default=0, help='Evict least recently used cache entries every minute to stay under this size (default: unlimited)')
+serve_parser.add_argument('--cache-policy', choices=['lru', 'lfu'], default='lru', help='Eviction order for --cache-max-size (default: lru)')
 
-# 导入tar文件功能将在缓存函数定义后处理
+# Retry decorator
+class RetryError(Exception):
+    pass
 
-# 只有在非导入模式下才执行镜像下载逻辑
-if not args.import_tar:
-    image_arg = args.image
-    target_platform = args.platform
-    max_concurrent_downloads = args.max_concurrent_downloads
+# Bearer token cache shared by manifest, config and layer requests.
+# Keyed by (auth_url, service, scope) so every worker reuses one token per repository.
+TOKEN_DEFAULT_TTL = 60       # Docker token spec: tokens without expires_in are valid for 60s
+TOKEN_REFRESH_MARGIN = 15    # refresh this many seconds before the token expires
+token_cache = {}
+token_cache_lock = threading.Lock()
+token_fetch_locks = {}
+auth_stats = {'token_fetches': 0, 'token_reuses': 0}
 
-    # Layer cache configuration
-    use_cache = not args.no_cache
-    if args.cache_dir:
-        cache_dir = Path(args.cache_dir).expanduser().resolve()
-    else:
-        cache_dir = Path.cwd() / 'docker_images_cache'
+def parse_token_issued_at(issued_at):
+    """Parse the RFC3339 issued_at field of a token response into a unix timestamp"""
+    if not issued_at:
+        return None
+    try:
+        from datetime import datetime, timezone
+        value = issued_at.strip().replace('Z', '+00:00')
+        # Trim fractional seconds beyond microseconds (some registries send nanoseconds)
+        if '.' in value:
+            head, rest = value.split('.', 1)
+            frac = ''.join(c for c in rest if c.isdigit())
+            tz = rest[len(frac):]
+            value = f"{head}.{frac[:6]}{tz}"
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+    except (ValueError, TypeError):
+        return None
 
-    layers_cache_dir = cache_dir / 'layers'
-    manifests_cache_dir = cache_dir / 'manifests'
+def cached_registry_token(key):
+    """A cached token that is not due for refresh, or None"""
+    with token_cache_lock:
+        cached = token_cache.get(key)
+        if cached and cached['refresh_at'] > time.time():
+            auth_stats['token_reuses'] += 1
+            return cached['token']
+        return None
 
-    # Initialize cache directories
-    if use_cache:
-        layers_cache_dir.mkdir(parents=True, exist_ok=True)
-        manifests_cache_dir.mkdir(parents=True, exist_ok=True)
-        print(f"Using layer cache: {cache_dir}")
-    else:
-        print("Layer caching disabled")
+def get_registry_token(auth_url, reg_service, repository):
+    """Return a cached bearer token for the repository, fetching a new one when missing or about to expire"""
+    scope = f"repository:{repository}:pull"
+    key = (auth_url, reg_service, scope)
+    token = cached_registry_token(key)
+    if token:
+        return token
 
-    # Thread-safe progress tracking
-    progress_lock = threading.Lock()
-    download_progress = {}
-    cache_stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0}
+    # One fetch per key: concurrent workers needing the same token wait for it, other repositories and
+    # registries fetch theirs in parallel instead of queueing behind a slow auth server
+    with token_cache_lock:
+        fetch_lock = token_fetch_locks.setdefault(key, threading.Lock())
+    with fetch_lock:
+        token = cached_registry_token(key)
+        if token:
+            return token
 
-    # Global session for connection pooling
-    session = requests.Session()
-    session.headers.update({'User-Agent': 'Docker-Pull-Script/1.0'})
+        token_url = f"{auth_url}?service={reg_service}&scope={scope}"
+        with timed_phase('auth'):
+            resp = session.get(token_url, verify=False, timeout=10)
+        with token_cache_lock:
+            auth_stats['token_fetches'] += 1
+        if resp.status_code != 200:
+            print(f"Warning: Token authentication failed with status {resp.status_code}")
+            return None
 
-    # Authentication support
-    username = args.username
-    password = args.password
+        token_data = resp.json()
+        token = token_data.get('token') or token_data.get('access_token')
+        if not token:
+            return None
 
-    # Display authentication info
-    if username and password:
-        print(f"Using authentication for user: {username}")
-    elif username or password:
-        print("Warning: Both username and password are required for authentication")
-    else:
-        print("Using anonymous access (no credentials provided)")
+        now = time.time()
+        try:
+            expires_in = int(token_data.get('expires_in') or TOKEN_DEFAULT_TTL)
+        except (TypeError, ValueError):
+            expires_in = TOKEN_DEFAULT_TTL
+        issued_at = parse_token_issued_at(token_data.get('issued_at'))
+        # Never trust an issued_at from the future (clock skew), only use it to shorten the lifetime
+        issued = min(issued_at, now) if issued_at else now
+        margin = min(TOKEN_REFRESH_MARGIN, expires_in / 4)
+        with token_cache_lock:
+            token_cache[key] = {'token': token, 'expires_at': issued + expires_in, 'refresh_at': issued + expires_in - margin}
+        return token
 
-# Retry decorator
-class RetryError(Exception):
-    pass
+def invalidate_registry_token(auth_url, reg_service, repository):
+    """Drop a cached token, e.g. after the registry rejected it with 401"""
+    key = (auth_url, reg_service, f"repository:{repository}:pull")
+    with token_cache_lock:
+        token_cache.pop(key, None)
 
 def get_auth_head(type_var, registry=None, repository=None, username=None, password=None, auth_url=None, reg_service=None):
     """Get authentication header for Docker registry requests"""
@@ -189,18 +342,9 @@ def get_auth_head(type_var, registry=None, repository=None, username=None, passw
     # Try token auth if we have auth_url and reg_service (from registry probing or known endpoints)
     if registry and auth_url and reg_service:
         try:
-            token_url = f"{auth_url}?service={reg_service}&scope=repository:{repository}:pull"
-            
-            resp = requests.get(token_url, verify=False, timeout=10)
-            
-            if resp.status_code == 200:
-                token_data = resp.json()
-                token = token_data.get('token') or token_data.get('access_token')
-                if token:
-                    header['Authorization'] = f'Bearer {token}'
-            else:
-                # If token auth fails, try anonymous access
-                print(f"Warning: Token authentication failed with status {resp.status_code}")
+            token = get_registry_token(auth_url, reg_service, repository)
+            if token:
+                header['Authorization'] = f'Bearer {token}'
                 
         except Exception as e:
             print(f"Warning: Could not obtain authentication token: {e}")
@@ -208,8 +352,559 @@ def get_auth_head(type_var, registry=None, repository=None, username=None, passw
     # For registries without token auth configuration, just return basic header
     return header
 
+def refresh_auth_head(type_var, registry=None, repository=None, username=None, password=None, auth_url=None, reg_service=None):
+    """Discard the cached token and build a fresh authentication header (used after a 401)"""
+    if auth_url and reg_service:
+        invalidate_registry_token(auth_url, reg_service, repository)
+    return get_auth_head(type_var, registry, repository, username, password, auth_url, reg_service)
+
+# Bandwidth limit and per-registry connection caps, shared by every download worker and both engines.
+# A registry answering 429/503 puts all workers to sleep for its Retry-After and halves the number of
+# connections it gets, instead of each request burning through its own fixed retries.
+THROTTLE_STATUS_CODES = (429, 503)
+THROTTLE_MAX_RETRIES = 5
+THROTTLE_MAX_DELAY = 120
+
+class TokenBucket:
+    """Token bucket limiting the combined download rate (bytes per second)"""
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate / 4, 64 * 1024)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Take amount tokens (going into debt if needed); returns how long the caller has to wait"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class SlotLimiter:
+    """Adjustable number of concurrent slots, usable with `with` and `async with`"""
+    def __init__(self, limit):
+        self.limit = limit          # 0 means no cap
+        self.active = 0
+        self.cond = threading.Condition()
+
+    def try_acquire(self):
+        """Take a slot if one is free; else return seconds to wait"""
+        with self.cond:
+            if self.limit and self.active >= self.limit:
+                return 0.1
+            self.active += 1
+            return 0
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def __enter__(self):
+        while True:
+            if shutdown_event.is_set():
+                raise KeyboardInterrupt("Download interrupted by user")
+            wait_time = self.try_acquire()
+            if not wait_time:
+                return self
+            with self.cond:
+                self.cond.wait(min(wait_time, 0.5))
+
+    def __exit__(self, *exc):
+        self.release()
+
+    async def __aenter__(self):
+        while True:
+            if shutdown_event.is_set():
+                raise DownloadInterrupted("Download interrupted by user")
+            wait_time = self.try_acquire()
+            if not wait_time:
+                return self
+            await asyncio.sleep(min(wait_time, 0.5))
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+class RegistryLimiter(SlotLimiter):
+    """Connection slots and 429/503 backoff for one registry"""
+    def __init__(self, registry, limit):
+        super().__init__(limit)
+        self.registry = registry
+        self.blocked_until = 0
+
+    def try_acquire(self):
+        """Take a slot if the registry isn't backing off and one is free; else return seconds to wait"""
+        backoff = self.backoff_remaining()
+        if backoff > 0:
+            return backoff
+        return super().try_acquire()
+
+    def backoff_remaining(self):
+        return max(0, self.blocked_until - time.monotonic())
+
+    def throttle(self, delay):
+        """Registry answered 429/503: pause new requests for delay seconds and halve the connection cap"""
+        delay = min(delay, THROTTLE_MAX_DELAY)
+        with self.cond:
+            now = time.monotonic()
+            already_backing_off = self.blocked_until > now
+            self.blocked_until = max(self.blocked_until, now + delay)
+            lowered = max(1, self.active // 2) if self.active else 0
+            if lowered and (not self.limit or lowered < self.limit):
+                self.limit = lowered
+            else:
+                lowered = 0
+        download_slots.congestion()
+        if already_backing_off and not lowered:
+            return
+        with progress_lock:
+            limit_note = f', connections limited to {lowered}' if lowered else ''
+            print(f'\n⚠️  {self.registry} is throttling requests, backing off {delay:.0f}s{limit_note}')
+
+# Adaptive concurrency (--max-concurrent-downloads auto): every ADAPT_INTERVAL the aggregate throughput of
+# all streams decides the number of concurrent layer downloads. Slow start doubles it while throughput keeps
+# rising; after that it probes one stream at a time. A step that gains less than ADAPT_MIN_GAIN is taken back
+# and held for ADAPT_HOLD_WINDOWS, and network errors or registry throttling halve it.
+ADAPT_INTERVAL = 2.0
+ADAPT_MIN_GAIN = 0.1
+ADAPT_HOLD_WINDOWS = 5
+
+class ConcurrencyController(SlotLimiter):
+    """Concurrent layer downloads of both engines, fixed or tuned AIMD-style from the measured throughput"""
+    def __init__(self, limit, ceiling, adaptive):
+        super().__init__(limit)
+        self.ceiling = ceiling
+        self.adaptive = adaptive
+        self.slow_start = True
+        self.grown_from = None      # (limit, bytes/s) before the step being evaluated
+        self.hold_windows = 0
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.last_decrease = 0
+        self.peak = limit
+        self.best_rate = 0
+
+    def add_bytes(self, amount):
+        """Count received bytes and re-evaluate the limit once per window"""
+        if not self.adaptive:
+            return
+        with self.cond:
+            self.window_bytes += amount
+            now = time.monotonic()
+            elapsed = now - self.window_start
+            if elapsed < ADAPT_INTERVAL:
+                return
+            rate = self.window_bytes / elapsed
+            self.window_start, self.window_bytes = now, 0
+            self.best_rate = max(self.best_rate, rate)
+            if self.active < self.limit:
+                # Fewer layers left than slots, the throughput says nothing about the limit
+                self.grown_from = None
+                return
+            self.adjust(rate)
+
+    def observed_best_rate(self):
+        """Best window throughput, counting the last partial window (short pulls never finish one)"""
+        with self.cond:
+            elapsed = time.monotonic() - self.window_start
+            partial = self.window_bytes / elapsed if self.window_bytes and elapsed > 0 else 0
+            return max(self.best_rate, partial)
+
+    def adjust(self, rate):
+        if self.hold_windows:
+            self.hold_windows -= 1
+            return
+        if self.grown_from is not None:
+            base_limit, base_rate = self.grown_from
+            self.grown_from = None
+            if rate < base_rate * (1 + ADAPT_MIN_GAIN):
+                # Extra streams no longer raise the total bytes per second: step back and stay there a while
+                self.limit = base_limit
+                self.slow_start = False
+                self.hold_windows = ADAPT_HOLD_WINDOWS
+                return
+        if self.limit >= self.ceiling:
+            return
+        self.grown_from = (self.limit, rate)
+        self.limit = min(self.ceiling, self.limit * 2 if self.slow_start else self.limit + 1)
+        self.peak = max(self.peak, self.limit)
+        self.cond.notify_all()
+
+    def congestion(self):
+        """Network error or registry throttling: halve the number of streams (once per window)"""
+        if not self.adaptive:
+            return
+        with self.cond:
+            now = time.monotonic()
+            if now - self.last_decrease < ADAPT_INTERVAL:
+                return
+            self.last_decrease = now
+            self.limit = max(1, self.limit // 2)
+            self.slow_start = False
+            self.grown_from = None
+            self.hold_windows = ADAPT_HOLD_WINDOWS
+            self.window_start, self.window_bytes = now, 0
+
+def account_chunk(size):
+    """Count a received chunk for the adaptive controller; returns how long to pause for --limit-rate"""
+    download_slots.add_bytes(size)
+    return rate_limiter.reserve(size) if rate_limiter else 0
+
+registry_limiters = {}
+registry_limiters_lock = threading.Lock()
+
+def parse_registry_limits(value):
+    """Parse --max-connections-per-registry ("8" or "8,harbor.example.com=5") into {registry or '': limit}"""
+    limits = {}
+    for item in (value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        registry, _, number = item.rpartition('=')
+        limit = int(number)
+        if limit < 1:
+            raise ValueError(item)
+        limits[registry.strip()] = limit
+    return limits
+
+def get_registry_limiter(registry):
+    """Return the shared limiter of a registry host"""
+    with registry_limiters_lock:
+        limiter = registry_limiters.get(registry)
+        if limiter is None:
+            limit = registry_connection_limits.get(registry, registry_connection_limits.get('', 0))
+            limiter = registry_limiters[registry] = RegistryLimiter(registry, limit)
+        return limiter
+
+def parse_retry_after(value, attempt):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), exponential when absent"""
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                from email.utils import parsedate_to_datetime
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return float(2 ** attempt)
+
+def registry_request(ref, method, url, type_var, extra_headers=None, **kwargs):
+    """Send a registry request for an image reference on the shared session, re-authenticating once if the cached token is
+    rejected and waiting out 429/503 responses as the registry asks"""
+    if offline_mode:
+        raise requests.ConnectionError(f'Offline mode: not contacting {url}')
+    auth = (ref['registry'], ref['repository'], *registry_credentials(ref), ref['auth_url'], ref['reg_service'])
+    limiter = get_registry_limiter(ref['registry'])
+    for attempt in range(THROTTLE_MAX_RETRIES + 1):
+        time.sleep(limiter.backoff_remaining())
+        auth_head = get_auth_head(type_var, *auth)
+        resp = session.request(method, url, headers={**auth_head, **(extra_headers or {})}, verify=False, **kwargs)
+        if resp.status_code == 401 and auth_head.get('Authorization', '').startswith('Bearer'):
+            resp.close()
+            auth_head = refresh_auth_head(type_var, *auth)
+            resp = session.request(method, url, headers={**auth_head, **(extra_headers or {})}, verify=False, **kwargs)
+        if resp.status_code not in THROTTLE_STATUS_CODES or attempt == THROTTLE_MAX_RETRIES:
+            return resp
+        resp.close()
+        limiter.throttle(parse_retry_after(resp.headers.get('Retry-After'), attempt))
+
+def registry_get(ref, url, type_var, extra_headers=None, **kwargs):
+    """GET a registry URL, see registry_request"""
+    return registry_request(ref, 'GET', url, type_var, extra_headers, **kwargs)
+
+def registry_url(ref, kind: str, reference: str) -> str:
+    """URL of a manifest or blob ('manifests'/'blobs') of an image reference, or of the same image on a mirror"""
+    return '{}://{}/v2/{}/{}/{}'.format(ref.get('scheme', 'https'), ref['registry'], ref['repository'], kind, reference)
+
+def registry_credentials(ref):
+    """--username/--password belong to the upstream registry and are never sent to its mirrors (nor, when
+    serving, to registries other than --upstream)"""
+    if ref.get('mirror') or (credential_registry and ref['registry'] != credential_registry):
+        return None, None
+    return username, password
+
+# Registry mirrors (--registry-mirror): pull-through endpoints serving the /v2/ API of an upstream registry.
+# Before the first layer of a registry is downloaded its mirrors and the registry itself are probed for
+# latency and throughput; layers are then spread over them by throughput (or all go to the fastest) and
+# a failed attempt moves the layer to another endpoint. Blobs and manifests by digest are verified as
+# always, so a bad mirror costs a retry, never a corrupt image.
+MIRROR_PROBE_BYTES = 1024 * 1024
+MIRROR_PROBE_TIMEOUT = 15
+MIRROR_FAILURE_LIMIT = 3        # consecutive failures before an endpoint is skipped for a while
+MIRROR_BENCH_TIME = 60
+MIRROR_MIN_SAMPLE = 256 * 1024  # smaller downloads say more about latency than throughput
+
+def parse_registry_mirrors(values):
+    """Parse --registry-mirror values ("https://mirror.example.com" for Docker Hub, or
+    "quay.io=http://10.0.0.5:5000/quay,https://quay.mirror.example.com") into {registry: [mirror url, ...]}
+    in the given order; mirrors listed after REGISTRY= in one value belong to that registry"""
+    mirrors = {}
+    for value in values or []:
+        registry = 'registry-1.docker.io'
+        for item in value.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            prefix, sep, url = item.partition('=')
+            if sep and '/' not in prefix:
+                registry, item = prefix.strip(), url.strip()
+                if registry in ('docker.io', 'index.docker.io'):
+                    registry = 'registry-1.docker.io'
+            if not registry or not item:
+                raise ValueError(item)
+            mirrors.setdefault(registry, []).append(item)
+    return mirrors
+
+class RegistryEndpoint:
+    """One server of an upstream registry's /v2/ API: a pull-through mirror, or the registry itself"""
+    def __init__(self, url, upstream=False):
+        parsed = urllib.parse.urlparse(url if '://' in url else 'https://' + url)
+        self.scheme = parsed.scheme or 'https'
+        self.host = parsed.netloc
+        self.prefix = parsed.path.strip('/')   # e.g. a Harbor proxy cache project
+        self.upstream = upstream
+        self.name = self.host + ('/' + self.prefix if self.prefix else '')
+        self.latency = None
+        self.rate = 0.0                         # bytes/s of one stream, probed then tracked
+        self.active = 0
+        self.failures = 0
+        self.benched_until = 0
+        self.blobs = 0
+        self.bytes = 0
+
+    def source(self, ref):
+        """The image reference as served by this endpoint: its host, repository path and token realm"""
+        if self.upstream:
+            return ref
+        auth_url, reg_service = resolve_registry_auth(self.host, self.scheme, anonymous=True)
+        repository = f'{self.prefix}/{ref["repository"]}' if self.prefix else ref['repository']
+        return dict(ref, registry=self.host, repository=repository, scheme=self.scheme, mirror=self.name,
+                    auth_url=auth_url, reg_service=reg_service)
+
+    def benched(self):
+        return self.benched_until > time.monotonic()
+
+class MirrorSet:
+    """The mirrors of one registry followed by the registry itself, with throughput-weighted selection"""
+    def __init__(self, registry, mirror_urls, strategy):
+        self.registry = registry
+        self.strategy = strategy
+        self.endpoints = [RegistryEndpoint(url) for url in mirror_urls] + [RegistryEndpoint(registry, upstream=True)]
+        self.lock = threading.Lock()
+        self.probe_lock = threading.Lock()
+        self.probed = len(self.endpoints) == 1 or strategy == 'order'
+        self.blob_failures = {}     # digest -> endpoints that failed it
+
+    def ranked(self, exclude=()):
+        """Endpoints to try in turn: fastest first once probed (configured order before), benched ones last"""
+        with self.lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if self.strategy == 'order':
+                return sorted(candidates, key=lambda e: e.benched())
+            return sorted(candidates, key=lambda e: (e.benched(), -e.rate))
+
+    def pick(self, digest):
+        """Endpoint for the next attempt at a blob, preferring those that haven't failed it"""
+        with self.lock:
+            failed = self.blob_failures.get(digest, set())
+            candidates = [e for e in self.endpoints if e not in failed and not e.benched()]
+            if not candidates:
+                # A live endpoint that failed this blob once (a dropped stream) beats one that is benched as unreachable
+                candidates = ([e for e in self.endpoints if not e.benched()] or [e for e in self.endpoints if e not in failed]
+                              or list(self.endpoints))
+            if self.strategy == 'spread':
+                # Expected share of an endpoint's throughput if it took one more stream
+                endpoint = min(candidates, key=lambda e: (e.active + 1) / e.rate if e.rate else float('inf'))
+            elif self.strategy == 'fastest':
+                endpoint = max(candidates, key=lambda e: e.rate)
+            else:
+                endpoint = candidates[0]
+            endpoint.active += 1
+            return endpoint, len(candidates) - 1
+
+    def succeeded(self, endpoint, digest, size, elapsed):
+        with self.lock:
+            endpoint.active -= 1
+            endpoint.failures = 0
+            endpoint.blobs += 1
+            endpoint.bytes += size
+            self.blob_failures.pop(digest, None)
+            if size >= MIRROR_MIN_SAMPLE and elapsed > 0:
+                rate = size / elapsed
+                endpoint.rate = rate if not endpoint.rate else endpoint.rate * 0.7 + rate * 0.3
+
+    def failed(self, endpoint, digest=None, release=True):
+        """An attempt on the endpoint failed: move the blob elsewhere, and skip the endpoint a while if it keeps failing"""
+        with self.lock:
+            if release:
+                endpoint.active -= 1
+            if digest is not None:
+                self.blob_failures.setdefault(digest, set()).add(endpoint)
+            endpoint.failures += 1
+            if endpoint.failures < MIRROR_FAILURE_LIMIT or len(self.endpoints) == 1 or endpoint.benched():
+                return
+            endpoint.benched_until = time.monotonic() + MIRROR_BENCH_TIME
+            endpoint.rate /= 2
+        with progress_lock:
+            print(f'\n⚠️  {endpoint.name} failed {endpoint.failures} times in a row, skipping it for {MIRROR_BENCH_TIME}s')
+
+    def released(self, endpoint):
+        with self.lock:
+            endpoint.active -= 1
+
+    def attempt(self, ref, layer):
+        return MirrorAttempt(self, ref, layer)
+
+    def probe(self, ref, layer):
+        """Measure latency and single-stream throughput of every endpoint once, on the first bytes of a layer"""
+        if self.probed:
+            return
+        with self.probe_lock:
+            if self.probed:
+                return
+            with ThreadPoolExecutor(max_workers=len(self.endpoints)) as probe_executor:
+                results = list(probe_executor.map(lambda e: self.probe_endpoint(e, ref, layer), self.endpoints))
+            with progress_lock:
+                print(f'🪞 Endpoints of {self.registry} ({self.strategy}):')
+                for endpoint, error in zip(self.endpoints, results):
+                    if error and endpoint.upstream:
+                        print(f'   {endpoint.name:<40} probe failed ({error}), tried last')
+                    elif error:
+                        print(f'   {endpoint.name:<40} unavailable ({error})')
+                    else:
+                        print(f'   {endpoint.name:<40} {endpoint.latency * 1000:6.0f} ms {format_speed(endpoint.rate):>10}/s')
+            self.probed = True
+
+    def probe_endpoint(self, endpoint, ref, layer):
+        """Probe one endpoint; returns None, or why it can't serve the layer (a mirror is then skipped for a while,
+        the registry itself, the one endpoint sure to have the blob, only ranks last)"""
+        try:
+            source = endpoint.source(ref)
+            start = time.monotonic()
+            resp = registry_get(source, registry_url(source, 'blobs', layer['digest']), 'application/vnd.docker.distribution.manifest.v2+json',
+                                {'Range': f'bytes=0-{MIRROR_PROBE_BYTES - 1}'}, stream=True, timeout=MIRROR_PROBE_TIMEOUT)
+            try:
+                endpoint.latency = time.monotonic() - start
+                if resp.status_code not in (200, 206):
+                    raise RetryError(f'HTTP {resp.status_code}')
+                received = 0
+                for chunk in resp.iter_content(chunk_size=64 * 1024):
+                    received += len(chunk)
+                    if received >= MIRROR_PROBE_BYTES or time.monotonic() - start > MIRROR_PROBE_TIMEOUT:
+                        break
+            finally:
+                resp.close()
+            endpoint.rate = received / max(time.monotonic() - start, 0.001)
+            return None
+        except (requests.RequestException, RetryError) as e:
+            endpoint.rate = 0.0
+            with self.lock:
+                endpoint.failures += 1
+            if not endpoint.upstream:
+                endpoint.benched_until = time.monotonic() + MIRROR_BENCH_TIME
+            return str(e) if isinstance(e, RetryError) else type(e).__name__
+
+class MirrorAttempt:
+    """One attempt at downloading a blob from the endpoint MirrorSet.pick chose, usable with `with` and `async with`;
+    leaving it with an error (or without succeeded()) sends the next attempt elsewhere"""
+    def __init__(self, mirror_set, ref, layer):
+        self.mirror_set = mirror_set
+        self.ref = ref
+        self.layer = layer
+        self.digest = layer['digest']
+        self.size = None
+
+    def __enter__(self):
+        # The first layer the run really downloads from this registry is the probe sample
+        self.mirror_set.probe(self.ref, self.layer)
+        return self.choose()
+
+    def choose(self):
+        self.endpoint, self.alternatives = self.mirror_set.pick(self.digest)
+        try:
+            self.source = self.endpoint.source(self.ref)
+        except BaseException:
+            self.mirror_set.released(self.endpoint)
+            raise
+        self.start = time.monotonic()
+        return self
+
+    def succeeded(self, size):
+        """The blob was downloaded and verified, size bytes of it in this attempt"""
+        self.size = size
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.size is not None:
+            self.mirror_set.succeeded(self.endpoint, self.digest, self.size, time.monotonic() - self.start)
+        elif shutdown_event.is_set() or (exc_type is not None and not issubclass(exc_type, Exception)):
+            self.mirror_set.released(self.endpoint)
+        else:
+            self.mirror_set.failed(self.endpoint, self.digest)
+
+    async def __aenter__(self):
+        if not self.mirror_set.probed:
+            await asyncio.get_running_loop().run_in_executor(None, self.mirror_set.probe, self.ref, self.layer)
+        return self.choose()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__exit__(exc_type, exc, tb)
+
+mirror_sets = {}
+mirror_sets_lock = threading.Lock()
+
+def get_mirror_set(registry):
+    """Return the shared endpoints (mirrors, then the registry itself) of a registry host"""
+    with mirror_sets_lock:
+        mirror_set = mirror_sets.get(registry)
+        if mirror_set is None:
+            mirror_set = mirror_sets[registry] = MirrorSet(registry, registry_mirrors.get(registry, []), mirror_strategy)
+        return mirror_set
+
+def mirrored_request(ref, method, kind, reference, type_var, verify_digest=False, **kwargs):
+    """Request a manifest or blob of ref from the endpoints of its registry in turn, fastest first: a connection error,
+    an error status or (verify_digest) a body not matching the digest reference moves on to the next one"""
+    mirror_set = get_mirror_set(ref['registry'])
+    endpoints = mirror_set.ranked()
+    for index, endpoint in enumerate(endpoints):
+        last = index == len(endpoints) - 1
+        try:
+            source = endpoint.source(ref)
+            resp = registry_request(source, method, registry_url(source, kind, reference), type_var, **kwargs)
+        except requests.RequestException:
+            if last:
+                raise
+            mirror_set.failed(endpoint, release=False)
+            continue
+        if last:
+            return resp
+        if resp.status_code == 200:
+            if not verify_digest or 'sha256:' + hashlib.sha256(resp.content).hexdigest() == reference:
+                return resp
+            with progress_lock:
+                print(f'\n⚠️  {endpoint.name} served {reference[7:19]} with the wrong digest, trying the next endpoint')
+        resp.close()
+        mirror_set.failed(endpoint, release=False)
+
 def retry(max_attempts: int = 3, delay: float = 1.0, backoff: float = 2.0):
     def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                current_delay = delay
+                for attempt in range(1, max_attempts + 1):
+                    try:
+                        return await func(*args, **kwargs)
+                    except (requests.RequestException, RetryError):
+                        if attempt >= max_attempts:
+                            raise
+                        await asyncio.sleep(current_delay)
+                        current_delay *= backoff
+            return async_wrapper
+
         @wraps(func)
         def wrapper(*args, **kwargs):
             attempt = 0
@@ -227,21 +922,388 @@ def retry(max_attempts: int = 3, delay: float = 1.0, backoff: float = 2.0):
         return wrapper
     return decorator
 
-# Initialize variables for image download mode
-if not args.import_tar:
-    image_arg = args.image
-    target_platform = args.platform
-    max_concurrent_downloads = args.max_concurrent_downloads
+# Run configuration: module defaults, set from the command line (or Puller's options) by configure()
+target_platforms = []
+all_platforms = False
+adaptive_concurrency = False
+max_concurrent_downloads = 3
+chunk_size = 16 * 1024 * 1024
+connections_per_blob = 4
+output_format = 'docker'
+download_engine = 'thread'
+limit_rate = 0
+use_cache = True
+offline_mode = False
+cache_max_size = 0
+cache_policy = 'lru'
+cache_storage = 'tar'
+cache_zstd_level = 3
+cache_dir = layers_cache_dir = manifests_cache_dir = partial_cache_dir = blobs_cache_dir = None
+session = None
+username = None
+password = None
+credential_registry = None      # serve: the only registry --username/--password are sent to
+registry_connection_limits = {}
+registry_mirrors = {}
+mirror_strategy = 'spread'
+rate_limiter = None
+download_slots = None
+read_chunk_size = 1024 * 1024
+inflate_backend, inflate = 'zlib', zlib
+aiohttp = None
+zstandard = None
+archive_stdout_fd = None
 
-    # Cache configuration
-    use_cache = not args.no_cache
-    if args.cache_dir:
-        cache_dir = Path(args.cache_dir).expanduser().resolve()
-    else:
-        cache_dir = Path.cwd() / 'docker_images_cache'
+# Thread-safe progress tracking, kept for the lifetime of the process. Every message is printed under
+# progress_lock (see print), so lines of concurrent downloads never run into each other
+progress_lock = threading.RLock()
+download_progress = {}
+cache_stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0}
+transfer_stats = {'bytes_downloaded': 0, 'layers_referenced': 0, 'layers_shared': 0}
+
+# Where pull time goes (--metrics-json, --metrics-prometheus, Puller.metrics()): one record per layer with its
+# connection setup, time to first byte, transfer, decompression and cache publish times, and run phases
+# (auth, manifest, layers, archive) summed over every worker plus the wall time they spanned
+metrics_json = None
+metrics_prometheus = None
+metrics_lock = threading.Lock()
+metrics_started = time.time()
+layer_metrics = {}
+run_phases = {}
+connection_stats = {'connections': 0, 'requests': 0, 'http2': 0, 'dns': 0.0, 'connect': 0.0, 'tls': 0.0}
+HTTP2_KEEPALIVE = 60   # seconds an idle --http2 connection stays pooled for the next layer or redirect
+# The record new connections are charged to: set per download thread (and per asyncio task)
+current_layer_metrics = contextvars.ContextVar('current_layer_metrics', default=None)
+LAYER_TIMINGS = ('wait', 'dns', 'connect', 'tls', 'ttfb', 'transfer', 'decompress', 'publish')
+
+def reset_metrics():
+    """Start a new metrics run"""
+    global metrics_started
+    with metrics_lock:
+        metrics_started = time.time()
+        layer_metrics.clear()
+        run_phases.clear()
+        connection_stats.update({'connections': 0, 'requests': 0, 'http2': 0, 'dns': 0.0, 'connect': 0.0, 'tls': 0.0})
+
+def note_resume_offset(record, offset: int):
+    """Remember how much of the blob an attempt found on disk: the least over all attempts is what a previous
+    run left, the rest of the blob had to be received in this one"""
+    record['resumed'] = offset if record['resumed'] is None else min(record['resumed'], offset)
+
+def layer_record(layer) -> Dict[str, Any]:
+    """The metrics record of a layer, created on first use"""
+    with metrics_lock:
+        record = layer_metrics.get(layer['digest'])
+        if record is None:
+            record = {'digest': layer['digest'], 'size': layer.get('size'), 'source': None, 'url': None, 'status': None,
+                      'bytes': 0, 'resumed': None, 'wasted': 0, 'attempts': 0, 'connections': 0, 'started': time.time(), 'total': 0.0}
+            record.update(dict.fromkeys(LAYER_TIMINGS, 0.0))
+            layer_metrics[layer['digest']] = record
+        return record
+
+def record_phase(name: str, started: float, ended: float, seconds: Optional[float] = None):
+    """Add time spent in a run phase; seconds defaults to ended - started (wall clock timestamps)"""
+    with metrics_lock:
+        phase = run_phases.setdefault(name, {'seconds': 0.0, 'count': 0, 'start': started, 'end': ended})
+        phase['seconds'] += ended - started if seconds is None else seconds
+        phase['count'] += 1
+        phase['start'] = min(phase['start'], started)
+        phase['end'] = max(phase['end'], ended)
+
+@contextmanager
+def timed_phase(name: str):
+    """Time a block (or, as a decorator, each call of a function) as part of a run phase"""
+    started = time.time()
+    try:
+        yield
+    finally:
+        record_phase(name, started, time.time())
+
+def record_connection(dns: float, connect: float, tls: float):
+    """Account the setup of a new connection to the run and to the layer being downloaded, if any"""
+    record = current_layer_metrics.get()
+    with metrics_lock:
+        for target in (connection_stats, record) if record is not None else (connection_stats,):
+            target['connections'] += 1
+            target['dns'] += dns
+            target['connect'] += connect
+            target['tls'] += tls
+
+def public_url(url) -> Optional[str]:
+    """A URL without its query string, which holds the signature of pre-signed CDN URLs"""
+    return str(url).split('?', 1)[0] if url else None
+
+class TimedConnectionMixin:
+    """Mixed into urllib3's connection classes by load_network_modules: times name resolution, TCP connect and
+    the TLS handshake of every new connection (reused pooled connections cost nothing)"""
+
+    def _new_conn(self):
+        host = self._dns_host
+        started = time.perf_counter()
+        try:
+            address = socket.getaddrinfo(host.strip('[]'), self.port, urllib3.util.connection.allowed_gai_family(), socket.SOCK_STREAM)[0][4][0]
+        except (OSError, IndexError, UnicodeError):
+            address = None
+        resolved = time.perf_counter()
+        try:
+            # Connect to the address just resolved instead of resolving again; the full lookup
+            # (every address, proper errors) is the fallback
+            if address is not None:
+                self._dns_host = address
+                try:
+                    sock = super()._new_conn()
+                except urllib3.exceptions.NewConnectionError:
+                    self._dns_host = host
+                    sock = super()._new_conn()
+            else:
+                sock = super()._new_conn()
+        finally:
+            self._dns_host = host
+        self.setup_times = (resolved - started, time.perf_counter() - resolved)
+        return sock
+
+    def connect(self):
+        self.setup_times = None
+        started = time.perf_counter()
+        super().connect()
+        if self.setup_times is not None:
+            dns, connect = self.setup_times
+            record_connection(dns, connect, max(0.0, time.perf_counter() - started - dns - connect))
+
+class Http2Body:
+    """The raw body of a Http2Adapter response: what requests' iter_content and .content read from"""
+
+    def __init__(self, response, request):
+        self.response = response
+        self.request = request
+        self.chunks = None
+
+    def read(self, amt=None, decode_content=True):
+        try:
+            if amt is None:
+                return b''.join(self.response.iter_bytes())
+            if self.chunks is None:
+                self.chunks = self.response.iter_bytes(chunk_size=amt)
+            return next(self.chunks, b'')
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.ReadTimeout(e, request=self.request)
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ChunkedEncodingError(e, request=self.request)
+
+    def close(self):
+        self.response.close()
+
+    release_conn = close
+
+class Http2Adapter:
+    """requests transport adapter sending over httpx (--http2): manifest, config and blob requests to a host share
+    a few multiplexed HTTP/2 connections, and the pools of redirect targets (CDN, S3) stay warm across layers.
+    Servers without HTTP/2 get pooled HTTP/1.1 connections. Responses stream like urllib3 ones."""
+
+    def __init__(self, pool_size: int):
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size,
+                                   keepalive_expiry=HTTP2_KEEPALIVE)
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def client(self, verify):
+        with self.lock:
+            client = self.clients.get(verify)
+            if client is None:
+                client = self.clients[verify] = httpx.Client(http2=True, verify=verify, limits=self.limits, timeout=None,
+                                                             follow_redirects=False, trust_env=True)
+            return client
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        setup = {}
+
+        def trace(event, info):
+            # New connections only: requests multiplexed or reused on a pooled connection skip these events
+            if event in ('connection.connect_tcp.started', 'connection.start_tls.started'):
+                setup[event] = time.perf_counter()
+            elif event == 'connection.start_tls.complete':
+                setup['tls'] = time.perf_counter() - setup.get('connection.start_tls.started', time.perf_counter())
+            elif event == 'connection.connect_tcp.complete':
+                setup['connect'] = time.perf_counter() - setup.get('connection.connect_tcp.started', time.perf_counter())
+
+        try:
+            hx_request = self.client(verify).build_request(
+                request.method, request.url, headers=request.headers, content=request.body,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout), extensions={'trace': trace})
+            hx_response = self.client(verify).send(hx_request, stream=True)
+        except httpx.ConnectTimeout as e:
+            raise requests.exceptions.ConnectTimeout(e, request=request)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.ReadTimeout(e, request=request)
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+        finally:
+            if 'connect' in setup:
+                record_connection(0.0, setup['connect'], setup.get('tls', 0.0))
+
+        response = requests.Response()
+        response.status_code = hx_response.status_code
+        response.reason = hx_response.reason_phrase
+        response.headers = requests.structures.CaseInsensitiveDict(hx_response.headers.items())
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = Http2Body(hx_response, request)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        if hx_response.http_version == 'HTTP/2':
+            with metrics_lock:
+                connection_stats['http2'] += 1
+        return response
+
+    def close(self):
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+
+def count_request(response, *args, **kwargs):
+    """requests response hook: every request sent, redirect hops included (new connections are counted apart)"""
+    with metrics_lock:
+        connection_stats['requests'] += 1
+
+async def trace_request_start(session, context, params):
+    with metrics_lock:
+        connection_stats['requests'] += 1
+
+async def trace_connection_start(session, context, params):
+    context.started = time.perf_counter()
+    context.dns = 0.0
+
+async def trace_dns_start(session, context, params):
+    context.dns_started = time.perf_counter()
 
+async def trace_dns_end(session, context, params):
+    context.dns = time.perf_counter() - context.dns_started
+
+async def trace_connection_end(session, context, params):
+    # aiohttp does not report the TLS handshake apart from the TCP connect
+    record_connection(context.dns, time.perf_counter() - context.started - context.dns, 0.0)
+
+def collect_metrics(images=None) -> Dict[str, Any]:
+    """Snapshot of the metrics of the current run, as written by --metrics-json"""
+    now = time.time()
+    with metrics_lock:
+        layers = sorted((dict(record) for record in layer_metrics.values()), key=lambda record: record['started'])
+        phases = {name: {'seconds': round(phase['seconds'], 6), 'wall': round(phase['end'] - phase['start'], 6), 'count': phase['count']}
+                  for name, phase in run_phases.items()}
+        connections = dict(connection_stats)
+    for record in layers:
+        for key in LAYER_TIMINGS + ('total',):
+            record[key] = round(record[key], 6)
+    return {
+        'version': __version__,
+        'started': metrics_started,
+        'wall': round(now - metrics_started, 6),
+        'engine': download_engine,
+        'images': [{'image': name, 'ok': bool(ok)} for name, ok in images or []],
+        'phases': phases,
+        'connections': {key: round(value, 6) for key, value in connections.items()},
+        'bytes_downloaded': sum(record['bytes'] for record in layers),
+        'bytes_wasted': sum(record['wasted'] for record in layers),
+        'cache': dict(cache_stats),
+        'layers': layers,
+    }
+
+def prometheus_text(metrics: Dict[str, Any]) -> str:
+    """Render run metrics in the Prometheus text format (for the node_exporter textfile collector); per-layer
+    records are summed by stage and source, digests would make a label per layer"""
+    lines = []
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP docker_pull_{name} {help_text}')
+        lines.append(f'# TYPE docker_pull_{name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{value}"' for key, value in labels.items())
+            lines.append(f'docker_pull_{name}{{{label_text}}} {value}' if label_text else f'docker_pull_{name} {value}')
+
+    layers = metrics['layers']
+    metric('last_run_timestamp_seconds', 'gauge', 'When the last run started.', [({}, metrics['started'])])
+    metric('run_duration_seconds', 'gauge', 'Wall time of the last run.', [({}, metrics['wall'])])
+    metric('run_success', 'gauge', '1 if every image of the last run was pulled.', [({}, int(all(image['ok'] for image in metrics['images'])))])
+    metric('phase_seconds', 'gauge', 'Time spent in each phase, summed over concurrent workers.',
+           [({'phase': name}, phase['seconds']) for name, phase in sorted(metrics['phases'].items())])
+    metric('phase_wall_seconds', 'gauge', 'Wall time from the start to the end of each phase.',
+           [({'phase': name}, phase['wall']) for name, phase in sorted(metrics['phases'].items())])
+    metric('layer_stage_seconds', 'gauge', 'Time spent by layer downloads in each stage, summed over layers.',
+           [({'stage': stage}, round(sum(record[stage] for record in layers), 6)) for stage in LAYER_TIMINGS])
+    sources = {}
+    for record in layers:
+        key = record['source'] or 'none', record['status'] or 'unknown'
+        sources[key] = sources.get(key, 0) + 1
+    metric('layers', 'gauge', 'Layers by source and outcome.',
+           [({'source': source, 'status': status}, count) for (source, status), count in sorted(sources.items())])
+    metric('layer_attempts', 'gauge', 'Download attempts of all layers (retries included).', [({}, sum(record['attempts'] for record in layers))])
+    metric('downloaded_bytes', 'gauge', 'Bytes received for layers, every attempt included.', [({}, metrics['bytes_downloaded'])])
+    metric('wasted_bytes', 'gauge', 'Bytes received for completed layers beyond what they needed (discarded after a failed digest check or restart).', [({}, metrics['bytes_wasted'])])
+    metric('connections', 'gauge', 'New connections opened (reused pooled connections not counted).', [({}, metrics['connections']['connections'])])
+    metric('requests', 'gauge', 'HTTP requests sent, redirects included.', [({}, metrics['connections']['requests'])])
+    metric('http2_requests', 'gauge', 'HTTP requests sent over HTTP/2 (--http2).', [({}, metrics['connections']['http2'])])
+    metric('connection_setup_seconds', 'gauge', 'Connection setup time by step.',
+           [({'step': step}, metrics['connections'][step]) for step in ('dns', 'connect', 'tls')])
+    metric('cache_hits', 'gauge', 'Layers served from the cache.', [({}, metrics['cache']['hits'])])
+    return '\n'.join(lines) + '\n'
+
+def report_metrics(images=None):
+    """Write the metrics files asked for with --metrics-json / --metrics-prometheus"""
+    if not metrics_json and not metrics_prometheus:
+        return
+    metrics = collect_metrics(images)
+    try:
+        if metrics_json:
+            write_atomic(Path(metrics_json), json.dumps(metrics, indent=2).encode())
+            print(f"📈 Metrics written to {metrics_json}")
+        if metrics_prometheus:
+            # Renamed into place: the textfile collector must never read a half-written file
+            write_atomic(Path(metrics_prometheus), prometheus_text(metrics).encode())
+            print(f"📈 Prometheus metrics written to {metrics_prometheus}")
+    except OSError as e:
+        print(f"Warning: Could not write metrics: {e}")
+
+def configure_cache_dir(path: Optional[str] = None):
+    """Point the cache globals at a cache directory (default: ./docker_images_cache)"""
+    global cache_dir, layers_cache_dir, manifests_cache_dir, partial_cache_dir, blobs_cache_dir
+    cache_dir = Path(path).expanduser().resolve() if path else Path.cwd() / 'docker_images_cache'
     layers_cache_dir = cache_dir / 'layers'
     manifests_cache_dir = cache_dir / 'manifests'
+    partial_cache_dir = cache_dir / 'partial'
+    blobs_cache_dir = cache_dir / 'blobs'
+
+def configure(options):
+    """Apply parsed pull (or serve) options to the module state: settings, cache, HTTP session, credentials,
+    limits, mirrors and optional libraries; raises ValueError for invalid options"""
+    global target_platforms, all_platforms, adaptive_concurrency, max_concurrent_downloads, chunk_size, connections_per_blob
+    global output_format, download_engine, limit_rate, use_cache, offline_mode, cache_max_size, cache_policy, cache_storage
+    global cache_zstd_level, session, username, password, registry_connection_limits, registry_mirrors, mirror_strategy
+    global rate_limiter, download_slots, read_chunk_size, inflate_backend, inflate, aiohttp, asyncio, zstandard
+    global metrics_json, metrics_prometheus, progress_mode, httpx
+    load_network_modules()
+    target_platforms = list(dict.fromkeys(p.strip() for p in options.platform.split(',') if p.strip())) if options.platform else []
+    all_platforms = options.all_platforms
+    adaptive_concurrency = options.max_concurrent_downloads == 'auto'
+    # In adaptive mode pools are sized for the ceiling, the controller decides how many streams run
+    max_concurrent_downloads = ADAPTIVE_MAX_CONCURRENCY if adaptive_concurrency else options.max_concurrent_downloads
+    chunk_size = options.chunk_size
+    connections_per_blob = options.connections_per_blob
+    output_format = options.format
+    download_engine = options.engine
+    limit_rate = options.limit_rate
+    metrics_json = options.metrics_json
+    metrics_prometheus = options.metrics_prometheus
+    progress_mode = options.progress
+
+    # Cache configuration
+    use_cache = not options.no_cache
+    offline_mode = options.offline
+    cache_max_size = options.cache_max_size
+    cache_policy = options.cache_policy
+    cache_storage = options.cache_storage
+    cache_zstd_level = options.cache_zstd_level
+    configure_cache_dir(options.cache_dir)
 
     # Create cache directories if caching is enabled
     if use_cache:
@@ -251,18 +1313,31 @@ if not args.import_tar:
     else:
         print("Layer caching disabled")
 
-    # Initialize progress tracking
-    progress_lock = threading.Lock()
-    download_progress = {}
-    cache_stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0}
-
-    # Initialize HTTP session
+    # Initialize HTTP session, pooled for every layer and range connection the run may open
     session = requests.Session()
     session.headers.update({'User-Agent': 'Docker-Pull-Script/1.0'})
+    session.hooks['response'].append(count_request)
+    pool_size = max(10, max_concurrent_downloads * max(1, connections_per_blob) + 4)
+    if options.http2:
+        # httpx is optional, only --http2 needs it (and h2 for the protocol itself, which httpx imports lazily)
+        try:
+            import httpx
+        except ImportError:
+            httpx = None
+        if httpx is None or importlib.util.find_spec('h2') is None:
+            raise ValueError("--http2 需要 httpx[http2]，请先安装: pip install 'httpx[http2]'")
+        adapter = Http2Adapter(pool_size)
+        for prefix in ('https://', 'http://'):
+            session.mount(prefix, adapter)
+    else:
+        for prefix in ('https://', 'http://'):
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            adapter.poolmanager.pool_classes_by_scheme = timed_pool_classes
+            session.mount(prefix, adapter)
 
     # Authentication configuration
-    username = args.username
-    password = args.password
+    username = options.username
+    password = options.password
 
     # Print authentication status
     if username and password:
@@ -272,7 +1347,87 @@ if not args.import_tar:
     else:
         print("Using anonymous access (no credentials provided)")
 
-    # Look for the Docker image to download
+    try:
+        registry_connection_limits = parse_registry_limits(options.max_connections_per_registry)
+    except ValueError:
+        raise ValueError(f"无效的 --max-connections-per-registry: {options.max_connections_per_registry}")
+    try:
+        registry_mirrors = parse_registry_mirrors(options.registry_mirror)
+    except ValueError:
+        raise ValueError(f"无效的 --registry-mirror: {', '.join(options.registry_mirror)}")
+    mirror_strategy = options.mirror_strategy
+    rate_limiter = TokenBucket(limit_rate) if limit_rate else None
+    download_slots = ConcurrencyController(ADAPTIVE_INITIAL_CONCURRENCY if adaptive_concurrency else max_concurrent_downloads,
+                                           max_concurrent_downloads, adaptive_concurrency)
+    # Smaller reads keep a throttled stream smooth instead of sleeping once per megabyte
+    read_chunk_size = max(16 * 1024, min(1024 * 1024, limit_rate // 8)) if limit_rate else 1024 * 1024
+
+    # The async engine is optional, only it needs aiohttp
+    if download_engine == 'async':
+        try:
+            import aiohttp
+        except ImportError:
+            raise ValueError("--engine async 需要 aiohttp，请先安装: pip install aiohttp")
+        import asyncio
+
+    # zstandard is optional: needed to write --cache-storage zstd entries, and to read them back
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+        if use_cache and cache_storage == 'zstd':
+            raise ValueError("--cache-storage zstd 需要 zstandard，请先安装: pip install zstandard")
+
+    # Faster gzip decompression when python-zlib-ng or python-isal is installed
+    inflate_backend, inflate = load_inflate_backend(options.inflate_backend)
+    if inflate_backend != 'zlib':
+        print(f"⚡ Using {inflate_backend} for gzip decompression")
+
+# Token endpoints of well-known registries; other registries are probed once per run
+registry_auth_endpoints = {
+    'registry-1.docker.io': {
+        'auth_url': 'https://auth.docker.io/token',
+        'service': 'registry.docker.io'
+    },
+    'gcr.io': {
+        'auth_url': 'https://gcr.io/v2/token',
+        'service': 'gcr.io'
+    },
+    'us.gcr.io': {
+        'auth_url': 'https://us.gcr.io/v2/token',
+        'service': 'us.gcr.io'
+    },
+    'eu.gcr.io': {
+        'auth_url': 'https://eu.gcr.io/v2/token',
+        'service': 'eu.gcr.io'
+    },
+    'asia.gcr.io': {
+        'auth_url': 'https://asia.gcr.io/v2/token',
+        'service': 'asia.gcr.io'
+    },
+    'quay.io': {
+        'auth_url': 'https://quay.io/v2/auth',
+        'service': 'quay.io'
+    },
+    'registry.cn-shanghai.aliyuncs.com': {
+        'auth_url': 'https://dockerauth.cn-hangzhou.aliyuncs.com/auth',
+        'service': 'registry.aliyuncs.com:cn-shanghai:26842'
+    },
+    'registry.cn-beijing.aliyuncs.com': {
+        'auth_url': 'https://registry.cn-beijing.aliyuncs.com/v2/token',
+        'service': 'registry.cn-beijing.aliyuncs.com'
+    },
+    'registry.cn-hangzhou.aliyuncs.com': {
+        'auth_url': 'https://dockerauth.cn-hangzhou.aliyuncs.com/auth',
+        'service': 'registry.aliyuncs.com:cn-hangzhou:26842'
+    }
+}
+
+registry_auth_cache = {}
+registry_auth_lock = threading.Lock()
+
+def parse_image_reference(image_arg: str) -> Dict[str, str]:
+    """Split [registry/][repository/]image[:tag|@digest] into registry, repo, img, tag and repository"""
     repo = 'library'
     tag = 'latest'
     imgparts = image_arg.split('/')
@@ -293,91 +1448,67 @@ if not args.import_tar:
             repo = '/'.join(imgparts[:-1])
         else:
             repo = 'library'
-    repository = '{}/{}'.format(repo, img)
-
-    # Get Docker authentication endpoint when it is required
-    auth_url='https://auth.docker.io/token'
-    reg_service='registry.docker.io'
-
-    # Handle authentication for different registry types
-    registry_auth_endpoints = {
-        'registry-1.docker.io': {
-            'auth_url': 'https://auth.docker.io/token',
-            'service': 'registry.docker.io'
-        },
-        'gcr.io': {
-            'auth_url': 'https://gcr.io/v2/token',
-            'service': 'gcr.io'
-        },
-        'us.gcr.io': {
-            'auth_url': 'https://us.gcr.io/v2/token',
-            'service': 'us.gcr.io'
-        },
-        'eu.gcr.io': {
-            'auth_url': 'https://eu.gcr.io/v2/token',
-            'service': 'eu.gcr.io'
-        },
-        'asia.gcr.io': {
-            'auth_url': 'https://asia.gcr.io/v2/token',
-            'service': 'asia.gcr.io'
-        },
-        'quay.io': {
-            'auth_url': 'https://quay.io/v2/auth',
-            'service': 'quay.io'
-        },
-        'registry.cn-shanghai.aliyuncs.com': {
-            'auth_url': 'https://dockerauth.cn-hangzhou.aliyuncs.com/auth',
-            'service': 'registry.aliyuncs.com:cn-shanghai:26842'
-        },
-        'registry.cn-beijing.aliyuncs.com': {
-            'auth_url': 'https://registry.cn-beijing.aliyuncs.com/v2/token',
-            'service': 'registry.cn-beijing.aliyuncs.com'
-        },
-        'registry.cn-hangzhou.aliyuncs.com': {
-            'auth_url': 'https://dockerauth.cn-hangzhou.aliyuncs.com/auth',
-            'service': 'registry.aliyuncs.com:cn-hangzhou:26842'
-        }
-    }
+    return {'image': image_arg, 'registry': registry, 'repo': repo, 'img': img, 'tag': tag,
+            'repository': '{}/{}'.format(repo, img)}
 
-    # Check if we have a known registry
-    if registry in registry_auth_endpoints:
-        auth_url = registry_auth_endpoints[registry]['auth_url']
-        reg_service = registry_auth_endpoints[registry]['service']
-    else:
-        # For private registries, don't probe for authentication unless necessary
-        # Only probe if we don't have credentials
-        if not (username and password):
-            try:
-                # Probe for authentication endpoint
-                resp = requests.get(f'https://{registry}/v2/', verify=False, timeout=10)
-                if resp.status_code == 401:
-                    www_auth = resp.headers.get('WWW-Authenticate', '')
-                    if 'Bearer' in www_auth:
-                        # Parse WWW-Authenticate header for token endpoint
-                        try:
-                            # Handle different formats of WWW-Authenticate header
-                            if 'realm=' in www_auth:
-                                realm_start = www_auth.find('realm="') + 7
-                                realm_end = www_auth.find('"', realm_start)
-                                auth_url = www_auth[realm_start:realm_end]
+def resolve_registry_auth(registry: str, scheme: str = 'https', anonymous: bool = False):
+    """Return (auth_url, reg_service) for a registry, probing its /v2/ endpoint at most once per run;
+    anonymous registries (mirrors, and when serving the registries besides --upstream, which never get the
+    credentials) are probed even with --username"""
+    with registry_auth_lock:
+        if registry in registry_auth_cache:
+            return registry_auth_cache[registry]
+
+        # Get Docker authentication endpoint when it is required
+        auth_url='https://auth.docker.io/token'
+        reg_service='registry.docker.io'
+        if anonymous:
+            # A mirror only uses token auth if its own /v2/ asks for it
+            auth_url = reg_service = None
+
+        # Check if we have a known registry
+        if registry in registry_auth_endpoints:
+            auth_url = registry_auth_endpoints[registry]['auth_url']
+            reg_service = registry_auth_endpoints[registry]['service']
+        else:
+            # For private registries, don't probe for authentication unless necessary
+            # Only probe if we don't have credentials
+            if (anonymous or not (username and password)) and not offline_mode:
+                try:
+                    # Probe for authentication endpoint
+                    with timed_phase('auth'):
+                        resp = session.get(f'{scheme}://{registry}/v2/', verify=False, timeout=10)
+                    if resp.status_code == 401:
+                        www_auth = resp.headers.get('WWW-Authenticate', '')
+                        if 'Bearer' in www_auth:
+                            # Parse WWW-Authenticate header for token endpoint
+                            try:
+                                # Handle different formats of WWW-Authenticate header
+                                if 'realm=' in www_auth:
+                                    realm_start = www_auth.find('realm="') + 7
+                                    realm_end = www_auth.find('"', realm_start)
+                                    auth_url = www_auth[realm_start:realm_end]
                                 
-                            if 'service=' in www_auth:
-                                service_start = www_auth.find('service="') + 9
-                                service_end = www_auth.find('"', service_start)
-                                if service_start > 8:  # Check if service= was found
-                                    reg_service = www_auth[service_start:service_end]
-                        except (IndexError, ValueError):
-                            # Fallback to registry-specific defaults
-                            pass
-                    elif 'Basic' in www_auth:
-                        # Registry uses basic authentication
-                        print(f"Registry {registry} uses basic authentication")
-                elif resp.status_code == 200:
-                    # Registry allows anonymous access
-                    print(f"Registry {registry} allows anonymous access")
-            except Exception as e:
-                print(f"Warning: Could not probe registry {registry}: {e}")
-                # Continue with basic authentication if credentials are provided
+                                if 'service=' in www_auth:
+                                    service_start = www_auth.find('service="') + 9
+                                    service_end = www_auth.find('"', service_start)
+                                    if service_start > 8:  # Check if service= was found
+                                        reg_service = www_auth[service_start:service_end]
+                            except (IndexError, ValueError):
+                                # Fallback to registry-specific defaults
+                                pass
+                        elif 'Basic' in www_auth:
+                            # Registry uses basic authentication
+                            print(f"Registry {registry} uses basic authentication")
+                    elif resp.status_code == 200:
+                        # Registry allows anonymous access
+                        print(f"Registry {registry} allows anonymous access")
+                except Exception as e:
+                    print(f"Warning: Could not probe registry {registry}: {e}")
+                    # Continue with basic authentication if credentials are provided
+
+        registry_auth_cache[registry] = (auth_url, reg_service)
+        return auth_url, reg_service
 
 def format_speed(bytes_downloaded):
     """Format download speed in human-readable format"""
@@ -404,78 +1535,1304 @@ def get_layer_cache_path(layer_digest: str) -> Path:
     """Get the cache path for a layer based on its digest"""
     return layers_cache_dir / layer_digest.replace(':', '_')
 
-def check_layer_cache(layer_digest: str) -> Optional[Path]:
-    """Check if a layer exists in cache and is valid"""
+# Cache index: maps every known digest of a layer (compressed blob digest and uncompressed
+# diff_id) to the cache entry holding its layer.tar, so pulls hit layers imported from tars.
+# It also records size, last access and hit count of every layer and blob for eviction.
+cache_index_lock = threading.Lock()
+cache_index = None
+
+@contextmanager
+def cache_lock():
+    """Exclusive lock on the cache index, held across every process sharing the cache directory"""
+    with cache_index_lock:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        fd = os.open(cache_dir / 'index.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            os.close(fd)
+
+def write_cache_index(index: Dict[str, Any]):
+    """Replace index.json atomically (caller holds cache_lock)"""
+    global cache_index
+    tmp_path = cache_dir / f'index.json.{unique_tmp_suffix()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, cache_dir / 'index.json')
+    cache_index = index
+
+def load_cache_index() -> Dict[str, Any]:
+    """Read the cache index from disk"""
+    try:
+        with open(cache_dir / 'index.json', 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    index.setdefault('layers', {})
+    index.setdefault('aliases', {})
+    index.setdefault('blobs', {})
+    return index
+
+def update_cache_index(cache_key: str, blob_digest: Optional[str] = None, diff_id: Optional[str] = None, size: Optional[int] = None):
+    """Record a cache entry and the digests that resolve to it"""
+    with cache_lock():
+        # Re-read so entries written by other runs are not lost
+        index = load_cache_index()
+        now = time.time()
+        entry = index['layers'].setdefault(cache_key, {'cached_at': now, 'last_access': now, 'hits': 0})
+        for key, value in (('blob_digest', blob_digest), ('diff_id', diff_id), ('size', size)):
+            if value is not None:
+                entry[key] = value
+        for digest in (blob_digest, diff_id):
+            if digest and digest != cache_key:
+                index['aliases'][digest] = cache_key
+        write_cache_index(index)
+
+def lookup_cache_alias(digest: str) -> Optional[str]:
+    """Return the cache key another digest of the same layer is stored under"""
+    global cache_index
+    with cache_index_lock:
+        if cache_index is None:
+            cache_index = load_cache_index()
+        return cache_index['aliases'].get(digest)
+
+def check_layer_cache(layer_digest: str, diff_id: Optional[str] = None) -> Optional[Path]:
+    """Check if a layer exists in cache under its blob digest or diff_id and is valid"""
     if not use_cache:
         return None
     
-    cache_path = get_layer_cache_path(layer_digest)
-    layer_file = cache_path / 'layer.tar'
-    
-    if layer_file.exists():
-        # Update access time for LRU
-        cache_path.touch()
-        return cache_path
+    candidates = [layer_digest, diff_id, lookup_cache_alias(layer_digest)]
+    if diff_id:
+        candidates.append(lookup_cache_alias(diff_id))
+    for cache_key in candidates:
+        if not cache_key:
+            continue
+        cache_path = get_layer_cache_path(cache_key)
+        
+        if cached_layer_file(cache_path):
+            # Update access time for LRU, the mtime also protects the entry from a concurrent gc
+            cache_path.touch()
+            record_cache_access('layers', cache_key)
+            if diff_id and cache_key == diff_id != layer_digest and lookup_cache_alias(layer_digest) != cache_key:
+                # Found an imported layer by diff_id, remember its blob digest for direct lookups
+                update_cache_index(cache_key, blob_digest=layer_digest, diff_id=diff_id)
+            return cache_path
+    return None
+
+def cached_layer_file(cache_path: Path) -> Optional[Path]:
+    """Return the layer.tar (or layer.tar.zst) of a cache entry, None if the entry is incomplete"""
+    for name in ('layer.tar', ZSTD_LAYER_NAME):
+        if (cache_path / name).exists():
+            return cache_path / name
     return None
 
-def save_layer_to_cache(layer_digest: str, layer_tar_path: str) -> bool:
-    """Save a downloaded layer to cache"""
+def save_layer_to_cache(layer_digest: str, layer_tar_path: str, diff_id: Optional[str] = None, zstd_level: Optional[int] = None) -> bool:
+    """Save a downloaded (or imported, when layer_digest is the diff_id) layer to cache, zstd compressed if zstd_level is given"""
     if not use_cache:
         return False
     
     try:
         cache_path = get_layer_cache_path(layer_digest)
-        cache_path.mkdir(parents=True, exist_ok=True)
-        
-        # Create hard link to save space
-        cache_layer_file = cache_path / 'layer.tar'
-        if not cache_layer_file.exists():
-            os.link(layer_tar_path, cache_layer_file)
-        
-        # Save metadata
-        metadata = {
-            'digest': layer_digest,
-            'size': os.path.getsize(layer_tar_path),
-            'cached_at': time.time()
-        }
-        with open(cache_path / 'metadata.json', 'w') as f:
-            json.dump(metadata, f)
+        tar_size = size = os.path.getsize(layer_tar_path)
+        existing = cached_layer_file(cache_path)
+        if existing:
+            size = existing.stat().st_size
+        else:
+            # Build the entry under a temporary name and rename it into place, so other processes
+            # sharing the cache either see no entry or a complete one
+            tmp_path = cache_path.with_name(f'.tmp-{cache_path.name}.{unique_tmp_suffix()}')
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            tmp_path.mkdir(parents=True)
+            
+            if zstd_level is None:
+                # Create hard link to save space
+                os.link(layer_tar_path, tmp_path / 'layer.tar')
+            else:
+                compress_layer_zstd(layer_tar_path, tmp_path / ZSTD_LAYER_NAME, zstd_level)
+                size = (tmp_path / ZSTD_LAYER_NAME).stat().st_size
+            
+            # Save metadata (size is what the entry takes on disk)
+            metadata = {
+                'digest': layer_digest,
+                'size': size,
+                'tar_size': tar_size,
+                'cached_at': time.time()
+            }
+            if diff_id:
+                metadata['diff_id'] = diff_id
+            with open(tmp_path / 'metadata.json', 'w') as f:
+                json.dump(metadata, f)
+            
+            if cache_path.exists() and not cached_layer_file(cache_path):
+                # Half-written entry of an older version
+                shutil.rmtree(cache_path, ignore_errors=True)
+            try:
+                os.rename(tmp_path, cache_path)
+            except OSError:
+                # Another process published it first
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                if not cached_layer_file(cache_path):
+                    raise
         
+        blob_digest = layer_digest if layer_digest != diff_id else None
+        update_cache_index(layer_digest, blob_digest=blob_digest, diff_id=diff_id, size=size)
         return True
     except Exception as e:
         print(f"Warning: Failed to cache layer {layer_digest[7:19]}: {e}")
         return False
 
-def use_cached_layer(cache_path: Path, target_dir: str, layer_digest: str) -> bool:
-    """Use a cached layer by creating hard link"""
-    try:
-        cached_layer = cache_path / 'layer.tar'
-        target_layer = target_dir + '/layer.tar'
-        
-        # Create hard link to reuse cached layer
-        os.link(cached_layer, target_layer)
-        
-        # Update cache stats
-        with progress_lock:
-            cache_stats['hits'] += 1
-            if (cache_path / 'metadata.json').exists():
-                with open(cache_path / 'metadata.json', 'r') as f:
-                    metadata = json.load(f)
-                    cache_stats['bytes_saved'] += metadata.get('size', 0)
-        
-        return True
-    except Exception as e:
-        print(f"Warning: Failed to use cached layer {layer_digest[7:19]}: {e}")
-        return False
+# Compressed blob cache: registry blobs stored as-is under blobs/sha256/<hex> (the OCI layout),
+# used by the OCI output formats and expanded locally when a docker-format pull misses layer.tar
+def get_blob_cache_path(blob_digest: str) -> Path:
+    """Get the cache path of a compressed layer blob"""
+    algorithm, _, hex_digest = blob_digest.partition(':')
+    return blobs_cache_dir / algorithm / hex_digest
 
-def calculate_layer_digest(layer_tar_path: str) -> str:
-    """Calculate SHA256 digest of a layer tar file"""
-    sha256_hash = hashlib.sha256()
+def check_blob_cache(blob_digest: str) -> Optional[Path]:
+    """Return the cached compressed blob for a digest, if present"""
+    if not use_cache:
+        return None
+    blob_file = get_blob_cache_path(blob_digest)
+    if blob_file.exists():
+        try:
+            os.utime(blob_file)
+        except OSError:
+            pass
+        record_cache_access('blobs', blob_digest)
+        return blob_file
+    return None
+
+def publish_blob(blob_digest: str, blob_path: Path, workdir: str, diff_id: Optional[str] = None, tar_size: Optional[int] = None) -> Path:
+    """Move a verified compressed blob into the blob cache (or the work directory with --no-cache)"""
+    if use_cache:
+        target = get_blob_cache_path(blob_digest)
+        target.parent.mkdir(parents=True, exist_ok=True)
+    else:
+        target = Path(workdir) / (blob_digest.replace(':', '_') + '.blob')
+    os.replace(blob_path, target)
+    if use_cache:
+        update_blob_index(blob_digest, target.stat().st_size, diff_id, tar_size)
+    return target
+
+def update_blob_index(blob_digest: str, size: int, diff_id: Optional[str] = None, tar_size: Optional[int] = None):
+    """Record a compressed blob in the cache index, with the diff_id and size of its layer.tar when known"""
+    with cache_lock():
+        index = load_cache_index()
+        now = time.time()
+        entry = index['blobs'].setdefault(blob_digest, {'cached_at': now, 'last_access': now, 'hits': 0})
+        for key, value in (('size', size), ('diff_id', diff_id), ('tar_size', tar_size)):
+            if value is not None:
+                entry[key] = value
+        write_cache_index(index)
+
+def lookup_blob_entry(blob_digest: str) -> Dict[str, Any]:
+    """Return the index entry of a cached blob, re-reading the index if it lacks the layer.tar size"""
+    global cache_index
+    with cache_index_lock:
+        if cache_index is None:
+            cache_index = load_cache_index()
+        entry = cache_index['blobs'].get(blob_digest, {})
+        if 'tar_size' not in entry:
+            # Another process may have measured it since we loaded the index
+            entry = load_cache_index()['blobs'].get(blob_digest, {})
+        return dict(entry)
+
+# Compressed-at-rest storage (--cache-storage blob|zstd): a layer is kept as the registry's blob or as
+# layers/<key>/layer.tar.zst instead of layer.tar, and only expanded while it is copied into the output
+# archive. The tar header needs the uncompressed size up front, so it is recorded as tar_size in the
+# index (blobs) or metadata.json (zstd entries).
+ZSTD_LAYER_NAME = 'layer.tar.zst'
+
+def compress_layer_zstd(layer_tar_path: str, target_path: Path, level: int):
+    """Compress a layer.tar with zstd, on every core"""
+    compressor = zstandard.ZstdCompressor(level=level, threads=-1)
+    with open(layer_tar_path, 'rb') as src, open(target_path, 'wb') as dst:
+        compressor.copy_stream(src, dst, size=os.path.getsize(layer_tar_path))
+
+class NullWriter:
+    def write(self, data):
+        return len(data)
+
+def measure_blob(blob_digest: str, blob_path: Path):
+    """Verify a cached blob and return (diff_id, tar_size) of the layer.tar it expands to, without writing it"""
+    stream = LayerStream(NullWriter())
+    with open(blob_path, 'rb') as blob_file:
+        for chunk in iter(lambda: blob_file.read(1024*1024), b''):
+            stream.feed(chunk)
+    actual_digest, diff_id = stream.finish()
+    verify_blob_digest(blob_digest, actual_digest)
+    return diff_id, stream.tar_size
+
+class CorruptLayerError(IOError):
+    pass
+
+class CompressedLayer(os.PathLike):
+    """A layer cached compressed (gzip blob or layer.tar.zst); expanded and verified while the archive is written"""
+
+    def __init__(self, path: Path, tar_size: int, diff_id: Optional[str] = None):
+        self.path = Path(path)
+        self.tar_size = tar_size
+        self.diff_id = diff_id
+
+    def __fspath__(self):
+        return str(self.path)
+
+    def chunks(self):
+        """Yield the uncompressed layer.tar; a corrupt entry is removed from the cache and raises IOError"""
+        decode_errors = (CorruptLayerError, zlib.error, RetryError) + ((zstandard.ZstdError,) if zstandard else ())
+        try:
+            yield from self._expand()
+        except decode_errors as e:
+            if self.path.name == ZSTD_LAYER_NAME:
+                shutil.rmtree(self.path.parent, ignore_errors=True)
+            else:
+                self.path.unlink()
+            raise IOError(f'Cached layer {self.path} is corrupt ({e}) and was removed, run again to download it')
+
+    def _expand(self):
+        produced = 0
+        with open(self.path, 'rb') as f:
+            if self.path.name == ZSTD_LAYER_NAME:
+                diff_hash = hashlib.sha256()
+                reader = zstandard.ZstdDecompressor().stream_reader(f)
+                for chunk in iter(lambda: reader.read(DECOMPRESS_CHUNK), b''):
+                    diff_hash.update(chunk)
+                    produced += len(chunk)
+                    self._check_size(produced)
+                    yield chunk
+                diff_id = 'sha256:' + diff_hash.hexdigest()
+            else:
+                buffer = BytesIO()
+                stream = LayerStream(buffer)
+                for chunk in iter(lambda: f.read(1024*1024), b''):
+                    stream.feed(chunk)
+                    produced += buffer.tell()
+                    self._check_size(produced)
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+                blob_digest, diff_id = stream.finish()
+                produced += buffer.tell()
+                self._check_size(produced)
+                yield buffer.getvalue()
+                if blob_digest != 'sha256:' + self.path.name:
+                    raise CorruptLayerError('blob digest mismatch')
+        if produced != self.tar_size:
+            raise CorruptLayerError(f'expanded to {produced} bytes, expected {self.tar_size}')
+        if self.diff_id and diff_id != self.diff_id:
+            raise CorruptLayerError('diff_id mismatch')
+
+    def _check_size(self, produced):
+        if produced > self.tar_size:
+            raise CorruptLayerError(f'expands beyond {self.tar_size} bytes')
+
+# Shared cache coordination: several processes (possibly on several hosts over NFS) may pull into one
+# cache directory. Whoever creates locks/<digest>.lock downloads that layer, the others wait and then
+# hit the published entry. Lock files are created with O_CREAT|O_EXCL, which unlike flock is atomic on
+# NFS too, and record their owner. A heartbeat keeps their mtime fresh, so the lock of a writer that
+# crashed (or whose host died) is broken once its process is gone or its mtime is CACHE_LOCK_STALE old.
+CACHE_LOCK_HEARTBEAT = 10
+CACHE_LOCK_STALE = 120
+CACHE_LOCK_POLL = 0.5
+CACHE_HOST = socket.gethostname()
+held_cache_locks = set()
+held_cache_locks_lock = threading.Lock()
+cache_heartbeat_thread = None
+
+def unique_tmp_suffix() -> str:
+    """Suffix for temporary names that can't collide between threads, processes and hosts"""
+    return f'{CACHE_HOST}.{os.getpid()}.{threading.get_ident()}'
+
+def get_cache_lock_path(digest: str) -> Path:
+    return cache_dir / 'locks' / (digest.replace(':', '_') + '.lock')
+
+def read_cache_lock_owner(path: Path) -> Dict[str, Any]:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def process_alive(pid: int) -> bool:
+    if os.name == 'nt':
+        return True  # os.kill(pid, 0) would terminate it on Windows: rely on the lock mtime
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def cache_lock_stale(path: Path, now: Optional[float] = None) -> bool:
+    """True if the writer holding a lock file crashed: its process is gone or it stopped heartbeating"""
+    try:
+        mtime = path.stat().st_mtime
+    except OSError:
+        return False
+    owner = read_cache_lock_owner(path)
+    pid = owner.get('pid')
+    if owner.get('host') == CACHE_HOST and pid and pid != os.getpid() and not process_alive(pid):
+        return True
+    return (now or time.time()) - mtime > CACHE_LOCK_STALE
+
+def break_stale_cache_lock(path: Path, digest: str) -> bool:
+    """Remove the lock of a crashed writer and what it left half-published; False if someone beat us to it"""
+    stale_path = path.with_name(f'{path.name}.{unique_tmp_suffix()}.stale')
+    try:
+        os.rename(path, stale_path)
+    except OSError:
+        return False
+    owner = read_cache_lock_owner(stale_path)
+    if not cache_lock_stale(stale_path):
+        # The lock was released and taken again between our check and the rename: put it back
+        try:
+            os.link(stale_path, path)
+        except OSError:
+            pass
+        os.remove(stale_path)
+        return False
+    os.remove(stale_path)
+    for tmp_dir in layers_cache_dir.glob(f".tmp-{digest.replace(':', '_')}.*"):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    with progress_lock:
+        print(f"🧹 {digest[7:19]}: Removed the lock of a crashed writer ({owner.get('host', '?')}:{owner.get('pid', '?')})")
+    return True
+
+def cache_lock_heartbeat():
+    while True:
+        time.sleep(CACHE_LOCK_HEARTBEAT)
+        with held_cache_locks_lock:
+            paths = list(held_cache_locks)
+        for path in paths:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+class CacheDigestLock:
+    """Cross-process lock on one digest of the shared cache, for `with` and `async with` (a no-op with --no-cache)"""
+
+    def __init__(self, digest: str):
+        self.digest = digest
+        self.path = get_cache_lock_path(digest)
+        self.held = False
+
+    def try_acquire(self) -> bool:
+        global cache_heartbeat_thread
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            if cache_lock_stale(self.path):
+                break_stale_cache_lock(self.path, self.digest)
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'host': CACHE_HOST, 'pid': os.getpid(), 'digest': self.digest, 'since': time.time()}, f)
+        with held_cache_locks_lock:
+            held_cache_locks.add(self.path)
+            if cache_heartbeat_thread is None:
+                cache_heartbeat_thread = threading.Thread(target=cache_lock_heartbeat, daemon=True)
+                cache_heartbeat_thread.start()
+        self.held = True
+        return True
+
+    def release(self):
+        if not self.held:
+            return
+        self.held = False
+        with held_cache_locks_lock:
+            held_cache_locks.discard(self.path)
+        # Only remove it if it is still ours, it may have been broken while we were stalled
+        owner = read_cache_lock_owner(self.path)
+        if owner.get('host') == CACHE_HOST and owner.get('pid') == os.getpid():
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def _waiting(self):
+        owner = read_cache_lock_owner(self.path)
+        with progress_lock:
+            print(f"{self.digest[7:19]}: Waiting for another process downloading it ({owner.get('host', '?')}:{owner.get('pid', '?')})")
+
+    def __enter__(self):
+        polls = 0
+        while use_cache and not self.try_acquire():
+            if shutdown_event.is_set():
+                raise KeyboardInterrupt("Download interrupted by user")
+            polls += 1
+            if polls == 2:
+                self._waiting()  # not for the brief lock of another process hitting the cache
+            time.sleep(CACHE_LOCK_POLL)
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    async def __aenter__(self):
+        polls = 0
+        while use_cache and not self.try_acquire():
+            if shutdown_event.is_set():
+                raise DownloadInterrupted("Download interrupted by user")
+            polls += 1
+            if polls == 2:
+                self._waiting()
+            await asyncio.sleep(CACHE_LOCK_POLL)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+def clean_stale_cache_writes(now: float, dry_run: bool = False) -> int:
+    """Remove locks and half-published layer directories left by crashed writers; returns how many"""
+    removed = 0
+    if layers_cache_dir.exists():
+        for tmp_dir in layers_cache_dir.glob('.tmp-*'):
+            # Publishing takes a moment, anything this old belongs to a crashed writer
+            if now - tmp_dir.stat().st_mtime > CACHE_STALE_WRITE_AGE:
+                removed += 1
+                if not dry_run:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+    locks_dir = cache_dir / 'locks'
+    if locks_dir.exists():
+        for path in locks_dir.iterdir():
+            if path.suffix == '.lock' and cache_lock_stale(path, now):
+                removed += 1
+                if not dry_run:
+                    break_stale_cache_lock(path, path.stem.replace('_', ':', 1))
+            elif path.suffix == '.stale' and now - path.stat().st_mtime > CACHE_LOCK_STALE:
+                removed += 1
+                if not dry_run:
+                    path.unlink()
+    return removed
+
+# Cache eviction (--cache-max-size, `cache gc`): driven by index.json, the directories are only scanned
+# once to index a cache written by an older version (or on `cache gc --rescan`). Hits are counted in
+# memory and merged into the index at the end of a run. Entries whose digest lock is held (being downloaded
+# or published) or used within CACHE_EVICT_MIN_IDLE (index last_access or file mtime, which every lookup
+# bumps) are never evicted, so a concurrent pull can't lose a layer it is about to write into its archive.
+CACHE_EVICT_MIN_IDLE = 600
+CACHE_STALE_WRITE_AGE = 3600
+PARTIAL_MAX_AGE = 7 * 24 * 3600
+pending_cache_access = {}
+pending_cache_access_lock = threading.Lock()
+
+def record_cache_access(kind: str, key: str):
+    """Remember a cache hit, merged into the index by flush_cache_access"""
+    with pending_cache_access_lock:
+        hits, _ = pending_cache_access.get((kind, key), (0, 0))
+        pending_cache_access[(kind, key)] = (hits + 1, time.time())
+
+def flush_cache_access():
+    """Merge the hits of this run into the index with a single write"""
+    with pending_cache_access_lock:
+        pending = dict(pending_cache_access)
+        pending_cache_access.clear()
+    if not pending:
+        return
+    with cache_lock():
+        index = load_cache_index()
+        for (kind, key), (hits, last_access) in pending.items():
+            entry = index[kind].get(key)
+            if entry is not None:
+                entry['hits'] = entry.get('hits', 0) + hits
+                entry['last_access'] = max(entry.get('last_access', 0), last_access)
+        write_cache_index(index)
+
+def cache_entry_path(kind: str, key: str) -> Path:
+    return get_layer_cache_path(key) if kind == 'layers' else get_blob_cache_path(key)
+
+def rescan_cache_index(index: Dict[str, Any]):
+    """Add layers and blobs missing from the index (caller holds cache_lock)"""
+    added = 0
+    if layers_cache_dir.exists():
+        for entry_dir in layers_cache_dir.iterdir():
+            if entry_dir.name.startswith('.'):
+                continue  # being published
+            key = entry_dir.name.replace('_', ':', 1)
+            layer_file = cached_layer_file(entry_dir)
+            if key in index['layers'] or not layer_file:
+                continue
+            try:
+                with open(entry_dir / 'metadata.json', 'r') as f:
+                    metadata = json.load(f)
+            except (OSError, ValueError):
+                metadata = {}
+            stat = layer_file.stat()
+            cached_at = metadata.get('cached_at', stat.st_mtime)
+            index['layers'][key] = {'cached_at': cached_at, 'last_access': entry_dir.stat().st_mtime,
+                                    'hits': 0, 'size': metadata.get('size', stat.st_size)}
+            if metadata.get('diff_id') and metadata['diff_id'] != key:
+                index['layers'][key]['diff_id'] = metadata['diff_id']
+                index['aliases'][metadata['diff_id']] = key
+            added += 1
+    sha256_dir = blobs_cache_dir / 'sha256'
+    if sha256_dir.exists():
+        for blob_file in sha256_dir.iterdir():
+            key = 'sha256:' + blob_file.name
+            if key in index['blobs'] or len(blob_file.name) != 64:
+                continue
+            stat = blob_file.stat()
+            index['blobs'][key] = {'cached_at': stat.st_mtime, 'last_access': stat.st_mtime, 'hits': 0, 'size': stat.st_size}
+            added += 1
+    index['scanned'] = True
+    return added
+
+def remove_cache_entry(index: Dict[str, Any], kind: str, key: str):
+    """Delete a layer or blob and its index entries (caller holds cache_lock)"""
+    path = cache_entry_path(kind, key)
+    if kind == 'layers':
+        shutil.rmtree(path, ignore_errors=True)
+    elif path.exists():
+        path.unlink()
+    index[kind].pop(key, None)
+    if kind == 'layers':
+        for alias in [alias for alias, target in index['aliases'].items() if target == key]:
+            del index['aliases'][alias]
+
+def cache_entry_idle(kind: str, key: str, entry: Dict[str, Any], now: float, aliases: Dict[str, str]) -> bool:
+    """True if no pull is using the entry: no live digest lock on it, and not used in the last few minutes
+    (judged by the index and the on-disk mtime)"""
+    if now - entry.get('last_access', entry.get('cached_at', 0)) < CACHE_EVICT_MIN_IDLE:
+        return False
+    for digest in [key] + [alias for alias, target in aliases.items() if target == key]:
+        lock_path = get_cache_lock_path(digest)
+        if lock_path.exists() and not cache_lock_stale(lock_path, now):
+            return False
+    try:
+        return now - cache_entry_path(kind, key).stat().st_mtime >= CACHE_EVICT_MIN_IDLE
+    except OSError:
+        return True
+
+def collect_cache_garbage(max_size: int = 0, policy: str = 'lru', dry_run: bool = False, rescan: bool = False) -> Dict[str, Any]:
+    """Drop dangling index entries and stale partial downloads, then evict layers and blobs until the cache
+    fits max_size; returns what was (or with dry_run would be) removed"""
+    result = {'evicted': [], 'freed': 0, 'dangling': 0, 'partials': 0, 'stale_writes': 0, 'skipped_recent': 0}
+    with cache_lock():
+        index = load_cache_index()
+        if rescan or not index.get('scanned'):
+            rescan_cache_index(index)
+        now = time.time()
+
+        # Entries whose files were removed by hand
+        for kind in ('layers', 'blobs'):
+            for key in list(index[kind]):
+                if not cache_entry_path(kind, key).exists():
+                    result['dangling'] += 1
+                    if not dry_run:
+                        remove_cache_entry(index, kind, key)
+
+        total = sum(entry.get('size', 0) for kind in ('layers', 'blobs') for entry in index[kind].values())
+        if max_size and total > max_size:
+            if policy == 'lfu':
+                order = lambda item: (item[2].get('hits', 0), item[2].get('last_access', 0))
+            else:
+                order = lambda item: item[2].get('last_access', item[2].get('cached_at', 0))
+            candidates = sorted(((kind, key, entry) for kind in ('layers', 'blobs') for key, entry in index[kind].items()), key=order)
+            for kind, key, entry in candidates:
+                if total <= max_size:
+                    break
+                if not cache_entry_idle(kind, key, entry, now, index['aliases'] if kind == 'layers' else {}):
+                    result['skipped_recent'] += 1
+                    continue
+                size = entry.get('size', 0)
+                if not dry_run:
+                    remove_cache_entry(index, kind, key)
+                result['evicted'].append((kind, key, size))
+                result['freed'] += size
+                total -= size
+        result['total'] = total
+
+        # Partial downloads nobody resumed for a week
+        if partial_cache_dir.exists():
+            for partial in partial_cache_dir.iterdir():
+                try:
+                    if now - partial.stat().st_mtime > PARTIAL_MAX_AGE:
+                        result['partials'] += 1
+                        if not dry_run:
+                            partial.unlink()
+                except OSError:
+                    pass
+        result['stale_writes'] = clean_stale_cache_writes(now, dry_run)
+
+        if not dry_run:
+            write_cache_index(index)
+    return result
+
+def format_cache_age(timestamp: float) -> str:
+    return format_time(max(0, time.time() - timestamp)) + ' ago' if timestamp else 'never'
+
+def run_cache_command(args) -> int:
+    """Run `docker_pull.py cache gc|ls|stats`; returns the exit code"""
+    if not cache_dir.exists():
+        print(f"Cache directory not found: {cache_dir}")
+        return 1
+
+    if args.cache_command == 'gc':
+        result = collect_cache_garbage(args.max_size, args.policy, args.dry_run, args.rescan)
+        action = 'Would evict' if args.dry_run else 'Evicted'
+        for kind, key, size in result['evicted']:
+            print(f"   {action} {kind[:-1]} {key[7:19]} ({format_speed(size)})")
+        print(f"🧹 {action} {len(result['evicted'])} entries, {format_speed(result['freed'])} freed, "
+              f"cache now {format_speed(result['total'])}" + (f" (limit {format_speed(args.max_size)})" if args.max_size else ''))
+        if result['dangling'] or result['partials']:
+            print(f"   Removed {result['dangling']} dangling index entries and {result['partials']} stale partial files")
+        if result['stale_writes']:
+            print(f"   Removed {result['stale_writes']} locks and unfinished entries left by crashed writers")
+        if args.max_size and result['total'] > args.max_size:
+            print(f"⚠️  Still over the limit: {result['skipped_recent']} entries are in use or were used in the last {format_time(CACHE_EVICT_MIN_IDLE)}")
+        return 0
+
+    with cache_lock():
+        index = load_cache_index()
+        if not index.get('scanned'):
+            rescan_cache_index(index)
+            write_cache_index(index)
+    entries = [(kind, key, entry) for kind in ('layers', 'blobs') for key, entry in index[kind].items()]
+
+    if args.cache_command == 'ls':
+        sort_keys = {'access': lambda item: item[2].get('last_access', 0), 'size': lambda item: item[2].get('size', 0),
+                     'hits': lambda item: item[2].get('hits', 0)}
+        print(f"{'TYPE':<6} {'DIGEST':<14} {'SIZE':>10} {'HITS':>6}  {'LAST ACCESS':<14} {'CACHED':<14}")
+        for kind, key, entry in sorted(entries, key=sort_keys[args.sort], reverse=True):
+            print(f"{kind[:-1]:<6} {key[7:19]:<14} {format_speed(entry.get('size', 0)):>10} {entry.get('hits', 0):>6}  "
+                  f"{format_cache_age(entry.get('last_access', 0)):<14} {format_cache_age(entry.get('cached_at', 0)):<14}")
+        return 0
+
+    # stats
+    print(f"💾 Cache: {cache_dir}")
+    for kind in ('layers', 'blobs'):
+        sizes = [entry.get('size', 0) for entry in index[kind].values()]
+        hits = sum(entry.get('hits', 0) for entry in index[kind].values())
+        print(f"   {kind.capitalize()}: {len(sizes)} entries, {format_speed(sum(sizes))}, {hits} hits")
+    if entries:
+        print(f"   Total: {format_speed(sum(entry.get('size', 0) for _, _, entry in entries))}")
+        print(f"   Least recently used: {format_cache_age(min(entry.get('last_access', 0) for _, _, entry in entries))}")
+        never_hit = [entry for _, _, entry in entries if not entry.get('hits')]
+        print(f"   Never reused: {len(never_hit)} entries, {format_speed(sum(entry.get('size', 0) for entry in never_hit))}")
+    if partial_cache_dir.exists():
+        partials = [path.stat().st_size for path in partial_cache_dir.iterdir() if path.suffix == '.partial']
+        if partials:
+            print(f"   Partial downloads: {len(partials)}, {format_speed(sum(partials))}")
+    return 0
+
+# Manifest cache: manifests, indexes and config blobs are stored content-addressed under
+# manifests/sha256/<hex>; tags/<registry>/<repository>/<tag>.json remembers the last tag
+# resolution so tags can be revalidated with a HEAD (free against Docker Hub pull limits).
+manifest_stats = {'cache_hits': 0, 'revalidated': 0, 'fetched': 0}
+
+class CachedResponse:
+    """Minimal stand-in for requests.Response when content is served from the local cache"""
+
+    def __init__(self, content: bytes, status_code: int = 200):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.content)
+
+def get_manifest_blob_path(digest: str) -> Path:
+    """Get the content-addressed cache path of a manifest, index or config blob"""
+    algorithm, _, hex_digest = digest.partition(':')
+    return manifests_cache_dir / algorithm / hex_digest
+
+def get_tag_resolution_path(ref, reference: str) -> Path:
+    """Get the path recording which digest a tag resolved to"""
+    return manifests_cache_dir / 'tags' / ref['registry'].replace(':', '_') / ref['repository'] / (reference + '.json')
+
+def read_cached_manifest_blob(digest: str) -> Optional[bytes]:
+    """Return cached manifest/config bytes if present and matching their digest"""
+    if not use_cache or not digest.startswith('sha256:'):
+        return None
+    try:
+        content = get_manifest_blob_path(digest).read_bytes()
+    except OSError:
+        return None
+    if 'sha256:' + hashlib.sha256(content).hexdigest() != digest:
+        return None
+    return content
+
+def write_atomic(path: Path, data: bytes):
+    """Write a file via a temporary name and rename so readers never see partial content"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'{path.name}.{unique_tmp_suffix()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def store_manifest_blob(content: bytes) -> str:
+    """Store manifest/config bytes content-addressed and return their digest"""
+    digest = 'sha256:' + hashlib.sha256(content).hexdigest()
+    if use_cache:
+        path = get_manifest_blob_path(digest)
+        if not path.exists():
+            write_atomic(path, content)
+    return digest
+
+def fetch_manifest(ref, reference: str, type_var: str):
+    """Fetch a manifest by tag or digest, serving from the manifest cache when possible (registry mirrors first)"""
+    is_digest = reference.startswith('sha256:')
+
+    if is_digest:
+        # Content-addressed: a verified cached copy never needs a network call
+        content = read_cached_manifest_blob(reference)
+        if content is not None:
+            manifest_stats['cache_hits'] += 1
+            return CachedResponse(content)
+    elif use_cache:
+        tag_path = get_tag_resolution_path(ref, reference)
+        try:
+            with open(tag_path, 'r') as f:
+                known_digest = json.load(f)['digest']
+        except (OSError, ValueError, KeyError):
+            known_digest = None
+        content = read_cached_manifest_blob(known_digest) if known_digest else None
+        if content is not None:
+            if offline_mode:
+                print(f"Offline mode: using cached resolution {reference} -> {known_digest[7:19]}")
+                manifest_stats['cache_hits'] += 1
+                return CachedResponse(content)
+            try:
+                head = mirrored_request(ref, 'HEAD', 'manifests', reference, type_var, timeout=10)
+                if head.status_code == 200 and head.headers.get('Docker-Content-Digest') == known_digest:
+                    manifest_stats['cache_hits'] += 1
+                    manifest_stats['revalidated'] += 1
+                    return CachedResponse(content)
+            except requests.RequestException as e:
+                print(f"Warning: Could not revalidate {reference} ({e}), using cached manifest {known_digest[7:19]}")
+                manifest_stats['cache_hits'] += 1
+                return CachedResponse(content)
+
+    if offline_mode:
+        # Same semantics as an HTTP only-if-cached miss
+        return CachedResponse(f'Offline mode: manifest {reference} is not cached'.encode(), 504)
+
+    resp = mirrored_request(ref, 'GET', 'manifests', reference, type_var, verify_digest=is_digest, timeout=30)
+    if resp.status_code == 200:
+        manifest_stats['fetched'] += 1
+        if is_digest:
+            verify_blob_digest(reference, 'sha256:' + hashlib.sha256(resp.content).hexdigest())
+        if use_cache:
+            digest = store_manifest_blob(resp.content)
+            if not is_digest:
+                write_atomic(get_tag_resolution_path(ref, reference),
+                             json.dumps({'digest': digest, 'resolved_at': time.time()}).encode())
+    return resp
+
+def use_cached_layer(cache_path: Path, layer_digest: str) -> Optional[Path]:
+    """Use a cached layer in place; returns the layer.tar path the archive is written from"""
+    try:
+        cached_layer = cache_path / 'layer.tar'
+        if cached_layer.exists():
+            size = cached_layer.stat().st_size
+        else:
+            # Stored with --cache-storage zstd: expanded while the archive is written
+            if zstandard is None:
+                raise RuntimeError('stored zstd compressed, pip install zstandard')
+            with open(cache_path / 'metadata.json', 'r') as f:
+                metadata = json.load(f)
+            size = metadata['tar_size']
+            cached_layer = CompressedLayer(cache_path / ZSTD_LAYER_NAME, size, metadata.get('diff_id'))
+        
+        # Update cache stats
+        with progress_lock:
+            cache_stats['hits'] += 1
+            cache_stats['bytes_saved'] += size
+        
+        return cached_layer
+    except Exception as e:
+        print(f"Warning: Failed to use cached layer {layer_digest[7:19]}: {e}")
+        return None
+
+def calculate_layer_digest(layer_tar_path: str) -> str:
+    """Calculate SHA256 digest of a layer tar file"""
+    sha256_hash = hashlib.sha256()
     with open(layer_tar_path, 'rb') as f:
         for chunk in iter(lambda: f.read(8192), b""):
             sha256_hash.update(chunk)
     return f"sha256:{sha256_hash.hexdigest()}"
 
+class DigestMismatchError(RetryError):
+    pass
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+DECOMPRESS_CHUNK = 1024 * 1024
+
+class LayerStream:
+    """Single-pass layer pipeline: hash the blob, gunzip incrementally and hash the uncompressed layer.tar"""
+
+    def __init__(self, out_file, expand: bool = True):
+        self.out_file = out_file
+        self.expand = expand     # False: only hash the blob (OCI output keeps layers compressed)
+        self.blob_hash = hashlib.sha256()
+        self.diff_hash = hashlib.sha256()
+        self.compressed = None   # decided from the magic bytes of the first chunk
+        self.decompressor = None
+        self.pending = b''
+        self.blob_size = 0
+        self.tar_size = 0
+        self.busy = 0.0          # seconds spent hashing and decompressing
+
+    def _emit(self, data):
+        if data:
+            self.out_file.write(data)
+            self.diff_hash.update(data)
+            self.tar_size += len(data)
+
+    def _inflate(self, data):
+        while data:
+            if self.decompressor is None:
+                # Between gzip members: skip zero padding, then start the next member
+                data = data.lstrip(b'\0')
+                if not data:
+                    return
+                self.decompressor = inflate.decompressobj(wbits=31)
+            # Bound the output per call so highly compressible layers can't blow up memory
+            try:
+                self._emit(self.decompressor.decompress(data, DECOMPRESS_CHUNK))
+            except inflate.error as e:
+                raise zlib.error(str(e))  # same exception whatever the backend
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                self.decompressor = None
+            else:
+                data = self.decompressor.unconsumed_tail
+
+    def feed(self, chunk):
+        started = time.perf_counter()
+        try:
+            self._feed(chunk)
+        finally:
+            self.busy += time.perf_counter() - started
+
+    def _feed(self, chunk):
+        self.blob_hash.update(chunk)
+        self.blob_size += len(chunk)
+        if not self.expand:
+            return
+        if self.compressed is None:
+            # Wait until we can see the magic bytes
+            self.pending += chunk
+            if len(self.pending) < len(ZSTD_MAGIC):
+                return
+            chunk, self.pending = self.pending, b''
+            if chunk.startswith(ZSTD_MAGIC):
+                raise ValueError('zstd compressed layers are not supported')
+            self.compressed = chunk.startswith(GZIP_MAGIC)
+        if self.compressed:
+            self._inflate(chunk)
+        else:
+            self._emit(chunk)
+
+    def finish(self):
+        """Flush the pipeline and return (blob_digest, diff_id); diff_id is None when not expanding"""
+        started = time.perf_counter()
+        try:
+            return self._finish()
+        finally:
+            self.busy += time.perf_counter() - started
+
+    def _finish(self):
+        if not self.expand:
+            return 'sha256:' + self.blob_hash.hexdigest(), None
+        if self.pending:
+            chunk, self.pending = self.pending, b''
+            self.compressed = chunk.startswith(GZIP_MAGIC)
+            if self.compressed:
+                self._inflate(chunk)
+            else:
+                self._emit(chunk)
+        if self.decompressor is not None:
+            try:
+                self._emit(self.decompressor.flush())
+            except inflate.error as e:
+                raise zlib.error(str(e))
+            if not self.decompressor.eof:
+                raise RetryError('Truncated gzip stream')
+        return 'sha256:' + self.blob_hash.hexdigest(), 'sha256:' + self.diff_hash.hexdigest()
+
+def verify_blob_digest(expected_digest: str, actual_digest: str):
+    """Raise DigestMismatchError if a sha256 blob digest does not match the manifest"""
+    if expected_digest.startswith('sha256:') and expected_digest != actual_digest:
+        raise DigestMismatchError(f'Digest mismatch: expected {expected_digest[7:19]}, got {actual_digest[7:19]}')
+
+# Decompression off the network path: the thread engine hands chunks to an InflatePipeline thread, and
+# segmented downloads are expanded by a SegmentFollower as soon as a contiguous prefix is on disk, so
+# hashing and gunzip (which release the GIL) overlap with receiving data instead of following it.
+INFLATE_QUEUE_CHUNKS = 16
+
+class InflatePipeline:
+    """Feed a LayerStream from a background thread; feed() only blocks when the thread falls behind"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.queue = queue.Queue(INFLATE_QUEUE_CHUNKS)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if self.error is None:
+                try:
+                    self.stream.feed(chunk)
+                except BaseException as e:
+                    self.error = e  # keep draining so feed() never blocks on a dead thread
+
+    def feed(self, chunk):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(chunk)
+
+    def close(self) -> bool:
+        """Wait until every queued chunk is fed; False if feeding failed and the stream is unusable"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        return self.error is None
+
+    def finish(self):
+        if not self.close():
+            raise self.error
+        return self.stream.finish()
+
+class SegmentFollower:
+    """Hash and gunzip a segmented download in order while its later segments are still arriving"""
+
+    def __init__(self, blob_path, layer_tar_path, total_size: int):
+        self.layer_tar_path = layer_tar_path
+        self.total_size = total_size
+        self.blob_file = open(blob_path, 'rb')
+        self.tar_file = open(layer_tar_path, 'wb')
+        self.stream = LayerStream(self.tar_file)
+        self.available = 0
+        self.aborted = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def advance(self, available: int):
+        """Tell the follower that bytes [0, available) of the blob are on disk"""
+        with self.cond:
+            self.available = max(self.available, available)
+            self.cond.notify()
+
+    def _run(self):
+        position = 0
+        try:
+            while position < self.total_size:
+                with self.cond:
+                    while position >= self.available and not self.aborted:
+                        self.cond.wait()
+                    if self.aborted:
+                        return
+                    available = self.available
+                while position < available and not self.aborted:
+                    chunk = self.blob_file.read(min(1024*1024, available - position))
+                    if not chunk:
+                        raise IOError('Segmented blob is shorter than expected')
+                    self.stream.feed(chunk)
+                    position += len(chunk)
+        except BaseException as e:
+            self.error = e
+
+    def finish(self):
+        """Expand what is left once every segment is on disk; returns (blob_digest, diff_id)"""
+        self.advance(self.total_size)
+        self.thread.join()
+        try:
+            if self.error is not None:
+                raise self.error
+            return self.stream.finish()
+        finally:
+            self.blob_file.close()
+            self.tar_file.close()
+
+    def abort(self):
+        with self.cond:
+            self.aborted = True
+            self.cond.notify()
+        self.thread.join()
+        self.blob_file.close()
+        self.tar_file.close()
+        if os.path.exists(self.layer_tar_path):
+            os.remove(self.layer_tar_path)
+
+def expand_blob(blob_digest: str, blob_path, layer_tar_path) -> str:
+    """Verify a complete local blob and gunzip it to layer_tar_path in one pass; returns the diff_id"""
+    try:
+        with open(blob_path, 'rb') as blob_file, open(layer_tar_path, 'wb') as tar_file:
+            stream = LayerStream(tar_file)
+            for chunk in iter(lambda: blob_file.read(1024*1024), b''):
+                stream.feed(chunk)
+            actual_digest, diff_id = stream.finish()
+        verify_blob_digest(blob_digest, actual_digest)
+    except BaseException:
+        if os.path.exists(layer_tar_path):
+            os.remove(layer_tar_path)
+        raise
+    return diff_id
+
+# Resumable downloads: the compressed blob is kept as <digest>.partial next to a JSON
+# sidecar recording how many bytes are safely on disk. hashlib/zlib state can't be
+# serialized, so a later run replays the local prefix through LayerStream; retries
+# within the same run reuse the live pipeline from active_streams instead.
+PARTIAL_STATE_INTERVAL = 8 * 1024 * 1024  # persist the sidecar every 8MB
+active_streams = {}
+
+def get_partial_paths(layer_digest: str, workdir: str):
+    """Return (blob_path, state_path) for the partial download of a layer"""
+    base_dir = partial_cache_dir if use_cache else Path(workdir)
+    base_dir.mkdir(parents=True, exist_ok=True)
+    name = layer_digest.replace(':', '_')
+    return base_dir / (name + '.partial'), base_dir / (name + '.partial.json')
+
+def load_partial_offset(layer_digest: str, blob_path: Path, state_path: Path) -> int:
+    """Return how many bytes of a previous partial download can be reused"""
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        if state.get('digest') != layer_digest:
+            return 0
+        return min(int(state.get('bytes', 0)), blob_path.stat().st_size)
+    except (OSError, ValueError):
+        return 0
+
+def save_partial_state(layer_digest: str, blob_file, state_path: Path, url: str = None):
+    """Flush the partial blob and atomically record how many bytes it holds"""
+    blob_file.flush()
+    state = {'digest': layer_digest, 'bytes': blob_file.tell(), 'url': url, 'updated_at': time.time()}
+    tmp_path = state_path.with_name(state_path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+def discard_partial(blob_path: Path, state_path: Path):
+    """Remove a partial download and its sidecar"""
+    for path in (blob_path, state_path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def parse_content_range_start(content_range: Optional[str]) -> Optional[int]:
+    """Return the first byte position of a 'bytes start-end/total' Content-Range header"""
+    try:
+        return int(content_range.split()[1].split('-')[0])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+# When streaming the archive without the cache, let downloads run at most this many layers
+# (beyond the worker count) ahead of the archive writer to bound temporary disk usage
+STREAM_READAHEAD_LAYERS = 4
+
+# Segmented downloads: blobs larger than SEGMENTED_MIN_CHUNKS * chunk_size are fetched with
+# concurrent Range requests into a preallocated partial file, then hashed/gunzipped in one pass.
+SEGMENTED_MIN_CHUNKS = 2
+
+class RangeNotSupportedError(Exception):
+    pass
+
+pwrite_lock = threading.Lock()
+
+def write_at(fd: int, data, offset: int):
+    """Write data at an absolute file offset (os.pwrite where available)"""
+    view = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        # Windows has no pwrite, serialize seek+write instead
+        with pwrite_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+
+def load_segment_state(layer_digest: str, state_path: Path, total_size: int, segment_size: int) -> set:
+    """Return the start offsets of segments already downloaded by a previous attempt"""
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    if state.get('digest') != layer_digest:
+        return set()
+    if state.get('size') == total_size and state.get('segment_size') == segment_size:
+        return set(state.get('done', []))
+    # A streaming partial (or other segment size) still covers a contiguous prefix
+    prefix = int(state.get('bytes', 0))
+    return {start for start in range(0, total_size, segment_size) if min(start + segment_size, total_size) <= prefix}
+
+def segment_prefix(done: set, total_size: int, segment_size: int) -> int:
+    """Length of the run of completed segments at the start of a blob"""
+    prefix = 0
+    while prefix < total_size and prefix in done:
+        prefix = min(prefix + segment_size, total_size)
+    return prefix
+
+def save_segment_state(layer_digest: str, state_path: Path, total_size: int, segment_size: int, done: set):
+    """Atomically record which segments of a partial blob are complete"""
+    state = {'digest': layer_digest, 'bytes': segment_prefix(done, total_size, segment_size), 'size': total_size, 'segment_size': segment_size,
+             'done': sorted(done), 'updated_at': time.time()}
+    tmp_path = state_path.with_name(state_path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+def copy_file_body(src_fd: int, dst_fd: int, size: int):
+    """Copy size bytes from src_fd to dst_fd, in-kernel (copy_file_range/sendfile) where supported"""
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src_fd, dst_fd, size - offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            pass  # e.g. EXDEV on older kernels or a pipe as destination
+    if offset < size and hasattr(os, 'sendfile'):
+        try:
+            while offset < size:
+                sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError:
+            pass  # e.g. macOS only sends to sockets
+    while offset < size:
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        chunk = os.read(src_fd, min(1024*1024, size - offset))
+        if not chunk:
+            raise IOError('Source file shrank while writing the archive')
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        offset += len(chunk)
+
+class ImageArchiveWriter:
+    """Write a docker-save style tar directly from layer files and in-memory metadata, no staging directory"""
+
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.written = 0
+        self.names = set()
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+        self.written += len(data)
+
+    def _header(self, name, size, mode=0o644, type=tarfile.REGTYPE):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = mode
+        info.type = type
+        info.mtime = int(time.time())
+        self._write(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+
+    def _pad(self, size):
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            self._write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+    def add_dir(self, name):
+        if name not in self.names:
+            self.names.add(name)
+            self._header(name, 0, 0o755, tarfile.DIRTYPE)
+
+    def add_bytes(self, name, data: bytes):
+        if name not in self.names:
+            self.names.add(name)
+            self._header(name, len(data))
+            self._write(data)
+            self._pad(len(data))
+
+    def add_file(self, name, path):
+        if name in self.names:
+            return
+        self.names.add(name)
+        if isinstance(path, CompressedLayer):
+            self._header(name, path.tar_size)
+            for chunk in path.chunks():
+                self._write(chunk)
+            self._pad(path.tar_size)
+            return
+        src_fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            size = os.fstat(src_fd).st_size
+            self._header(name, size)
+            copy_file_body(src_fd, self.fd, size)
+            self.written += size
+            self._pad(size)
+        finally:
+            os.close(src_fd)
+
+    def add_layer(self, layer_id, layer_path):
+        """Add a layer in the legacy docker save layout: <id>/VERSION and <id>/layer.tar"""
+        self.add_dir(layer_id)
+        self.add_bytes(layer_id + '/VERSION', b'1.0')
+        self.add_file(layer_id + '/layer.tar', layer_path)
+
+    def close(self):
+        # End-of-archive marker, padded to a full record like tarfile does
+        self._write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        remainder = self.written % tarfile.RECORDSIZE
+        if remainder:
+            self._write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+
+class OCILayoutDirectoryWriter:
+    """Write an OCI image layout into a directory, same interface as ImageArchiveWriter"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.written = 0
+
+    def add_dir(self, name):
+        (self.path / name).mkdir(parents=True, exist_ok=True)
+
+    def add_bytes(self, name, data: bytes):
+        write_atomic(self.path / name, data)
+        self.written += len(data)
+
+    def add_file(self, name, path):
+        target = self.path / name
+        if target.exists():
+            return  # blobs are content-addressed, an existing one is identical
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = target.with_name(f'{target.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            # Hard link from the cache when possible, the blob is never modified
+            os.link(path, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, target)
+        self.written += target.stat().st_size
+
+    def close(self):
+        pass
+
 def import_docker_tar_to_cache(tar_file_path: str):
     """Import layers from a Docker tar file to cache"""
     print(f"🔄 开始导入Docker tar文件到缓存: {tar_file_path}")
@@ -525,7 +2882,14 @@ def import_docker_tar_to_cache(tar_file_path: str):
                 layers = image_manifest['Layers']
                 print(f"📦 发现 {len(layers)} 个层")
                 
-                for layer_path in layers:
+                # 从镜像配置读取diff_ids，导入的层按diff_id登记到缓存索引，拉取时可按diff_id命中
+                diff_ids = []
+                config_path = temp_dir / image_manifest.get('Config', '')
+                if image_manifest.get('Config') and config_path.is_file():
+                    with open(config_path, 'r') as f:
+                        diff_ids = json.load(f).get('rootfs', {}).get('diff_ids', [])
+                
+                for layer_index, layer_path in enumerate(layers):
                     full_layer_path = temp_dir / layer_path
                     if not full_layer_path.exists():
                         print(f"⚠️  警告: 层文件不存在 {layer_path}")
@@ -534,6 +2898,8 @@ def import_docker_tar_to_cache(tar_file_path: str):
                     # 计算层的digest
                     print(f"🔍 计算层digest: {layer_path}")
                     layer_digest = calculate_layer_digest(str(full_layer_path))
+                    if layer_index < len(diff_ids) and diff_ids[layer_index] != layer_digest:
+                        print(f"⚠️  警告: 层digest与镜像配置中的diff_id不一致 {layer_path}")
                     
                     # 检查是否已经在缓存中
                     if check_layer_cache(layer_digest):
@@ -543,7 +2909,7 @@ def import_docker_tar_to_cache(tar_file_path: str):
                     
                     # 导入到缓存
                     layer_size = full_layer_path.stat().st_size
-                    if save_layer_to_cache(layer_digest, str(full_layer_path)):
+                    if save_layer_to_cache(layer_digest, str(full_layer_path), diff_id=layer_digest):
                         print(f"✅ 成功导入层: {layer_digest[7:19]} ({format_speed(layer_size)})")
                         imported_count += 1
                         total_size += layer_size
@@ -572,200 +2938,1135 @@ def import_docker_tar_to_cache(tar_file_path: str):
     print(f"   📁 缓存位置: {layers_cache_dir}")
     print(f"\n🎉 Docker tar文件导入完成！")
 
-# 处理导入tar文件功能（在函数定义后立即处理）
-if args.import_tar:
-    import_docker_tar_to_cache(args.import_tar)
-    sys.exit(0)
-else:
-    # 只有在非导入模式下才定义和执行镜像下载相关的函数和逻辑
-    def progress_bar(ublob, downloaded, total, start_time):
-        """Enhanced progress bar with speed and ETA"""
-        if total and total > 0:
-            percentage = (downloaded / total) * 100
-            bar_length = 30
-            filled_length = int(bar_length * downloaded // total)
-            bar = '█' * filled_length + '-' * (bar_length - filled_length)
-            
-            elapsed = time.time() - start_time
-            speed = downloaded / elapsed if elapsed > 0 else 0
-            
-            if total > downloaded:
-                eta = (total - downloaded) / speed if speed > 0 else 0
-                eta_str = format_time(eta)
-            else:
-                eta_str = "0s"
-            
-            speed_str = format_speed(speed)
-            
-            sys.stdout.write(f'\r{ublob[7:19]}: |{bar}| {percentage:.1f}% ({speed_str}/s, ETA: {eta_str})')
-            sys.stdout.flush()
-        else:
-            # Unknown total size
-            speed = format_speed(downloaded / (time.time() - start_time))
-            sys.stdout.write(f'\r{ublob[7:19]}: Downloaded {format_speed(downloaded)} ({speed}/s)')
-            sys.stdout.flush()
-
-    @retry(max_attempts=3, delay=1.0, backoff=2.0)
-    def download_layer(layer, imgdir, parentid):
-        """Download a single layer in a separate thread with streaming and progress"""
-        # 检查是否收到中断信号
-        if shutdown_event.is_set():
-            raise KeyboardInterrupt("Download interrupted by user")
-        
-        ublob = layer['digest']
-        fake_layerid = hashlib.sha256((parentid+'\n'+ublob+'\n').encode('utf-8')).hexdigest()
-        layerdir = imgdir + '/' + fake_layerid
-        os.makedirs(layerdir, exist_ok=True)
+# Pulling: layer downloads (thread and async engines), image resolution and archive writing
+# Progress: download workers only store their byte counts in a LayerProgress (a plain attribute write, no lock),
+# and one renderer thread draws them at a fixed frame rate. On a terminal that is a dashboard of per-layer bars
+# plus the aggregate throughput and ETA, redrawn in place below the log lines; otherwise (CI logs, pipes) a
+# summary line every PROGRESS_LOG_INTERVAL seconds, or nothing with --progress none.
+PROGRESS_FRAME_INTERVAL = 0.2
+PROGRESS_LOG_INTERVAL = 10
+PROGRESS_MAX_BARS = 10
+PROGRESS_SPEED_WINDOW = 3.0   # seconds of history behind the aggregate speed
+progress_mode = 'auto'
 
-        # Create VERSION file
-        with open(layerdir + '/VERSION', 'w') as f:
-            f.write('1.0')
+class LayerProgress:
+    """Byte counters of one layer download, written by its worker and read by the renderer"""
+    __slots__ = ('digest', 'total', 'initial', 'downloaded', 'started')
 
-        # Check cache first
-        cache_path = check_layer_cache(ublob)
-        if cache_path:
-            with progress_lock:
-                # 显示缓存使用的进度条
-                sys.stdout.write(f'\r{ublob[7:19]}: |{"█" * 30}| 100.0% (cached)')
-                sys.stdout.flush()
-                print(f'\n{ublob[7:19]}: Using cached layer')
-            if use_cached_layer(cache_path, layerdir, ublob):
-                return {'fake_layerid': fake_layerid, 'layer': layer, 'layerdir': layerdir}
-            else:
-                with progress_lock:
-                    print(f'{ublob[7:19]}: Cache failed, downloading...')
-        
-        # Update cache miss stats
-        with progress_lock:
-            cache_stats['misses'] += 1
-            # 显示开始下载的进度条
-            sys.stdout.write(f'\r{ublob[7:19]}: |{" " * 30}|   0.0% (starting...)')
-            sys.stdout.flush()
+    def __init__(self, digest: str, total: Optional[int], initial: int = 0):
+        self.digest = digest
+        self.total = total
+        self.initial = initial
+        self.downloaded = initial
+        self.started = time.time()
 
-        start_time = time.time()
+class DashboardStream:
+    """Stands in for sys.stdout while the dashboard is shown: other output first erases the dashboard,
+    which the next frame redraws below it"""
 
-        auth_head = get_auth_head('application/vnd.docker.distribution.manifest.v2+json', registry, repository, username, password, auth_url, reg_service)
+    def __init__(self, stream, renderer):
+        self.stream = stream
+        self.renderer = renderer
+        self.at_line_start = True
 
-        # Try primary URL first, then fallback URLs
-        urls = [f'https://{registry}/v2/{repository}/blobs/{ublob}']
-        if 'urls' in layer and layer['urls']:
-            urls.extend(layer['urls'])
+    def write(self, text):
+        with self.renderer.lock:
+            self.renderer.erase()
+            if text:
+                self.at_line_start = text.endswith('\n')
+            return self.stream.write(text)
 
-        bresp = None
-        for url in urls:
-            try:
-                # 检查中断信号
-                if shutdown_event.is_set():
-                    raise KeyboardInterrupt("Download interrupted by user")
-                    
-                bresp = session.get(url, headers=auth_head, stream=True, verify=False, timeout=30)
-                if bresp.status_code == 200:
-                    break
-            except KeyboardInterrupt:
-                raise
-            except requests.RequestException:
-                continue
-        else:
-            with progress_lock:
-                print(f'ERROR: Cannot download layer {ublob[7:19]} from any source')
-            return None
+    def flush(self):
+        self.stream.flush()
 
-        # Stream download with progress
-        content_length = int(bresp.headers.get('Content-Length', 0)) if bresp.headers.get('Content-Length') else None
-        downloaded = 0
-        last_update = 0
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
 
-        try:
-            # Stream directly to file without loading entire content in memory
-            with open(layerdir + '/layer_gzip.tar', 'wb') as file:
-                for chunk in bresp.iter_content(chunk_size=1024*1024):  # 1MB chunks
-                    # 检查中断信号
-                    if shutdown_event.is_set():
-                        bresp.close()
-                        raise KeyboardInterrupt("Download interrupted by user")
-                        
-                    if chunk:
-                        file.write(chunk)
-                        downloaded += len(chunk)
+class ProgressRenderer:
+    """Draws the progress of every active layer download from a single thread"""
 
-                        # Update progress every 100ms
-                        current_time = time.time()
-                        if current_time - last_update > 0.1:
-                            with progress_lock:
-                                progress_bar(ublob, downloaded, content_length, start_time)
-                            last_update = current_time
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.bars = {}
+        self.mode = 'none'
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.output = None
+        self.drawn = 0
+        self.reset()
 
-            with progress_lock:
-                # 显示最终完成的进度条
-                if content_length:
-                    sys.stdout.write(f'\r{ublob[7:19]}: |{"█" * 30}| 100.0% ({format_speed(downloaded)})')
-                else:
-                    sys.stdout.write(f'\r{ublob[7:19]}: |{"█" * 30}| 100.0% ({format_speed(downloaded)})')
-                sys.stdout.flush()
-                print(f'\n{ublob[7:19]}: Download complete')
-                print(f'{ublob[7:19]}: Extracting...')
+    def reset(self):
+        self.finished_layers = 0
+        self.finished_bytes = 0
+        self.samples = []
 
-            # Stream decompress to avoid memory issues
-            with open(layerdir + '/layer.tar', 'wb') as out_file:
-                with gzip.open(layerdir + '/layer_gzip.tar', 'rb') as gz_file:
-                    shutil.copyfileobj(gz_file, out_file)  # type: ignore
+    def start(self, mode: str = 'auto'):
+        """Start rendering: mode is tty (dashboard), log (periodic summary lines), none, or auto"""
+        if self.thread is not None:
+            return
+        if mode == 'auto':
+            interactive = sys.stdout.isatty() and os.environ.get('TERM') != 'dumb'
+            # The dashboard moves the cursor with ANSI sequences, which old Windows consoles don't understand
+            mode = 'tty' if interactive and (sys.platform != 'win32' or 'WT_SESSION' in os.environ) else 'log'
+        self.mode = mode
+        self.reset()
+        if mode == 'none':
+            return
+        if mode == 'tty':
+            self.output = DashboardStream(sys.stdout, self)
+            sys.stdout = self.output
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name='docker_pull_progress', daemon=True)
+        self.thread.start()
 
-            os.remove(layerdir + '/layer_gzip.tar')
-            
-            # Save to cache after successful download and extraction
-            layer_tar_path = layerdir + '/layer.tar'
-            if save_layer_to_cache(ublob, layer_tar_path):
-                with progress_lock:
-                    print(f'{ublob[7:19]}: Cached for future use')
-            
-            return {'fake_layerid': fake_layerid, 'layer': layer, 'layerdir': layerdir}
-            
-        except KeyboardInterrupt:
-            # 清理部分下载的文件
-            if os.path.exists(layerdir + '/layer_gzip.tar'):
-                os.remove(layerdir + '/layer_gzip.tar')
-            if os.path.exists(layerdir + '/layer.tar'):
-                os.remove(layerdir + '/layer.tar')
-            raise
-        except Exception as e:
-            # 清理部分下载的文件
-            if os.path.exists(layerdir + '/layer_gzip.tar'):
-                os.remove(layerdir + '/layer_gzip.tar')
-            if os.path.exists(layerdir + '/layer.tar'):
-                os.remove(layerdir + '/layer.tar')
-            raise RetryError(f'Error downloading layer {ublob[7:19]}: {str(e)}')
-
-    # Main execution continues...
-    # Get Docker authentication
-    # Support multiple manifest formats including OCI index
-    accept_types = [
-        'application/vnd.oci.image.index.v1+json',
-        'application/vnd.oci.image.manifest.v1+json',
-        'application/vnd.docker.distribution.manifest.list.v2+json',
-        'application/vnd.docker.distribution.manifest.v2+json',
-        'application/vnd.docker.distribution.manifest.v1+json'
-    ]
-    auth_head = get_auth_head(', '.join(accept_types), registry, repository, username, password, auth_url, reg_service)
+    def stop(self):
+        """Stop rendering and remove the dashboard from the terminal"""
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        with self.lock:
+            self.bars.clear()
+            if self.output is not None:
+                self.erase()
+                if sys.stdout is self.output:
+                    sys.stdout = self.output.stream
+                self.output = None
 
-    # Get manifest
-    try:
-        resp = requests.get('https://{}/v2/{}/manifests/{}'.format(registry, repository, tag), headers=auth_head, verify=False, timeout=30)
-        if resp.status_code != 200:
-            print('Cannot fetch manifest for {} [HTTP {}]'.format(repository, resp.status_code))
-            if resp.status_code == 401:
-                print('Authentication failed. Please check your credentials.')
-                if not username or not password:
-                    print('Private registry requires authentication. Use --username and --password arguments.')
-            elif resp.status_code == 403:
-                print('Access forbidden. You may not have permission to access this image.')
-            print(resp.content)
-            exit(1)
-    except KeyboardInterrupt:
+    def add(self, digest: str, total: Optional[int], initial: int = 0) -> LayerProgress:
+        """Show a layer download attempt (replacing the previous one); the worker updates .downloaded"""
+        bar = LayerProgress(digest, total, initial)
+        with self.lock:
+            previous = self.bars.get(digest)
+            if previous is not None:
+                self.finished_bytes += previous.downloaded - previous.initial
+            self.bars[digest] = bar
+        return bar
+
+    def remove(self, digest: str, ok: bool = True):
+        """A layer download ended (all attempts included)"""
+        with self.lock:
+            bar = self.bars.pop(digest, None)
+            if bar is not None:
+                self.finished_bytes += bar.downloaded - bar.initial
+            if ok:
+                self.finished_layers += 1
+
+    def erase(self):
+        """Remove the drawn dashboard (called with the lock held), leaving the cursor where it started"""
+        if self.drawn:
+            self.output.stream.write(f'\x1b[{self.drawn}A\r\x1b[J')
+            self.drawn = 0
+
+    def _totals(self, bars, now):
+        downloaded = self.finished_bytes + sum(bar.downloaded - bar.initial for bar in bars)
+        self.samples.append((now, downloaded))
+        while len(self.samples) > 2 and self.samples[0][0] < now - PROGRESS_SPEED_WINDOW:
+            self.samples.pop(0)
+        first_time, first_bytes = self.samples[0]
+        speed = (downloaded - first_bytes) / (now - first_time) if now > first_time else 0
+        remaining = sum(bar.total - bar.downloaded for bar in bars if bar.total and bar.total > bar.downloaded)
+        eta = format_time(remaining / speed) if speed > 0 else '?'
+        return downloaded, speed, remaining, eta
+
+    def _bar_line(self, bar, now, width):
+        elapsed = now - bar.started
+        speed = (bar.downloaded - bar.initial) / elapsed if elapsed > 0 else 0
+        if bar.total:
+            fraction = min(1.0, bar.downloaded / bar.total)
+            filled = int(30 * fraction)
+            eta = format_time((bar.total - bar.downloaded) / speed) if speed > 0 else '?'
+            line = f'{bar.digest[7:19]}: |{"█" * filled}{"-" * (30 - filled)}| {fraction * 100:5.1f}% ({format_speed(speed)}/s, ETA: {eta})'
+        else:
+            line = f'{bar.digest[7:19]}: Downloaded {format_speed(bar.downloaded)} ({format_speed(speed)}/s)'
+        return line[:width]
+
+    def _run(self):
+        last_log = time.time()
+        while not self.stop_event.wait(PROGRESS_FRAME_INTERVAL):
+            now = time.time()
+            with self.lock:
+                bars = list(self.bars.values())
+                downloaded, speed, remaining, eta = self._totals(bars, now)
+                summary = (f'{len(bars)} active, {self.finished_layers} done: {format_speed(downloaded)} downloaded, '
+                           f'{format_speed(remaining)} to go, {format_speed(speed)}/s, ETA: {eta}')
+                if self.mode == 'tty':
+                    self._draw(bars, summary, now)
+            # Printed like any other message, outside self.lock: print takes progress_lock, the dashboard's
+            # stream takes progress_lock then self.lock
+            if self.mode == 'log' and bars and now - last_log >= PROGRESS_LOG_INTERVAL:
+                print(f'[progress] {summary}', flush=True)
+                last_log = now
+
+    def _draw(self, bars, summary, now):
+        # A line still being written (no newline yet) would be overwritten: wait for it to end
+        if not self.output.at_line_start:
+            return
+        width = max(20, shutil.get_terminal_size().columns - 1)
+        lines = [self._bar_line(bar, now, width) for bar in bars[:PROGRESS_MAX_BARS]]
+        if len(bars) > PROGRESS_MAX_BARS:
+            lines.append(f'... {len(bars) - PROGRESS_MAX_BARS} more'[:width])
+        if bars:
+            lines.append(f'Total: {summary}'[:width])
+        elif not self.drawn:
+            return
+        frame = f'\x1b[{self.drawn}A\r' if self.drawn else ''
+        frame += ''.join(line + '\x1b[K\n' for line in lines) + '\x1b[J'
+        self.output.stream.write(frame)
+        self.output.stream.flush()
+        self.drawn = len(lines)
+
+dashboard = ProgressRenderer()
+
+def probe_range_support(ref, url):
+    """Return (final_url, total_size) if the blob URL (after redirects) serves byte ranges, else None"""
+    resp = registry_get(ref, url, 'application/vnd.docker.distribution.manifest.v2+json', {'Range': 'bytes=0-0'}, stream=True, timeout=30)
+    try:
+        if resp.status_code != 206:
+            return None
+        return resp.url, int(resp.headers.get('Content-Range', '').rsplit('/', 1)[1])
+    except (IndexError, ValueError):
+        return None
+    finally:
+        resp.close()
+
+def fetch_segment(ref, ublob, blob_url, cdn_url, fd, start, end, progress):
+    """Download bytes start..end (inclusive) of a blob into fd, resuming within the segment on errors"""
+    # New connections of this segment thread count towards the layer
+    current_layer_metrics.set(progress['metrics'])
+    pos = start
+    attempt = 0
+    url = cdn_url
+    while True:
+        if shutdown_event.is_set():
+            raise KeyboardInterrupt("Download interrupted by user")
+        range_head = {'Range': f'bytes={pos}-{end}'}
+        try:
+            with get_registry_limiter(ref['registry']):
+                if urllib.parse.urlparse(url).netloc == ref['registry']:
+                    resp = registry_get(ref, url, 'application/vnd.docker.distribution.manifest.v2+json', range_head, stream=True, timeout=30)
+                else:
+                    # Pre-signed CDN URL: must not carry the registry Authorization header
+                    resp = session.get(url, headers=range_head, stream=True, verify=False, timeout=30)
+                if resp.status_code == 200:
+                    resp.close()
+                    raise RangeNotSupportedError(f'{url} ignored the Range header')
+                if resp.status_code != 206 or parse_content_range_start(resp.headers.get('Content-Range')) != pos:
+                    resp.close()
+                    raise RetryError(f'Unexpected response for range {pos}-{end} [HTTP {resp.status_code}]')
+                for chunk in resp.iter_content(chunk_size=read_chunk_size):
+                    if shutdown_event.is_set():
+                        resp.close()
+                        raise KeyboardInterrupt("Download interrupted by user")
+                    if chunk:
+                        pause = account_chunk(len(chunk))
+                        if pause:
+                            time.sleep(pause)
+                        write_at(fd, chunk, pos)
+                        pos += len(chunk)
+                        with progress['lock']:
+                            progress['bytes'] += len(chunk)
+                if pos != end + 1:
+                    raise RetryError(f'Short read for range {start}-{end}')
+                return start
+        except (requests.RequestException, RetryError):
+            attempt += 1
+            if attempt >= 3:
+                raise
+            # The redirect target may have expired, go back through the registry
+            url = blob_url
+            time.sleep(attempt)
+
+def download_layer_segmented(ref, layer, ublob, blob_path, state_path, layer_tar_path, bar):
+    """Download a large blob into blob_path with parallel Range requests; returns False if ranges are unsupported,
+    else the SegmentFollower expanding it to layer_tar_path (True for OCI output, which keeps it compressed)"""
+    metrics = layer_record(layer)
+    blob_url = registry_url(ref, 'blobs', ublob)
+    requested = time.perf_counter()
+    probe = probe_range_support(ref, blob_url)
+    if not probe or probe[1] != layer['size']:
+        return False
+    cdn_url, total_size = probe
+    metrics['ttfb'] = time.perf_counter() - requested
+    metrics['url'] = public_url(cdn_url)
+
+    done = load_segment_state(ublob, state_path, total_size, chunk_size)
+    pending = [start for start in range(0, total_size, chunk_size) if start not in done]
+    progress = {'lock': threading.Lock(), 'bytes': sum(min(chunk_size, total_size - start) for start in done), 'metrics': metrics}
+    initial = progress['bytes']
+    note_resume_offset(metrics, initial)
+    bar.total, bar.initial, bar.downloaded = total_size, initial, initial
+    if initial:
+        with progress_lock:
+            print(f'{ublob[7:19]}: Resuming segmented download from {format_speed(initial)}')
+
+    fd = os.open(blob_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+    follower = None
+    transfer_started = time.perf_counter()
+    try:
+        # Preallocate so every segment can be written at its final offset
+        os.ftruncate(fd, total_size)
+        if output_format == 'docker':
+            follower = SegmentFollower(blob_path, layer_tar_path, total_size)
+            follower.advance(segment_prefix(done, total_size, chunk_size))
+        with ThreadPoolExecutor(max_workers=connections_per_blob) as segment_executor:
+            futures = {segment_executor.submit(fetch_segment, ref, ublob, blob_url, cdn_url, fd, start,
+                                               min(start + chunk_size, total_size) - 1, progress): start for start in pending}
+            not_done = set(futures)
+            try:
+                while not_done:
+                    finished, not_done = wait(not_done, timeout=0.1, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        done.add(future.result())
+                        save_segment_state(ublob, state_path, total_size, chunk_size, done)
+                    if finished and follower is not None:
+                        follower.advance(segment_prefix(done, total_size, chunk_size))
+                    bar.downloaded = progress['bytes']
+            except BaseException:
+                # Don't start queued segments, the completed ones stay recorded for resuming
+                for future in not_done:
+                    future.cancel()
+                raise
+    except RangeNotSupportedError:
+        if follower is not None:
+            follower.abort()
+        discard_partial(blob_path, state_path)
+        return False
+    except BaseException:
+        if follower is not None:
+            follower.abort()
+        raise
+    finally:
+        os.close(fd)
+        metrics['transfer'] += time.perf_counter() - transfer_started
+        metrics['bytes'] += progress['bytes'] - initial
+
+    bar.downloaded = total_size
+    with progress_lock:
+        print(f'{ublob[7:19]}: Segments complete, verifying...')
+        transfer_stats['bytes_downloaded'] += progress['bytes'] - initial
+    return follower or True
+
+def complete_segmented_blob(ublob, blob_path, state_path, layer_tar_path, workdir, follower):
+    """Verify a blob assembled from segments and publish it; returns (layer_path, diff_id)"""
+    if output_format != 'docker':
+        try:
+            verify_blob_digest(ublob, calculate_layer_digest(blob_path))
+        except DigestMismatchError:
+            discard_partial(blob_path, state_path)
+            raise
+        return finish_downloaded_blob(ublob, blob_path, state_path, workdir), None
+    # The follower already expanded most of it while later segments downloaded, finish the tail
+    keep_blob = use_cache and cache_storage == 'blob'
+    try:
+        blob_digest, diff_id = follower.finish()
+        verify_blob_digest(ublob, blob_digest)
+    except BaseException as e:
+        discard_partial(blob_path, state_path)
+        if os.path.exists(layer_tar_path):
+            os.remove(layer_tar_path)
+        if isinstance(e, zlib.error):
+            # A damaged blob usually breaks the gzip stream before its digest can be checked
+            raise RetryError(f'{ublob[7:19]} is not a valid gzip stream ({e})')
+        raise
+    if not keep_blob:
+        discard_partial(blob_path, state_path)
+    return finish_downloaded_layer(ublob, layer_tar_path, diff_id, blob_path if keep_blob else None, state_path), diff_id
+
+def finish_downloaded_layer(ublob, layer_tar_path, diff_id, blob_path=None, state_path=None):
+    """Publish a downloaded layer to the cache as --cache-storage says; returns the path the archive reads it from"""
+    if blob_path is not None:
+        # --cache-storage blob: keep the registry blob, this run's archive still reads the expanded layer.tar
+        publish_blob(ublob, blob_path, None, diff_id, os.path.getsize(layer_tar_path))
+        discard_partial(blob_path, state_path)
+        with progress_lock:
+            print(f'{ublob[7:19]}: Cached for future use (compressed blob)')
+        return Path(layer_tar_path)
+    if save_layer_to_cache(ublob, layer_tar_path, diff_id, cache_zstd_level if cache_storage == 'zstd' else None):
+        with progress_lock:
+            print(f'{ublob[7:19]}: Cached for future use' + (' (zstd)' if cache_storage == 'zstd' else ''))
+        cached_layer = get_layer_cache_path(ublob) / 'layer.tar'
+        if cached_layer.exists():
+            os.remove(layer_tar_path)
+            return cached_layer
+    return Path(layer_tar_path)
+
+def finish_downloaded_blob(ublob, blob_path, state_path, workdir):
+    """Publish a verified compressed blob (OCI output) to the blob cache; returns the path the archive reads it from"""
+    layer_path = publish_blob(ublob, blob_path, workdir)
+    discard_partial(blob_path, state_path)
+    if use_cache:
+        with progress_lock:
+            print(f'{ublob[7:19]}: Cached for future use')
+    return layer_path
+
+def use_cached_blob(ublob, cached_blob, layer_tar_path):
+    """Serve a layer from the compressed blob cache; returns (layer_path, diff_id), or (None, None) to download"""
+    size = cached_blob.stat().st_size
+    if output_format == 'docker' and cache_storage == 'blob':
+        # Kept compressed at rest: expanded while the archive is written, once we know its size
+        entry = lookup_blob_entry(ublob)
+        if 'tar_size' not in entry:
+            try:
+                entry['diff_id'], entry['tar_size'] = measure_blob(ublob, cached_blob)
+            except ValueError:
+                return None, None
+            except (RetryError, zlib.error) as e:
+                with progress_lock:
+                    print(f'{ublob[7:19]}: Cached blob is corrupt ({e}), downloading...')
+                os.remove(cached_blob)
+                return None, None
+            update_blob_index(ublob, size, entry['diff_id'], entry['tar_size'])
+        diff_id = entry.get('diff_id')
+        layer_path = CompressedLayer(cached_blob, entry['tar_size'], diff_id)
+    elif output_format == 'docker':
+        # Only layer.tar is missing: gunzip locally instead of downloading again
+        try:
+            diff_id = expand_blob(ublob, cached_blob, layer_tar_path)
+        except ValueError:
+            return None, None
+        except (RetryError, zlib.error) as e:
+            with progress_lock:
+                print(f'{ublob[7:19]}: Cached blob is corrupt ({e}), downloading...')
+            os.remove(cached_blob)
+            return None, None
+        layer_path = finish_downloaded_layer(ublob, layer_tar_path, diff_id)
+    else:
+        layer_path, diff_id = cached_blob, None
+    with progress_lock:
+        cache_stats['hits'] += 1
+        cache_stats['bytes_saved'] += size
+        print(f'{ublob[7:19]}: Using cached blob')
+    return layer_path, diff_id
+
+def lookup_cached_layer(ublob, expected_diff_id, layer_tar_path):
+    """Serve a layer from the layer or blob cache; returns (layer_path, diff_id), or None to download"""
+    # OCI output needs the compressed blob, not layer.tar
+    cache_path = check_layer_cache(ublob, expected_diff_id) if output_format == 'docker' else None
+    if cache_path:
+        with progress_lock:
+            print(f'{ublob[7:19]}: Using cached layer')
+        layer_path = use_cached_layer(cache_path, ublob)
+        if layer_path:
+            return layer_path, None
+        else:
+            with progress_lock:
+                print(f'{ublob[7:19]}: Cache failed, downloading...')
+
+    cached_blob = check_blob_cache(ublob)
+    if cached_blob:
+        layer_path, diff_id = use_cached_blob(ublob, cached_blob, layer_tar_path)
+        if layer_path:
+            return layer_path, diff_id
+    return None
+
+def open_layer_stream(ublob, blob_path, layer_tar_path, resume_from, stream):
+    """Open the partial blob and layer.tar for writing at resume_from; returns (blob_file, tar_file, stream)"""
+    blob_file = open(blob_path, 'r+b' if resume_from else 'wb')
+    tar_file = None
+    try:
+        expand = output_format == 'docker'
+        if stream is not None:
+            # Same-run retry: the live pipeline already covers the partial bytes
+            if expand:
+                tar_file = open(layer_tar_path, 'r+b')
+                tar_file.seek(stream.tar_size)
+                tar_file.truncate()
+                stream.out_file = tar_file
+            blob_file.seek(resume_from)
+        else:
+            # OCI output keeps the blob compressed: only hash it, no layer.tar
+            tar_file = open(layer_tar_path, 'wb') if expand else None
+            stream = LayerStream(tar_file, expand)
+            if resume_from:
+                # Replay the bytes from a previous run to rebuild the hash and gunzip state
+                with progress_lock:
+                    print(f'{ublob[7:19]}: Resuming from {format_speed(resume_from)}')
+                remaining = resume_from
+                while remaining > 0:
+                    chunk = blob_file.read(min(1024*1024, remaining))
+                    if not chunk:
+                        break
+                    stream.feed(chunk)
+                    remaining -= len(chunk)
+        blob_file.truncate()
+    except BaseException:
+        blob_file.close()
+        if tar_file is not None:
+            tar_file.close()
+        raise
+    return blob_file, tar_file, stream
+
+def finish_streamed_layer(ublob, blob_digest, diff_id, blob_path, state_path, layer_tar_path, workdir, downloaded, resume_from):
+    """Verify a fully streamed blob and publish it (layer.tar or compressed blob) to the cache; returns the layer path"""
+    verify_blob_digest(ublob, blob_digest)
+    expand = output_format == 'docker'
+    keep_blob = expand and use_cache and cache_storage == 'blob'
+    if expand and not keep_blob:
+        discard_partial(blob_path, state_path)
+
+    with progress_lock:
+        print(f'{ublob[7:19]}: Download complete (digest verified)')
+        transfer_stats['bytes_downloaded'] += downloaded - resume_from
+
+    # Save to cache after successful download and extraction
+    if expand:
+        return finish_downloaded_layer(ublob, layer_tar_path, diff_id, blob_path if keep_blob else None, state_path)
+    return finish_downloaded_blob(ublob, blob_path, state_path, workdir)
+
+@retry(max_attempts=3, delay=1.0, backoff=2.0)
+def download_layer(ref, layer, workdir, parentid, expected_diff_id=None):
+    """Download a single layer in a separate thread with streaming and progress"""
+    # 检查是否收到中断信号
+    if shutdown_event.is_set():
+        raise KeyboardInterrupt("Download interrupted by user")
+    
+    ublob = layer['digest']
+    fake_layerid = hashlib.sha256((parentid+'\n'+ublob+'\n').encode('utf-8')).hexdigest()
+    metrics = layer_record(layer)
+    metrics['attempts'] += 1
+    attempt_started = time.perf_counter()
+
+    # Per process: with --cache-storage blob|zstd it outlives the digest lock until the archive has it
+    layer_tar_path = os.path.join(workdir, ublob.replace(':', '_') + (f'.{CACHE_HOST}.{os.getpid()}' if use_cache else '') + '.tar')
+
+    # Processes sharing the cache download each layer once: the others wait here, then hit the cache
+    with CacheDigestLock(ublob):
+        # Check cache first
+        cached = lookup_cached_layer(ublob, expected_diff_id, layer_tar_path)
+        if cached:
+            metrics['source'] = 'cache'
+            return {'fake_layerid': fake_layerid, 'layer': layer, 'layer_path': cached[0], 'diff_id': cached[1]}
+    
+        if offline_mode:
+            with progress_lock:
+                print(f'ERROR: Layer {ublob[7:19]} is not cached (offline mode)')
+            return None
+
+        # One of the concurrent download slots (fixed, or tuned by --max-concurrent-downloads auto),
+        # and the registry or mirror this attempt downloads from
+        with download_slots, get_mirror_set(ref['registry']).attempt(ref, layer) as attempt:
+            source = attempt.source
+            metrics['wait'] += time.perf_counter() - attempt_started
+            metrics['source'] = attempt.endpoint.name
+            bar = dashboard.add(ublob, layer.get('size'))
+
+            # Pick up where a previous attempt (or a previous run) stopped
+            blob_path, state_path = get_partial_paths(ublob, workdir)
+
+            # Large blobs: parallel ranged segments, falling back to a single stream if unsupported
+            if connections_per_blob > 1 and layer.get('size', 0) > chunk_size * SEGMENTED_MIN_CHUNKS:
+                try:
+                    segmented = download_layer_segmented(source, layer, ublob, blob_path, state_path, layer_tar_path, bar)
+                    if segmented:
+                        published = time.perf_counter()
+                        layer_path, diff_id = complete_segmented_blob(ublob, blob_path, state_path, layer_tar_path, workdir, segmented)
+                        metrics['publish'] += time.perf_counter() - published
+                        if segmented is not True:
+                            metrics['decompress'] = segmented.stream.busy
+                        # Only what the segments fetched in this attempt, not the part resumed from disk
+                        attempt.succeeded(bar.downloaded - bar.initial)
+                        return {'fake_layerid': fake_layerid, 'layer': layer, 'layer_path': layer_path, 'diff_id': diff_id}
+                except (requests.RequestException, RetryError) as e:
+                    raise RetryError(f'Error downloading layer {ublob[7:19]}: {str(e)}')
+
+            resume_from = load_partial_offset(ublob, blob_path, state_path)
+            stream = active_streams.pop(ublob, None)
+            if stream is not None and stream.blob_size != resume_from:
+                stream = None
+
+            # Try primary URL first, then fallback URLs
+            urls = [registry_url(source, 'blobs', ublob)]
+            if 'urls' in layer and layer['urls']:
+                urls.extend(layer['urls'])
+
+            # One connection slot of the registry for the whole stream
+            with get_registry_limiter(source['registry']):
+                bresp = None
+                last_error = None
+                requested = time.perf_counter()
+                for url in urls:
+                    try:
+                        # 检查中断信号
+                        if shutdown_event.is_set():
+                            raise KeyboardInterrupt("Download interrupted by user")
+                        
+                        range_head = {'Range': f'bytes={resume_from}-'} if resume_from else None
+                        bresp = registry_get(source, url, 'application/vnd.docker.distribution.manifest.v2+json', range_head, stream=True, timeout=30)
+                        if bresp.status_code == 416:
+                            # Partial state no longer matches the blob, start over
+                            bresp.close()
+                            discard_partial(blob_path, state_path)
+                            resume_from, stream = 0, None
+                            bresp = registry_get(source, url, 'application/vnd.docker.distribution.manifest.v2+json', stream=True, timeout=30)
+                        if bresp.status_code == 206 and parse_content_range_start(bresp.headers.get('Content-Range')) == resume_from:
+                            break
+                        if bresp.status_code == 200:
+                            if resume_from:
+                                # Registry ignored the Range header, restart from byte zero
+                                with progress_lock:
+                                    print(f'{ublob[7:19]}: Range not supported by server, restarting download')
+                                resume_from, stream = 0, None
+                            break
+                        last_error = f'HTTP {bresp.status_code}'
+                        bresp.close()
+                    except KeyboardInterrupt:
+                        raise
+                    except requests.RequestException as e:
+                        last_error = type(e).__name__
+                        continue
+                else:
+                    # Back off and retry (on another endpoint if there is one) instead of giving up on the layer
+                    raise RetryError(f'Cannot download layer {ublob[7:19]} from {attempt.endpoint.name} ({last_error})')
+                metrics['ttfb'] = time.perf_counter() - requested
+                metrics['url'] = public_url(bresp.url)
+                note_resume_offset(metrics, resume_from)
+
+                # Stream download with progress
+                content_length = int(bresp.headers.get('Content-Length', 0)) if bresp.headers.get('Content-Length') else None
+                if content_length is not None:
+                    content_length += resume_from
+                downloaded = resume_from
+                bar.total, bar.initial, bar.downloaded = content_length, resume_from, resume_from
+                last_state_save = resume_from
+
+                blob_file = None
+                tar_file = None
+                pipeline = None
+                try:
+                    blob_file, tar_file, stream = open_layer_stream(ublob, blob_path, layer_tar_path, resume_from, stream)
+                    pipeline = InflatePipeline(stream)
+
+                    # Single pass: every chunk is kept for resuming, and hashed and (docker format) decompressed
+                    # to layer.tar on the pipeline thread while the next chunks arrive
+                    transfer_started = time.perf_counter()
+                    try:
+                        for chunk in bresp.iter_content(chunk_size=read_chunk_size):
+                            # 检查中断信号
+                            if shutdown_event.is_set():
+                                bresp.close()
+                                raise KeyboardInterrupt("Download interrupted by user")
+
+                            if chunk:
+                                pause = account_chunk(len(chunk))
+                                if pause:
+                                    time.sleep(pause)
+                                blob_file.write(chunk)
+                                pipeline.feed(chunk)
+                                downloaded += len(chunk)
+
+                                if downloaded - last_state_save >= PARTIAL_STATE_INTERVAL:
+                                    save_partial_state(ublob, blob_file, state_path, url)
+                                    last_state_save = downloaded
+                                bar.downloaded = downloaded
+                    finally:
+                        metrics['transfer'] += time.perf_counter() - transfer_started
+                        metrics['bytes'] += downloaded - resume_from
+
+                    blob_digest, diff_id = pipeline.finish()
+                    metrics['decompress'] = stream.busy
+                    if tar_file is not None:
+                        tar_file.close()
+                    blob_file.close()
+                    published = time.perf_counter()
+                    layer_path = finish_streamed_layer(ublob, blob_digest, diff_id, blob_path, state_path, layer_tar_path, workdir, downloaded, resume_from)
+                    metrics['publish'] += time.perf_counter() - published
+                    attempt.succeeded(downloaded - resume_from)
+                    return {'fake_layerid': fake_layerid, 'layer': layer, 'layer_path': layer_path, 'diff_id': diff_id}
+                
+                except (KeyboardInterrupt, requests.RequestException) as e:
+                    # Let the pipeline catch up first: the kept stream must cover exactly the bytes on disk
+                    if pipeline is not None and not pipeline.close():
+                        stream = None
+                    # Keep the partial blob so the next attempt or run can resume with a Range request
+                    if blob_file is not None and not blob_file.closed:
+                        save_partial_state(ublob, blob_file, state_path, url)
+                        blob_file.close()
+                    if tar_file is not None:
+                        tar_file.close()
+                    if isinstance(e, KeyboardInterrupt):
+                        if os.path.exists(layer_tar_path):
+                            os.remove(layer_tar_path)
+                        raise
+                    download_slots.congestion()
+                    if stream is not None:
+                        active_streams[ublob] = stream
+                    raise RetryError(f'Error downloading layer {ublob[7:19]}: {str(e)}')
+                except Exception as e:
+                    # 清理部分下载的文件
+                    if pipeline is not None:
+                        pipeline.close()
+                    for f in (blob_file, tar_file):
+                        if f is not None:
+                            f.close()
+                    discard_partial(blob_path, state_path)
+                    if os.path.exists(layer_tar_path):
+                        os.remove(layer_tar_path)
+                    if isinstance(e, DigestMismatchError):
+                        with progress_lock:
+                            print(f'{ublob[7:19]}: {e}, retrying...')
+                    raise RetryError(f'Error downloading layer {ublob[7:19]}: {str(e)}')
+
+# Asyncio engine (--engine async): one event loop thread drives every blob stream over a
+# pooled aiohttp session, so hundreds of concurrent streams don't need hundreds of threads.
+# Hashing, gunzip and file I/O run on a small executor to keep the loop responsive. Cache,
+# resume and digest handling are shared with download_layer; blobs are always streamed over
+# one connection (segmented Range downloads are a thread engine feature).
+ASYNC_IO_WORKERS = min(8, (os.cpu_count() or 2) + 2)
+async_loop = None
+async_session = None
+async_io_executor = None
+
+class DownloadInterrupted(Exception):
+    """Raised inside the event loop on Ctrl+C (KeyboardInterrupt would tear down the loop itself)"""
+    pass
+
+def start_async_engine():
+    """Start the event loop thread with its aiohttp session"""
+    global async_loop, async_session, async_io_executor
+    async_io_executor = ThreadPoolExecutor(max_workers=ASYNC_IO_WORKERS, thread_name_prefix='docker_pull_io')
+    async_loop = asyncio.new_event_loop()
+    threading.Thread(target=async_loop.run_forever, name='docker_pull_loop', daemon=True).start()
+
+    async def open_session():
+        connector = aiohttp.TCPConnector(limit=max_concurrent_downloads + 4, ssl=False, keepalive_timeout=30)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30)
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_start.append(trace_connection_start)
+        trace.on_dns_resolvehost_start.append(trace_dns_start)
+        trace.on_dns_resolvehost_end.append(trace_dns_end)
+        trace.on_connection_create_end.append(trace_connection_end)
+        trace.on_request_start.append(trace_request_start)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, headers={'User-Agent': 'Docker-Pull-Script/1.0'}, trace_configs=[trace])
+    async_session = asyncio.run_coroutine_threadsafe(open_session(), async_loop).result()
+
+def stop_async_engine():
+    """Close the aiohttp session and stop the event loop"""
+    global async_loop
+    if async_loop is None:
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(async_session.close(), async_loop).result(timeout=10)
+    except Exception:
+        pass
+    async_loop.call_soon_threadsafe(async_loop.stop)
+    async_loop = None
+    async_io_executor.shutdown(wait=False)
+
+async def run_io(func, *args):
+    """Run blocking file/CPU work on the I/O executor"""
+    return await asyncio.get_running_loop().run_in_executor(async_io_executor, func, *args)
+
+async def async_registry_get(ref, url, type_var, extra_headers=None):
+    """GET a registry URL on the aiohttp session, re-authenticating once on 401, waiting out 429/503 like
+    registry_request and following redirects without the registry credentials (pre-signed CDN URLs reject them)"""
+    auth = (ref['registry'], ref['repository'], *registry_credentials(ref), ref['auth_url'], ref['reg_service'])
+    limiter = get_registry_limiter(ref['registry'])
+    for attempt in range(THROTTLE_MAX_RETRIES + 1):
+        await asyncio.sleep(limiter.backoff_remaining())
+        auth_head = await run_io(get_auth_head, type_var, *auth)
+        resp = await async_session.get(url, headers={**auth_head, **(extra_headers or {})}, allow_redirects=False)
+        if resp.status == 401 and auth_head.get('Authorization', '').startswith('Bearer'):
+            resp.release()
+            auth_head = await run_io(refresh_auth_head, type_var, *auth)
+            resp = await async_session.get(url, headers={**auth_head, **(extra_headers or {})}, allow_redirects=False)
+        if resp.status not in THROTTLE_STATUS_CODES or attempt == THROTTLE_MAX_RETRIES:
+            break
+        resp.release()
+        limiter.throttle(parse_retry_after(resp.headers.get('Retry-After'), attempt))
+    for _ in range(10):
+        if resp.status not in (301, 302, 303, 307, 308) or 'Location' not in resp.headers:
+            break
+        location = urllib.parse.urljoin(str(resp.url), resp.headers['Location'])
+        resp.release()
+        resp = await async_session.get(location, headers=extra_headers or {}, allow_redirects=False)
+    return resp
+
+@retry(max_attempts=3, delay=1.0, backoff=2.0)
+async def async_download_layer(ref, layer, workdir, parentid, expected_diff_id=None):
+    """Download a single layer on the event loop; same cache, resume and verification as download_layer"""
+    if shutdown_event.is_set():
+        raise DownloadInterrupted("Download interrupted by user")
+
+    ublob = layer['digest']
+    fake_layerid = hashlib.sha256((parentid+'\n'+ublob+'\n').encode('utf-8')).hexdigest()
+    metrics = layer_record(layer)
+    metrics['attempts'] += 1
+    attempt_started = time.perf_counter()
+    # Per process: with --cache-storage blob|zstd it outlives the digest lock until the archive has it
+    layer_tar_path = os.path.join(workdir, ublob.replace(':', '_') + (f'.{CACHE_HOST}.{os.getpid()}' if use_cache else '') + '.tar')
+
+    # Processes sharing the cache download each layer once: the others wait here, then hit the cache
+    async with CacheDigestLock(ublob):
+        # Check cache first (may gunzip a cached blob, so off the loop)
+        cached = await run_io(lookup_cached_layer, ublob, expected_diff_id, layer_tar_path)
+        if cached:
+            metrics['source'] = 'cache'
+            return {'fake_layerid': fake_layerid, 'layer': layer, 'layer_path': cached[0], 'diff_id': cached[1]}
+
+        if offline_mode:
+            with progress_lock:
+                print(f'ERROR: Layer {ublob[7:19]} is not cached (offline mode)')
+            return None
+
+        async with download_slots, get_mirror_set(ref['registry']).attempt(ref, layer) as attempt, get_registry_limiter(attempt.source['registry']):
+            source = attempt.source
+            metrics['wait'] += time.perf_counter() - attempt_started
+            metrics['source'] = attempt.endpoint.name
+            bar = dashboard.add(ublob, layer.get('size'))
+
+            # Pick up where a previous attempt (or a previous run) stopped
+            blob_path, state_path = get_partial_paths(ublob, workdir)
+            resume_from = load_partial_offset(ublob, blob_path, state_path)
+            stream = active_streams.pop(ublob, None)
+            if stream is not None and stream.blob_size != resume_from:
+                stream = None
+
+            # Try primary URL first, then fallback URLs
+            urls = [registry_url(source, 'blobs', ublob)]
+            if 'urls' in layer and layer['urls']:
+                urls.extend(layer['urls'])
+
+            bresp = None
+            last_error = None
+            requested = time.perf_counter()
+            for url in urls:
+                try:
+                    range_head = {'Range': f'bytes={resume_from}-'} if resume_from else None
+                    bresp = await async_registry_get(source, url, 'application/vnd.docker.distribution.manifest.v2+json', range_head)
+                    if bresp.status == 416:
+                        # Partial state no longer matches the blob, start over
+                        bresp.release()
+                        discard_partial(blob_path, state_path)
+                        resume_from, stream = 0, None
+                        bresp = await async_registry_get(source, url, 'application/vnd.docker.distribution.manifest.v2+json')
+                    if bresp.status == 206 and parse_content_range_start(bresp.headers.get('Content-Range')) == resume_from:
+                        break
+                    if bresp.status == 200:
+                        if resume_from:
+                            with progress_lock:
+                                print(f'{ublob[7:19]}: Range not supported by server, restarting download')
+                            resume_from, stream = 0, None
+                        break
+                    last_error = f'HTTP {bresp.status}'
+                    bresp.release()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    last_error = type(e).__name__
+                    continue
+            else:
+                # Back off and retry (on another endpoint if there is one) instead of giving up on the layer
+                raise RetryError(f'Cannot download layer {ublob[7:19]} from {attempt.endpoint.name} ({last_error})')
+            metrics['ttfb'] = time.perf_counter() - requested
+            metrics['url'] = public_url(bresp.url)
+            note_resume_offset(metrics, resume_from)
+
+            content_length = bresp.content_length
+            if content_length is not None:
+                content_length += resume_from
+            downloaded = resume_from
+            bar.total, bar.initial, bar.downloaded = content_length, resume_from, resume_from
+            last_state_save = resume_from
+
+            blob_file = None
+            tar_file = None
+            pending_write = None
+            buffer = bytearray()
+            try:
+                blob_file, tar_file, stream = await run_io(open_layer_stream, ublob, blob_path, layer_tar_path, resume_from, stream)
+
+                def write_chunk(chunk):
+                    blob_file.write(chunk)
+                    stream.feed(chunk)
+
+                # Single pass as in download_layer; the next chunk is received while the previous one is written
+                transfer_started = time.perf_counter()
+                try:
+                    async for piece in bresp.content.iter_chunked(read_chunk_size):
+                        if shutdown_event.is_set():
+                            raise DownloadInterrupted("Download interrupted by user")
+                        pause = account_chunk(len(piece))
+                        if pause:
+                            await asyncio.sleep(pause)
+                        buffer += piece
+                        if len(buffer) < 1024*1024:
+                            continue
+                        if pending_write is not None:
+                            await pending_write
+                        pending_write = asyncio.ensure_future(run_io(write_chunk, bytes(buffer)))
+                        downloaded += len(buffer)
+                        buffer.clear()
+
+                        if downloaded - last_state_save >= PARTIAL_STATE_INTERVAL:
+                            await pending_write
+                            pending_write = None
+                            await run_io(save_partial_state, ublob, blob_file, state_path, url)
+                            last_state_save = downloaded
+                        bar.downloaded = downloaded
+                    if pending_write is not None:
+                        await pending_write
+                    pending_write = None
+                    if buffer:
+                        await run_io(write_chunk, bytes(buffer))
+                        downloaded += len(buffer)
+                        buffer.clear()
+                finally:
+                    # Never touch the files while the executor may still be writing them
+                    if pending_write is not None:
+                        await asyncio.gather(pending_write, return_exceptions=True)
+                    metrics['transfer'] += time.perf_counter() - transfer_started
+                    metrics['bytes'] += downloaded + len(buffer) - resume_from
+
+                blob_digest, diff_id = await run_io(stream.finish)
+                metrics['decompress'] = stream.busy
+                if tar_file is not None:
+                    tar_file.close()
+                blob_file.close()
+                published = time.perf_counter()
+                layer_path = await run_io(finish_streamed_layer, ublob, blob_digest, diff_id, blob_path, state_path,
+                                          layer_tar_path, workdir, downloaded, resume_from)
+                metrics['publish'] += time.perf_counter() - published
+                attempt.succeeded(downloaded - resume_from)
+                return {'fake_layerid': fake_layerid, 'layer': layer, 'layer_path': layer_path, 'diff_id': diff_id}
+
+            except (DownloadInterrupted, asyncio.CancelledError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Keep the partial blob so the next attempt or run can resume with a Range request
+                if blob_file is not None and not blob_file.closed:
+                    if buffer:
+                        # Bytes received since the last write still count towards the resume offset
+                        blob_file.write(buffer)
+                        stream.feed(bytes(buffer))
+                    save_partial_state(ublob, blob_file, state_path, url)
+                    blob_file.close()
+                if tar_file is not None:
+                    tar_file.close()
+                if isinstance(e, (DownloadInterrupted, asyncio.CancelledError)):
+                    if os.path.exists(layer_tar_path):
+                        os.remove(layer_tar_path)
+                    raise
+                download_slots.congestion()
+                active_streams[ublob] = stream
+                raise RetryError(f'Error downloading layer {ublob[7:19]}: {str(e) or type(e).__name__}')
+            except Exception as e:
+                # 清理部分下载的文件
+                for f in (blob_file, tar_file):
+                    if f is not None:
+                        f.close()
+                discard_partial(blob_path, state_path)
+                if os.path.exists(layer_tar_path):
+                    os.remove(layer_tar_path)
+                if isinstance(e, DigestMismatchError):
+                    with progress_lock:
+                        print(f'{ublob[7:19]}: {e}, retrying...')
+                raise RetryError(f'Error downloading layer {ublob[7:19]}: {str(e)}')
+            finally:
+                bresp.release()
+
+def finish_layer_record(record, started: float, result):
+    """Close the metrics of one layer download (every attempt included)"""
+    ended = time.time()
+    record['total'] += ended - started
+    record['status'] = 'ok' if result else 'failed'
+    if result and record['size'] and record['resumed'] is not None:
+        # Received beyond the part of the blob this run needed: discarded partials and restarted downloads
+        record['wasted'] = max(0, record['bytes'] - (record['size'] - record['resumed']))
+    record_phase('layers', started, ended)
+    dashboard.remove(record['digest'], bool(result))
+    if record['source'] not in (None, 'cache'):
+        # Once per layer, however many attempts it took to download
+        with progress_lock:
+            cache_stats['misses'] += 1
+
+def measured_download_layer(ref, layer, workdir, parentid, expected_diff_id):
+    """download_layer with the metrics record of the layer current on this thread"""
+    record = layer_record(layer)
+    token = current_layer_metrics.set(record)
+    started = time.time()
+    result = None
+    try:
+        result = download_layer(ref, layer, workdir, parentid, expected_diff_id)
+        return result
+    finally:
+        current_layer_metrics.reset(token)
+        finish_layer_record(record, started, result)
+
+async def async_measured_download_layer(ref, layer, workdir, parentid, expected_diff_id):
+    """async_download_layer with the metrics record of the layer current in its task"""
+    record = layer_record(layer)
+    current_layer_metrics.set(record)
+    started = time.time()
+    result = None
+    try:
+        result = await async_download_layer(ref, layer, workdir, parentid, expected_diff_id)
+        return result
+    finally:
+        finish_layer_record(record, started, result)
+
+def submit_layer_download(ref, layer, workdir, parentid, expected_diff_id):
+    """Start a layer download on the selected engine; returns a concurrent.futures.Future either way"""
+    if download_engine == 'async':
+        return asyncio.run_coroutine_threadsafe(async_measured_download_layer(ref, layer, workdir, parentid, expected_diff_id), async_loop)
+    return executor.submit(measured_download_layer, ref, layer, workdir, parentid, expected_diff_id)
+
+@retry(max_attempts=3, delay=1.0, backoff=2.0)
+def fetch_config_blob(ref, config_digest):
+    """Fetch the image config blob (from the manifest cache if present) and verify it against its digest"""
+    content = read_cached_manifest_blob(config_digest)
+    if content is not None:
+        manifest_stats['cache_hits'] += 1
+        return CachedResponse(content)
+    if offline_mode:
+        return CachedResponse(f'Offline mode: config {config_digest} is not cached'.encode(), 504)
+    resp = mirrored_request(ref, 'GET', 'blobs', config_digest, 'application/vnd.docker.container.image.v1+json', verify_digest=True, timeout=30)
+    if resp.status_code == 200:
+        verify_blob_digest(config_digest, 'sha256:' + hashlib.sha256(resp.content).hexdigest())
+        manifest_stats['fetched'] += 1
+        store_manifest_blob(resp.content)
+    return resp
+
+# Main execution continues...
+# Get Docker authentication
+# Support multiple manifest formats including OCI index
+accept_types = [
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.v1+json'
+]
+
+
+# Layer downloads of every image share one pool. A digest already downloading (or done) is
+# handed to each image that needs it; the temporary file of an uncached layer is removed
+# once the last image holding it has written it to its archive.
+layer_futures = {}
+layer_users = {}
+layer_futures_lock = threading.Lock()
+oci_index_lock = threading.Lock()
+used_outputs = set()
+
+def acquire_layer(ref, layer, parentid, expected_diff_id):
+    """Return the shared download future of a layer, submitting the download on first use"""
+    digest = layer['digest']
+    with layer_futures_lock:
+        future = layer_futures.get(digest)
+        if future is None or future.cancelled() or (future.done() and (future.exception() or not future.result())):
+            future = submit_layer_download(ref, layer, workdir, parentid, expected_diff_id)
+            layer_futures[digest] = future
+        else:
+            transfer_stats['layers_shared'] += 1
+        layer_users[digest] = layer_users.get(digest, 0) + 1
+        return future
+
+def remove_temporary_layer(future):
+    """Delete a finished layer file that lives in the work directory rather than the cache"""
+    if future.cancelled() or future.exception() or not future.result():
+        return
+    layer_path = future.result()['layer_path']
+    if Path(layer_path).parent == Path(workdir) and os.path.exists(layer_path):
+        os.remove(layer_path)
+
+def release_layer(digest):
+    """Drop one image's claim on a shared layer download"""
+    with layer_futures_lock:
+        layer_users[digest] -= 1
+        if layer_users[digest] > 0:
+            return
+        del layer_users[digest]
+        future = layer_futures.pop(digest)
+    if not future.cancel():
+        future.add_done_callback(remove_temporary_layer)
+
+def claim_output_name(name, tag):
+    """Reserve a default output name for this run, adding the tag when another image already uses it"""
+    with layer_futures_lock:
+        if name in used_outputs:
+            name += '_' + tag.replace(':', '_')
+        used_outputs.add(name)
+        return name
+
+def print_registry_error(resp):
+    """Explain an authentication or permission failure returned by the registry"""
+    if resp.status_code == 401:
+        print('Authentication failed. Please check your credentials.')
+        if not username or not password:
+            print('Private registry requires authentication. Use --username and --password arguments.')
+    elif resp.status_code == 403:
+        print('Access forbidden. You may not have permission to access this image.')
+
+def format_platform(platform):
+    """Format a manifest platform object as os/architecture[/variant]"""
+    platform_str = f"{platform.get('os', 'linux')}/{platform.get('architecture', 'amd64')}"
+    if platform.get('variant'):
+        platform_str += f"/{platform.get('variant')}"
+    return platform_str
+
+def fetch_platform_image(ref, descriptor, manifest=None, manifest_content=None):
+    """Fetch a platform manifest (unless given) and its config; returns the image description, or None on error"""
+    if manifest is None:
+        platform_str = format_platform(descriptor.get('platform', {}))
+        print(f"Fetching manifest for platform {platform_str}: {descriptor['digest']}")
+        resp = fetch_manifest(ref, descriptor['digest'], ', '.join(accept_types))
+        if resp.status_code != 200:
+            print('Cannot fetch manifest for platform {} [HTTP {}]'.format(platform_str, resp.status_code))
+            print_registry_error(resp)
+            return None
+        # OCI output stores the manifest exactly as served so its digest stays valid
+        manifest, manifest_content = resp.json(), resp.content
+
+    # Extract layers from manifest
+    if 'layers' in manifest:
+        layers = manifest['layers']
+    else:
+        print('Error: No layers found in manifest')
+        print(f'Manifest content: {manifest}')
+        return None
+
+    # Config blob is fetched first: its rootfs.diff_ids let cache lookups hit imported layers
+    config_digest = manifest['config']['digest']
+    try:
+        resp = fetch_config_blob(ref, config_digest)
+    except RetryError as e:
+        print(f'Cannot fetch config blob: {e}')
+        return None
+    if resp.status_code != 200:
+        print('Cannot fetch config blob [HTTP {}]'.format(resp.status_code))
+        print_registry_error(resp)
+        return None
+
+    config_content = resp.content
+    image_config = json.loads(config_content)
+    diff_ids = image_config.get('rootfs', {}).get('diff_ids', [])
+    if len(diff_ids) != len(layers):
+        diff_ids = [None] * len(layers)
+
+    platform = dict(descriptor.get('platform') or {})
+    if not platform and image_config.get('architecture') and image_config.get('os'):
+        platform = {'architecture': image_config['architecture'], 'os': image_config['os']}
+        if image_config.get('variant'):
+            platform['variant'] = image_config['variant']
+    return {'manifest': manifest, 'manifest_content': manifest_content, 'platform': platform,
+            'config_digest': config_digest, 'config_content': config_content, 'layers': layers, 'diff_ids': diff_ids}
+
+@timed_phase('manifest')
+def resolve_image(ref):
+    """Fetch the manifest of an image and of every selected platform; returns one target per output archive, or None on error"""
+    tag = ref['tag']
+
+    # Get manifest
+    try:
+        resp = fetch_manifest(ref, tag, ', '.join(accept_types))
+        if resp.status_code != 200:
+            print('Cannot fetch manifest for {} [HTTP {}]'.format(ref['repository'], resp.status_code))
+            print_registry_error(resp)
+            print(resp.content)
+            return None
+    except KeyboardInterrupt:
         print('\n⚠️  获取镜像清单时被用户中断')
-        sys.exit(0)
+        return None
     except requests.exceptions.RequestException as e:
         print(f'Network error fetching manifest: {e}')
-        exit(1)
+        return None
 
     manifest = resp.json()
 
@@ -774,192 +4075,799 @@ else:
     if 'mediaType' in manifest:
         print(f"Media type: {manifest['mediaType']}")
 
+    if 'manifests' not in manifest:
+        image = fetch_platform_image(ref, {}, manifest, resp.content)
+        return [{'ref': ref, 'images': [image], 'platform_suffix': ''}] if image else None
+
     # Handle multi-platform manifests (both Docker and OCI formats)
-    if target_platform and 'manifests' in manifest:
-        # This is a manifest list, find the right platform
-        found = False
-        for m in manifest['manifests']:
-            platform = m.get('platform', {})
-            platform_str = f"{platform.get('os', 'linux')}/{platform.get('architecture', 'amd64')}"
-            if platform.get('variant'):
-                platform_str += f"/{platform.get('variant')}"
-            
-            if platform_str == target_platform:
-                print(f"Found manifest for platform: {platform_str}")
-                digest = m['digest']
-                print(f"Platform manifest digest: {digest}")
-                
-                # Fetch the actual manifest for this platform
-                manifest_url = 'https://{}/v2/{}/manifests/{}'.format(registry, repository, digest)
-                print(f"Fetching platform manifest from: {manifest_url}")
-                auth_head = get_auth_head(', '.join(accept_types), registry, repository, username, password, auth_url, reg_service)
-                resp = requests.get(manifest_url, headers=auth_head, verify=False)
-                if resp.status_code != 200:
-                    print('Cannot fetch manifest for platform {} [HTTP {}]'.format(target_platform, resp.status_code))
-                    if resp.status_code == 401:
-                        print('Authentication failed. Please check your credentials.')
-                        if not username or not password:
-                            print('Private registry requires authentication. Use --username and --password arguments.')
-                    elif resp.status_code == 403:
-                        print('Access forbidden. You may not have permission to access this image.')
-                    exit(1)
-                
-                manifest = resp.json()
-                found = True
-                break
-        
-        if not found:
-            print('No manifest found for platform: {}'.format(target_platform))
-            print('Available platforms:')
-            for m in manifest['manifests']:
-                platform = m.get('platform', {})
-                platform_str = f"{platform.get('os', 'linux')}/{platform.get('architecture', 'amd64')}"
-                if platform.get('variant'):
-                    platform_str += f"/{platform.get('variant')}"
-                print(f"  - {platform_str}")
-            exit(1)
-
-    # Handle case where no platform is specified but manifest is multi-platform
-    if not target_platform and 'manifests' in manifest:
+    # Skip attestation manifests and other non-image manifests
+    image_manifests = [m for m in manifest['manifests']
+                       if m.get('annotations', {}).get('vnd.docker.reference.type') != 'attestation-manifest']
+    if all_platforms:
+        selected = image_manifests
+        print('Pulling all platforms: {}'.format(', '.join(format_platform(m.get('platform', {})) for m in selected)))
+    elif target_platforms:
+        selected = []
+        for wanted in target_platforms:
+            match = next((m for m in image_manifests if format_platform(m.get('platform', {})) == wanted), None)
+            if match is None:
+                print('No manifest found for platform: {}'.format(wanted))
+                print('Available platforms:')
+                for m in image_manifests:
+                    print(f"  - {format_platform(m.get('platform', {}))}")
+                return None
+            print(f"Found manifest for platform: {wanted}")
+            selected.append(match)
+    else:
+        # Handle case where no platform is specified but manifest is multi-platform
         print('Multi-platform image detected. Available platforms:')
-        image_manifests = []
-        last_platform_str = ""
-        for m in manifest['manifests']:
-            # Skip attestation manifests and other non-image manifests
-            annotations = m.get('annotations', {})
-            if annotations.get('vnd.docker.reference.type') == 'attestation-manifest':
-                continue
-            
-            platform = m.get('platform', {})
-            platform_str = f"{platform.get('os', 'linux')}/{platform.get('architecture', 'amd64')}"
-            if platform.get('variant'):
-                platform_str += f"/{platform.get('variant')}"
-            print(f"  - {platform_str}")
-            image_manifests.append(m)
-            last_platform_str = platform_str
-        
-        if len(image_manifests) == 1:
-            # Only one actual image manifest, use it directly
-            print(f"Using the only available platform: {last_platform_str}")
-            selected_manifest = image_manifests[0]
-            # We need to fetch the actual manifest content
-            digest = selected_manifest['digest']
-            manifest_url = 'https://{}/v2/{}/manifests/{}'.format(registry, repository, digest)
-            print(f"Fetching manifest from: {manifest_url}")
-            auth_head = get_auth_head(', '.join(accept_types), registry, repository, username, password, auth_url, reg_service)
-            resp = requests.get(manifest_url, headers=auth_head, verify=False)
-            if resp.status_code != 200:
-                print('Cannot fetch manifest [HTTP {}]'.format(resp.status_code))
-                print(f'Response: {resp.content}')
-                exit(1)
-            manifest = resp.json()
-        else:
-            print('Please specify a platform using --platform argument')
-            exit(1)
+        for m in image_manifests:
+            print(f"  - {format_platform(m.get('platform', {}))}")
+        if len(image_manifests) != 1:
+            print('Please specify a platform using --platform argument (comma separated for several), or --all-platforms')
+            return None
+        # Only one actual image manifest, use it directly
+        print(f"Using the only available platform: {format_platform(image_manifests[0].get('platform', {}))}")
+        selected = image_manifests
 
-    # Create image directory
-    imgdir = 'docker_{}_{}'.format(img, tag.replace(':', '_').replace('@', '_'))
-    if os.path.exists(imgdir):
-        shutil.rmtree(imgdir)
-    os.makedirs(imgdir)
+    # Platform manifests and configs are small, fetch them concurrently
+    with ThreadPoolExecutor(max_workers=max(1, min(len(selected), max_concurrent_downloads))) as platform_executor:
+        images = list(platform_executor.map(lambda m: fetch_platform_image(ref, m), selected))
+    if any(image is None for image in images):
+        return None
 
-    # Extract layers from manifest
-    if 'layers' in manifest:
-        layers = manifest['layers']
-    else:
-        print('Error: No layers found in manifest')
-        print(f'Manifest content: {manifest}')
-        exit(1)
+    # A docker archive holds one image, so each platform gets its own tar;
+    # an OCI layout lists every platform in one index
+    if output_format == 'docker' and len(images) > 1:
+        if archive_stdout_fd is not None:
+            print('ERROR: Several platforms need one docker archive each, use --format oci-archive to stream them together')
+            return None
+        return [{'ref': ref, 'images': [image], 'platform_suffix': '_' + format_platform(image['platform']).replace('/', '_')}
+                for image in images]
+    return [{'ref': ref, 'images': images, 'platform_suffix': ''}]
+
+def describe_target(target):
+    """Name a target in progress and summary output"""
+    if target['platform_suffix']:
+        return '{} ({})'.format(target['ref']['image'], format_platform(target['images'][0]['platform']))
+    return target['ref']['image']
+
+def write_image(target, output=None):
+    """Download the layers of a target through the shared pool and write its archive to output (default: named
+    after the image); returns the path written ('-' for stdout), or False"""
+    ref, images = target['ref'], target['images']
+    registry, repository, repo, img, tag = ref['registry'], ref['repository'], ref['repo'], ref['img'], ref['tag']
+
+    # Every selected platform goes into the archive; blobs they share are fetched and written once
+    layers = [layer for image in images for layer in image['layers']]
+    diff_ids = [diff_id for image in images for diff_id in image['diff_ids']]
 
     # Create repositories file
     repositories = '{{"{}":{{"{}":"{}"}}}}'.format(repo, img, tag)
-    with open(imgdir + '/repositories', 'w') as f:
-        f.write(repositories)
+
+    # Create manifest.json (docker format: exactly one image)
+    parentid = 'sha256:' + hashlib.sha256(''.encode()).hexdigest()
+    manifest_json = [{
+        'Config': 'config.json',
+        'RepoTags': ['{}:{}'.format(repository, tag)],
+        'Layers': ['{}/layer.tar'.format(hashlib.sha256((parentid + '\n' + layer['digest'] + '\n').encode()).hexdigest()) for layer in images[0]['layers']]
+    }]
+
+    # OCI image layout: registry blobs as-is under blobs/sha256, index.json pointing at the manifests
+    if output_format != 'docker':
+        image_name = '{}/{}{}{}'.format('docker.io' if registry == 'registry-1.docker.io' else registry, repository,
+                                        '@' if tag.startswith('sha256:') else ':', tag)
+        manifest_descriptors = []
+        for image in images:
+            descriptor = {
+                'mediaType': image['manifest'].get('mediaType', 'application/vnd.oci.image.manifest.v1+json'),
+                'digest': 'sha256:' + hashlib.sha256(image['manifest_content']).hexdigest(),
+                'size': len(image['manifest_content']),
+                'annotations': {'io.containerd.image.name': image_name}
+            }
+            if not tag.startswith('sha256:'):
+                descriptor['annotations']['org.opencontainers.image.ref.name'] = tag
+            if image['platform']:
+                descriptor['platform'] = image['platform']
+            manifest_descriptors.append(descriptor)
+
+    # The archive is written while layers download: each layer is appended as soon as it and
+    # every layer before it in the manifest are done; config and manifest.json go last,
+    # which docker load accepts. Output goes to a .tmp file renamed at the end, or to stdout.
+    # The oci format writes into a directory instead, with index.json written last.
+    default_output = claim_output_name(repo.replace('/', '_') + '_' + img + target['platform_suffix'] + ('_oci' if output_format != 'docker' else ''), tag)
+    if output and target['platform_suffix']:
+        root, ext = os.path.splitext(output)
+        output = root + target['platform_suffix'] + ext
+    if archive_stdout_fd is not None:
+        docker_tar = None
+        tmp_tar = None
+        tar_fd = archive_stdout_fd
+    elif output_format == 'oci':
+        docker_tar = output or default_output
+        tmp_tar = None
+        tar_fd = None
+    else:
+        docker_tar = output or default_output + '.tar'
+        tmp_tar = docker_tar + '.tmp'
+        tar_fd = os.open(tmp_tar, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    if output_format == 'oci':
+        archive = OCILayoutDirectoryWriter(docker_tar)
+    else:
+        archive = ImageArchiveWriter(tar_fd)
+    if output_format != 'docker':
+        archive.add_bytes('oci-layout', json.dumps({'imageLayoutVersion': '1.0.0'}).encode())
+        archive.add_dir('blobs')
+        archive.add_dir('blobs/sha256')
+
+    # Without the cache (or when it keeps layers compressed), finished layer.tar files wait in the
+    # work directory until the archive reaches them, so only let downloads run a bounded distance ahead
+    unique_digests = list(dict.fromkeys(layer['digest'] for layer in layers))
+    layer_diff_ids = {layer['digest']: diff_id for layer, diff_id in zip(layers, diff_ids)}
+    layer_by_digest = {layer['digest']: layer for layer in layers}
+    window = len(unique_digests) if use_cache and (cache_storage == 'tar' or output_format != 'docker') else max(max_concurrent_downloads * 2, max_concurrent_downloads + STREAM_READAHEAD_LAYERS)
+    remaining_uses = {digest: sum(1 for layer in layers if layer['digest'] == digest) for digest in unique_digests}
+
+    def cleanup_partial_archive():
+        # An oci directory is left as is: without a new index.json its previous content stays valid
+        if tmp_tar is not None:
+            os.close(tar_fd)
+            if os.path.exists(tmp_tar):
+                os.remove(tmp_tar)
 
     # Download layers concurrently
     print('Downloading {} layers...'.format(len(layers)))
     print('💡 提示: 按 Ctrl+C 可以随时中断下载\n')
 
+    layer_results = {}
+    archive_started, archive_time = None, 0.0   # for the archive phase of the metrics
+    acquired = target.pop('prefetched', {})   # digest -> shared download future this image still holds
+    transfer_stats['layers_referenced'] += len(layers)
+    failed = False
     try:
-        with ThreadPoolExecutor(max_workers=max_concurrent_downloads) as thread_executor:
-            executor = thread_executor
-            
-            future_to_layer = {thread_executor.submit(download_layer, layer, imgdir, 'sha256:' + hashlib.sha256(''.encode()).hexdigest()): layer for layer in layers}
+        emitted_digests = set()
+        next_submit = 0
+        next_emit = 0
+        while next_emit < len(layers) and not failed:
+            # 检查中断信号
+            if shutdown_event.is_set():
+                print('\n⚠️  下载已被用户中断')
+                failed = True
+                break
 
-            for future in as_completed(future_to_layer):
-                # 检查中断信号
-                if shutdown_event.is_set():
-                    print('\n⚠️  下载已被用户中断')
-                    break
-                    
-                layer = future_to_layer[future]
+            # Keep the shared pool fed, at most `window` unique layers ahead of the archive writer
+            while next_submit < len(unique_digests) and next_submit - len(emitted_digests) < window:
+                digest = unique_digests[next_submit]
+                if digest not in acquired:
+                    acquired[digest] = acquire_layer(ref, layer_by_digest[digest], parentid, layer_diff_ids[digest])
+                next_submit += 1
+
+            # Append every layer that is ready, in manifest order
+            while next_emit < len(layers) and layers[next_emit]['digest'] in layer_results:
+                digest = layers[next_emit]['digest']
+                result = layer_results[digest]
+                written = time.time()
+                archive_started = archive_started or written
+                if output_format == 'docker':
+                    archive.add_layer(result['fake_layerid'], result['layer_path'])
+                else:
+                    archive.add_file('blobs/sha256/' + digest.split(':', 1)[1], result['layer_path'])
+                archive_time += time.time() - written
+                emitted_digests.add(digest)
+                remaining_uses[digest] -= 1
+                if remaining_uses[digest] == 0:
+                    # Last use in this image: a temporary (uncached) file goes once no image needs it
+                    del acquired[digest]
+                    release_layer(digest)
+                next_emit += 1
+            if next_emit >= len(layers):
+                break
+
+            pending = {digest: future for digest, future in acquired.items() if digest not in layer_results}
+            finished = [digest for digest, future in pending.items() if future.done()]
+            if not finished:
+                wait(list(pending.values()), timeout=0.5, return_when=FIRST_COMPLETED)
+                continue
+
+            for digest in finished:
                 try:
-                    result = future.result()
+                    result = pending[digest].result()
                     if result:
-                        print('{}: Layer {} completed'.format(result['fake_layerid'][:12], result['layer']['digest'][7:19]))
+                        layer_results[digest] = result
+                        print('{}: Layer {} completed'.format(result['fake_layerid'][:12], digest[7:19]))
                     else:
-                        print('ERROR: Failed to download layer {}'.format(layer['digest'][7:19]))
+                        print('ERROR: Failed to download layer {}'.format(digest[7:19]))
+                        failed = True
                 except KeyboardInterrupt:
                     print('\n⚠️  下载被用户中断')
-                    break
+                    failed = True
                 except Exception as e:
-                    print('ERROR: Exception downloading layer {}: {}'.format(layer['digest'][7:19], str(e)))
-            
-            # 清除全局executor引用
-            executor = None
-            
+                    print('ERROR: Exception downloading layer {}: {}'.format(digest[7:19], str(e)))
+                    failed = True
+
     except KeyboardInterrupt:
         print('\n\n⚠️  下载被用户中断，正在清理...')
-        # 清理临时目录
-        if os.path.exists(imgdir):
-            shutil.rmtree(imgdir)
-            print(f'🗑️  已清理临时目录: {imgdir}')
-        print('✅ 清理完成，程序退出')
-        sys.exit(0)
+        # 清理未完成的镜像文件
+        cleanup_partial_archive()
+        print('✅ 清理完成')
+        return False
+    except OSError as e:
+        # e.g. the consumer of a stdout pipe went away
+        print(f'ERROR: Failed writing the image archive: {e}')
+        cleanup_partial_archive()
+        return False
+    finally:
+        # Layers not yet archived (failure or interruption) are given back to the shared pool
+        for digest in list(acquired):
+            release_layer(digest)
 
-    # Create manifest.json
-    manifest_json = [{
-        'Config': 'config.json',
-        'RepoTags': ['{}:{}'.format(repository, tag)],
-        'Layers': ['{}/layer.tar'.format(hashlib.sha256(('sha256:' + hashlib.sha256(''.encode()).hexdigest() + '\n' + layer['digest'] + '\n').encode()).hexdigest()) for layer in layers]
-    }]
+    if failed:
+        print('ERROR: Not all layers could be downloaded, the image archive is incomplete')
+        cleanup_partial_archive()
+        return False
+
+    print("Finishing archive...", end='', flush=True)
+    written = time.time()
+    try:
+        if output_format == 'docker':
+            archive.add_bytes('config.json', images[0]['config_content'])
+            archive.add_bytes('manifest.json', json.dumps(manifest_json).encode())
+            archive.add_bytes('repositories', repositories.encode())
+        else:
+            for image, descriptor in zip(images, manifest_descriptors):
+                archive.add_bytes('blobs/sha256/' + image['config_digest'].split(':', 1)[1], image['config_content'])
+                archive.add_bytes('blobs/sha256/' + descriptor['digest'].split(':', 1)[1], image['manifest_content'])
+            oci_index = {'schemaVersion': 2, 'mediaType': 'application/vnd.oci.image.index.v1+json', 'manifests': []}
+            with oci_index_lock:
+                if output_format == 'oci':
+                    # Keep other images (and other platforms of this one) already in the layout
+                    replaced = {(image_name, json.dumps(d.get('platform'), sort_keys=True)) for d in manifest_descriptors}
+                    try:
+                        with open(Path(docker_tar) / 'index.json', 'r') as f:
+                            oci_index['manifests'] = [m for m in json.load(f).get('manifests', [])
+                                                      if (m.get('annotations', {}).get('io.containerd.image.name'),
+                                                          json.dumps(m.get('platform'), sort_keys=True)) not in replaced]
+                    except (OSError, ValueError):
+                        pass
+                oci_index['manifests'].extend(manifest_descriptors)
+                archive.add_bytes('index.json', json.dumps(oci_index).encode())
+        archive.close()
+    except OSError as e:
+        print(f'\nERROR: Failed writing the image archive: {e}')
+        cleanup_partial_archive()
+        return False
+    if tar_fd is not None:
+        os.close(tar_fd)
+    if tmp_tar is not None:
+        os.replace(tmp_tar, docker_tar)
+    record_phase('archive', archive_started or written, time.time(), archive_time + time.time() - written)
 
-    with open(imgdir + '/manifest.json', 'w') as f:
-        json.dump(manifest_json, f)
+    if docker_tar:
+        # docker-daemon: needs a tag, an image pulled by digest gets :latest
+        daemon_ref = f"{img}:{'latest' if tag.startswith('sha256:') else tag}"
+        if output_format == 'oci':
+            print('\rOCI image layout written: ' + docker_tar)
+            print(f'You can copy it with: skopeo copy oci:{docker_tar} docker-daemon:{daemon_ref}')
+        elif output_format == 'oci-archive':
+            # Older docker engines can't docker load an OCI archive
+            print('\rOCI image archive written: ' + docker_tar)
+            print(f'You can load it with: podman load -i {docker_tar}, or skopeo copy oci-archive:{docker_tar} docker-daemon:{daemon_ref}')
+        else:
+            print('\rDocker image pulled: ' + docker_tar)
+            print('You can load it with: docker load < ' + docker_tar)
+    else:
+        kind = 'OCI image archive' if output_format == 'oci-archive' else 'Docker image'
+        print('\r{} streamed to stdout ({})'.format(kind, format_speed(archive.written)))
+    return docker_tar or '-'
 
-    # Save config blob
-    config_digest = manifest['config']['digest']
-    auth_head = get_auth_head('application/vnd.docker.container.image.v1+json', registry, repository, username, password, auth_url, reg_service)
-    resp = requests.get('https://{}/v2/{}/blobs/{}'.format(registry, repository, config_digest), headers=auth_head, verify=False)
-    if resp.status_code != 200:
-        print('Cannot fetch config blob [HTTP {}]'.format(resp.status_code))
-        if resp.status_code == 401:
-            print('Authentication failed. Please check your credentials.')
-            if not username or not password:
-                print('Private registry requires authentication. Use --username and --password arguments.')
-        elif resp.status_code == 403:
-            print('Access forbidden. You may not have permission to access this image.')
-        exit(1)
-
-    with open(imgdir + '/config.json', 'wb') as f:
-        f.write(resp.content)
-
-    # Create final tar file
-    docker_tar = repo.replace('/', '_') + '_' + img + '.tar'
-    sys.stdout.write("Creating archive...")
-    sys.stdout.flush()
-
-    tar = tarfile.open(docker_tar, "w")
-    tar.add(imgdir, arcname=os.path.sep)
-    tar.close()
-
-    # Clean up temporary directory
-    shutil.rmtree(imgdir)
-
-    print('\rDocker image pulled: ' + docker_tar)
-    print('You can load it with: docker load < ' + docker_tar)
-    print(f'\n🎉 下载完成！感谢使用 Docker Pull v{__version__}')
-    print(f'📦 开源项目: {__url__}')
+# `docker_pull.py serve`: the cache as a read-only Registry v2 endpoint for docker, containerd or docker_pull
+# on other machines. Manifests go through fetch_manifest (tags are revalidated upstream unless --offline),
+# blobs are sent from blobs/sha256 with Range support. A blob that isn't cached is downloaded upstream once
+# however many clients ask for it meanwhile: they all stream it from the partial file while it grows, and
+# it is published into the cache once its digest is verified.
+SERVE_READ_SIZE = 256 * 1024
+SERVE_FETCH_ATTEMPTS = 3
+SERVE_MAINTENANCE_INTERVAL = 60
+SERVE_NAME_PATTERN = re.compile(r'^(?:[A-Za-z0-9.-]+(?::[0-9]+)?/)?[a-z0-9]+(?:[._-]+[a-z0-9]+)*(?:/[a-z0-9]+(?:[._-]+[a-z0-9]+)*)*$')
+SERVE_REFERENCE_PATTERN = re.compile(r'^(?:[A-Za-z0-9_][A-Za-z0-9_.-]{0,127}|sha256:[a-f0-9]{64})$')
+
+serve_stats = {'manifests': 0, 'blob_hits': 0, 'blob_fetches': 0, 'blob_joins': 0, 'bytes_served': 0, 'errors': 0}
+serve_stats_lock = threading.Lock()
+serve_upstream = 'registry-1.docker.io'
+serve_allowed_registries = set()
+blob_fetches = {}
+blob_fetches_lock = threading.Lock()
+
+class ServeError(Exception):
+    """An error answered to the client in the Registry v2 format"""
+    def __init__(self, status, code, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.headers = headers or {}
+
+def count_serve(key, amount=1):
+    with serve_stats_lock:
+        serve_stats[key] += amount
+
+def serve_log(message):
+    with progress_lock:
+        print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+def serve_reference(name):
+    """The upstream image behind a repository name: names starting with a registry host (quay.io/org/app,
+    10.0.0.5:5000/team/app) proxy that registry if it is --upstream or in --allow-registry, the others
+    --upstream (library/ is added for Docker Hub)"""
+    first = name.split('/', 1)[0]
+    if '/' in name and ('.' in first or ':' in first):
+        # Not an open proxy: clients only reach the registries the operator chose (cached images stay servable offline)
+        if first != serve_upstream and first not in serve_allowed_registries and not offline_mode:
+            raise ServeError(403, 'DENIED', f'{first} is not proxied here (allowed: {", ".join([serve_upstream, *sorted(serve_allowed_registries)])})')
+    elif serve_upstream != 'registry-1.docker.io':
+        name = f'{serve_upstream}/{name}'
+    ref = parse_image_reference(name)
+    # Registries other than --upstream never get the credentials, so find their own token endpoint
+    ref['auth_url'], ref['reg_service'] = resolve_registry_auth(ref['registry'], anonymous=ref['registry'] != serve_upstream)
+    return ref
+
+def parse_serve_range(header, size):
+    """(start, end) of a single bytes range, or None to send the whole blob"""
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[6:].strip().partition('-')
+    try:
+        if first:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        else:
+            start, end = max(0, size - int(last)), size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ServeError(416, 'BLOB_UNKNOWN', f'Range {header} not satisfiable', {'Content-Range': f'bytes */{size}'})
+    return start, end
+
+class UpstreamBlob:
+    """The one upstream download of a blob missing from the cache; every client asking for it while it runs
+    reads the partial file up to `available`"""
+
+    def __init__(self, ref, digest):
+        self.ref = ref
+        self.digest = digest
+        self.path = partial_cache_dir / f"{digest.replace(':', '_')}.{unique_tmp_suffix()}.serve"
+        self.size = None
+        self.available = 0
+        self.finished = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        try:
+            # Another process (a pull, or a second server on this cache) may be downloading it already
+            with CacheDigestLock(self.digest):
+                with self.condition:
+                    cached = check_blob_cache(self.digest)
+                    if cached is not None:
+                        self.path, self.size, self.available = cached, cached.stat().st_size, cached.stat().st_size
+                        self.finished = True
+                if cached is None:
+                    with download_slots:
+                        self._download()
+        except BaseException as e:
+            with self.condition:
+                self.error = e
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            serve_log(f"❌ {self.digest[7:19]}: upstream download failed: {e}")
+        finally:
+            with blob_fetches_lock:
+                blob_fetches.pop(self.digest, None)
+            with self.condition:
+                self.condition.notify_all()
+
+    def _download(self):
+        sha256_hash = hashlib.sha256()
+        start_time = time.time()
+        with open(self.path, 'wb') as blob_file:
+            for attempt_number in range(SERVE_FETCH_ATTEMPTS):
+                try:
+                    with get_mirror_set(self.ref['registry']).attempt(self.ref, {'digest': self.digest, 'size': self.size or 0}) as attempt:
+                        with get_registry_limiter(attempt.source['registry']):
+                            received = self._receive(attempt, blob_file, sha256_hash)
+                        attempt.succeeded(received)
+                    break
+                except (requests.RequestException, RetryError) as e:
+                    if attempt_number == SERVE_FETCH_ATTEMPTS - 1 or shutdown_event.is_set():
+                        raise
+                    serve_log(f"⚠️  {self.digest[7:19]}: {e}, resuming at {format_speed(self.available)}")
+                    time.sleep(2 ** attempt_number)
+        verify_blob_digest(self.digest, 'sha256:' + sha256_hash.hexdigest())
+        with self.condition:
+            self.path = publish_blob(self.digest, self.path, str(partial_cache_dir))
+            self.size = self.available
+            self.finished = True
+        elapsed = time.time() - start_time
+        serve_log(f"✅ {self.digest[7:19]}: cached {format_speed(self.available)} in {format_time(elapsed)} "
+                  f"({format_speed(self.available / elapsed if elapsed > 0 else 0)}/s)")
+
+    def _receive(self, attempt, blob_file, sha256_hash):
+        """Append the rest of the blob from one endpoint to the partial file; returns the bytes received"""
+        source = attempt.source
+        offset = self.available
+        range_head = {'Range': f'bytes={offset}-'} if offset else None
+        resp = registry_get(source, registry_url(source, 'blobs', self.digest), 'application/octet-stream', range_head, stream=True, timeout=30)
+        received = 0
+        try:
+            skip = 0
+            if resp.status_code == 206 and parse_content_range_start(resp.headers.get('Content-Range')) == offset:
+                total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+            elif resp.status_code == 200:
+                # Range ignored: drop what the partial file already holds
+                skip = offset
+                total = resp.headers.get('Content-Length')
+            elif resp.status_code in (401, 403, 404) and not attempt.alternatives:
+                raise ServeError(404, 'BLOB_UNKNOWN', f'{self.digest} not found upstream (HTTP {resp.status_code})')
+            else:
+                raise RetryError(f'HTTP {resp.status_code} from {attempt.endpoint.name}')
+            with self.condition:
+                if self.size is None and total and total.isdigit():
+                    self.size = int(total)
+                    self.condition.notify_all()
+
+            for chunk in resp.iter_content(chunk_size=read_chunk_size):
+                if shutdown_event.is_set():
+                    raise KeyboardInterrupt("Download interrupted by user")
+                if skip:
+                    dropped = min(skip, len(chunk))
+                    chunk, skip = chunk[dropped:], skip - dropped
+                    if not chunk:
+                        continue
+                blob_file.write(chunk)
+                blob_file.flush()
+                sha256_hash.update(chunk)
+                received += len(chunk)
+                with self.condition:
+                    self.available += len(chunk)
+                    self.condition.notify_all()
+                pause = account_chunk(len(chunk))
+                if pause:
+                    time.sleep(pause)
+            if self.size is not None and self.available != self.size:
+                raise RetryError(f'{self.digest[7:19]}: connection closed at {self.available}/{self.size} bytes')
+            return received
+        finally:
+            resp.close()
+            with progress_lock:
+                transfer_stats['bytes_downloaded'] += received
+
+def join_blob_fetch(ref, digest):
+    """Return (download, joined): the running upstream download of a blob, started here unless another client did"""
+    with blob_fetches_lock:
+        fetch = blob_fetches.get(digest)
+        if fetch is not None:
+            return fetch, True
+        fetch = blob_fetches[digest] = UpstreamBlob(ref, digest)
+    fetch.start()
+    return fetch, False
+
+class RegistryRequestHandler(BaseHTTPRequestHandler):
+    """GET/HEAD of /v2/, /v2/<name>/manifests/<reference> and /v2/<name>/blobs/<digest>"""
+    protocol_version = 'HTTP/1.1'
+    server_version = f'docker_pull/{__version__}'
+
+    def log_message(self, format, *args):
+        pass  # requests worth logging go through serve_log
+
+    def send_body(self, status, body=b'', headers=None):
+        self.send_response(status)
+        self.send_header('Docker-Distribution-API-Version', 'registry/2.0')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        path = urllib.parse.unquote(self.path.split('?', 1)[0])
+        try:
+            if path in ('/v2', '/v2/'):
+                return self.send_body(200, b'{}', {'Content-Type': 'application/json'})
+            name, _, reference = path[len('/v2/'):].rpartition('/')
+            name, _, kind = name.rpartition('/')
+            if not path.startswith('/v2/') or kind not in ('manifests', 'blobs') or not SERVE_NAME_PATTERN.match(name):
+                raise ServeError(404, 'NAME_UNKNOWN', f'Unknown repository or endpoint: {path}')
+            if not SERVE_REFERENCE_PATTERN.match(reference) or (kind == 'blobs' and not reference.startswith('sha256:')):
+                raise ServeError(400, 'DIGEST_INVALID' if kind == 'blobs' else 'TAG_INVALID', f'Invalid reference: {reference}')
+            if kind == 'manifests':
+                self.serve_manifest(name, reference)
+            else:
+                self.serve_blob(name, reference)
+        except ServeError as e:
+            count_serve('errors')
+            if e.status >= 500:
+                serve_log(f"❌ {self.command} {path}: {e}")
+            body = json.dumps({'errors': [{'code': e.code, 'message': str(e)}]}).encode()
+            self.send_body(e.status, body, {'Content-Type': 'application/json', **e.headers})
+        except (requests.RequestException, RetryError) as e:
+            count_serve('errors')
+            serve_log(f"❌ {self.command} {path}: upstream error: {e}")
+            body = json.dumps({'errors': [{'code': 'UNAVAILABLE', 'message': f'upstream error: {e}'}]}).encode()
+            self.send_body(502, body, {'Content-Type': 'application/json'})
+        except OSError:
+            # The client went away, or a blob stream broke after its headers were sent
+            self.close_connection = True
+
+    def serve_manifest(self, name, reference):
+        ref = serve_reference(name)
+        resp = fetch_manifest(ref, reference, ', '.join(accept_types))
+        if resp.status_code != 200:
+            if resp.status_code in (401, 403, 404, 504):
+                raise ServeError(404, 'MANIFEST_UNKNOWN', f'{name}:{reference} is not cached and not available upstream (HTTP {resp.status_code})')
+            raise ServeError(502, 'UNAVAILABLE', f'{name}:{reference}: upstream answered HTTP {resp.status_code}')
+        content = resp.content
+        manifest = json.loads(content)
+        media_type = manifest.get('mediaType') or ('application/vnd.oci.image.index.v1+json' if 'manifests' in manifest
+                                                   else 'application/vnd.oci.image.manifest.v1+json')
+        digest = 'sha256:' + hashlib.sha256(content).hexdigest()
+        count_serve('manifests')
+        serve_log(f"📋 {self.address_string()} {name}:{reference} -> {digest[7:19]}")
+        self.send_body(200, content, {'Content-Type': media_type, 'Docker-Content-Digest': digest})
+
+    def send_blob_headers(self, digest, size):
+        """Send the 200 or 206 headers of a blob; returns the (start, end) byte range to send"""
+        byte_range = parse_serve_range(self.headers.get('Range'), size)
+        start, end = byte_range or (0, size - 1)
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Docker-Distribution-API-Version', 'registry/2.0')
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Docker-Content-Digest', digest)
+        self.send_header('Accept-Ranges', 'bytes')
+        if byte_range:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        return start, end
+
+    def serve_blob(self, name, digest):
+        blob_file = check_blob_cache(digest)
+        # Image configs are kept with the manifests
+        content = read_cached_manifest_blob(digest) if blob_file is None else None
+        if blob_file is not None or content is not None:
+            count_serve('blob_hits')
+            size = blob_file.stat().st_size if blob_file is not None else len(content)
+            start, end = self.send_blob_headers(digest, size)
+            if self.command == 'HEAD':
+                return
+            if content is not None:
+                self.wfile.write(content[start:end + 1])
+            else:
+                with open(blob_file, 'rb') as f:
+                    # sendfile(2) for plain HTTP, a copy loop under TLS
+                    self.connection.sendfile(f, start, end - start + 1)
+            count_serve('bytes_served', end - start + 1)
+            return
+        if offline_mode:
+            raise ServeError(404, 'BLOB_UNKNOWN', f'{digest} is not cached (offline)')
+
+        fetch, joined = join_blob_fetch(serve_reference(name), digest)
+        count_serve('blob_joins' if joined else 'blob_fetches')
+        serve_log(f"{'🔗' if joined else '⬇️ '} {self.address_string()} {name}@{digest[7:19]}: "
+                  f"{'joined the running upstream download' if joined else 'not cached, fetching upstream'}")
+        self.send_fetched_blob(fetch)
+
+    def send_fetched_blob(self, fetch):
+        """Stream a blob from its upstream download, waiting for the bytes that haven't arrived yet"""
+        with fetch.condition:
+            while fetch.size is None and fetch.error is None:
+                fetch.condition.wait()
+            if fetch.error is not None and not fetch.finished:
+                if isinstance(fetch.error, (ServeError, requests.RequestException, RetryError)):
+                    raise fetch.error
+                raise ServeError(502, 'UNAVAILABLE', f'{fetch.digest}: upstream download failed')
+            blob_file = open(fetch.path, 'rb')
+        with blob_file:
+            start, end = self.send_blob_headers(fetch.digest, fetch.size)
+            if self.command == 'HEAD':
+                return
+            position = start
+            while position <= end:
+                with fetch.condition:
+                    while fetch.available <= position and fetch.error is None:
+                        fetch.condition.wait()
+                    if fetch.error is not None:
+                        # Headers are out, all that is left is to cut the connection
+                        count_serve('errors')
+                        self.close_connection = True
+                        return
+                    available = fetch.available
+                blob_file.seek(position)
+                data = blob_file.read(min(SERVE_READ_SIZE, available - position, end + 1 - position))
+                self.wfile.write(data)
+                position += len(data)
+                count_serve('bytes_served', len(data))
+
+class ThreadingRegistryServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+def serve_maintenance():
+    """Merge cache hits into the index now and then, and keep the cache under --cache-max-size"""
+    while not shutdown_event.wait(SERVE_MAINTENANCE_INTERVAL):
+        try:
+            flush_cache_access()
+            if cache_max_size:
+                gc_result = collect_cache_garbage(cache_max_size, cache_policy)
+                if gc_result['evicted']:
+                    serve_log(f"🧹 Evicted {len(gc_result['evicted'])} entries ({format_speed(gc_result['freed'])}) to stay under {format_speed(cache_max_size)}")
+        except OSError as e:
+            serve_log(f"Warning: Could not update the cache index: {e}")
+
+def serve_registry(listen: str = '127.0.0.1:5000', upstream: str = 'registry-1.docker.io', tls_cert: Optional[str] = None,
+                   tls_key: Optional[str] = None, allowed_registries: Iterable[str] = ()) -> int:
+    """Serve the cache on listen ([HOST:]PORT) until interrupted; returns the exit code"""
+    global serve_upstream, serve_allowed_registries, credential_registry
+    serve_upstream = credential_registry = upstream
+    serve_allowed_registries = set(allowed_registries)
+    host, _, port = listen.rpartition(':')
+    host = host.strip('[]') or '127.0.0.1'
+    if not port.isdigit():
+        print(f"❌ 错误: 无效的 --listen: {listen}")
+        return 1
+    if ':' in host:
+        ThreadingRegistryServer.address_family = socket.AF_INET6
+    try:
+        server = ThreadingRegistryServer((host, int(port)), RegistryRequestHandler)
+    except OSError as e:
+        print(f"❌ 错误: 无法监听 {listen}: {e}")
+        return 1
+    scheme = 'http'
+    if tls_cert:
+        import ssl
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(tls_cert, tls_key)
+        # The handshake happens in the request thread, a slow client doesn't hold up accept()
+        server.socket = context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+        scheme = 'https'
+    partial_cache_dir.mkdir(parents=True, exist_ok=True)
+
+    source = 'offline, cache only' if offline_mode else f'pull-through from {", ".join([serve_upstream, *sorted(serve_allowed_registries)])}'
+    print(f"🛰️  Serving {cache_dir} as a read-only registry on {scheme}://{host}:{port} ({source})")
+    print(f"   docker pull <this host>:{port}/library/nginx:latest")
+    if scheme == 'http':
+        print(f'   Docker needs "insecure-registries": ["<this host>:{port}"] in /etc/docker/daemon.json for plain HTTP')
+    print(f"   Blobs are served from {blobs_cache_dir}: populate it with --format oci or --cache-storage blob pulls,")
+    print(f"   layers only kept as layer.tar are fetched from upstream again the first time they are asked for")
+    threading.Thread(target=serve_maintenance, daemon=True).start()
+    serve_start = time.time()
+    try:
+        server.serve_forever()
+    finally:
+        shutdown_event.set()
+        server.server_close()
+        try:
+            flush_cache_access()
+        except OSError:
+            pass
+        elapsed = time.time() - serve_start
+        print(f"\n📊 Serve Summary ({format_time(elapsed)}):")
+        print(f"   Manifests: {serve_stats['manifests']}, blobs from cache: {serve_stats['blob_hits']}, "
+              f"fetched upstream: {serve_stats['blob_fetches']} ({serve_stats['blob_joins']} requests joined a running download)")
+        print(f"   Served: {format_speed(serve_stats['bytes_served'])}, downloaded: {format_speed(transfer_stats['bytes_downloaded'])}, errors: {serve_stats['errors']}")
+    return 0
+
+workdir = None
+
+def open_pull_session():
+    """Create the work directory, the shared layer download pool and (--engine async) the event loop"""
+    global workdir, executor
+    reset_metrics()
+    # Downloaded layers land in the cache (or a temporary directory with --no-cache);
+    # the final archives are written straight from there without a staging directory
+    if use_cache:
+        workdir = str(partial_cache_dir)
+        os.makedirs(workdir, exist_ok=True)
+    else:
+        workdir = tempfile.mkdtemp(prefix='docker_pull_', dir='.')
+    executor = ThreadPoolExecutor(max_workers=max_concurrent_downloads)
+    if download_engine == 'async':
+        start_async_engine()
+    dashboard.start(progress_mode)
+
+def close_pull_session():
+    """Stop the download pool and the event loop, and remove the --no-cache work directory"""
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=False)
+        executor = None
+    stop_async_engine()
+    dashboard.stop()
+    # 清理临时目录
+    if not use_cache and workdir and os.path.exists(workdir):
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def maintain_cache():
+    """Record the cache hits so far in the index, then keep the cache under --cache-max-size"""
+    if not use_cache:
+        return
+    try:
+        flush_cache_access()
+        if cache_max_size:
+            gc_result = collect_cache_garbage(cache_max_size, cache_policy)
+            if gc_result['evicted']:
+                print(f"   Evicted: {len(gc_result['evicted'])} entries ({format_speed(gc_result['freed'])}) to stay under {format_speed(cache_max_size)}")
+            if gc_result['total'] > cache_max_size:
+                print(f"   ⚠️  Cache is {format_speed(gc_result['total'])}, over --cache-max-size: the rest is in use or was used in the last {format_time(CACHE_EVICT_MIN_IDLE)}")
+    except OSError as e:
+        print(f"Warning: Could not update the cache index: {e}")
+
+def image_reference(image_arg: str) -> Dict[str, str]:
+    """parse_image_reference plus the token endpoint of the registry"""
+    ref = parse_image_reference(image_arg)
+    ref['auth_url'], ref['reg_service'] = resolve_registry_auth(ref['registry'])
+    return ref
+
+def pull_images(image_args, output=None, max_concurrent_images=4) -> bool:
+    """Pull every image, sharing one download pool, then print the run summary; returns True if all were pulled"""
+    # One process, one connection pool and one layer scheduler for every requested image
+    run_start = time.time()
+    image_results = []
+    open_pull_session()
+    try:
+        refs = [image_reference(image_arg) for image_arg in dict.fromkeys(image_args)]
+        if len(refs) == 1:
+            targets = resolve_image(refs[0])
+        if len(refs) == 1 and targets is not None and len(targets) == 1:
+            image_results.append((describe_target(targets[0]), write_image(targets[0], output)))
+        else:
+            # Resolve every image (and platform), then assemble the archives concurrently;
+            # an archive starts as soon as its image is resolved
+            with ThreadPoolExecutor(max_workers=max(1, max_concurrent_images)) as image_executor:
+                if len(refs) == 1:
+                    resolved = {refs[0]['image']: targets}
+                else:
+                    print(f'Pulling {len(refs)} images, sharing layer downloads between them...\n')
+                    resolve_futures = {image_executor.submit(resolve_image, ref): ref for ref in refs}
+                    resolved = {}
+                    for future in as_completed(resolve_futures):
+                        ref = resolve_futures[future]
+                        try:
+                            resolved[ref['image']] = future.result()
+                        except Exception as e:
+                            print(f'ERROR: Failed to resolve {ref["image"]}: {e}')
+                            resolved[ref['image']] = None
+                write_futures = {}
+                for image, image_targets in resolved.items():
+                    if image_targets is None:
+                        print(f'❌ {image}')
+                        image_results.append((image, False))
+                        continue
+                    for target in image_targets:
+                        write_futures[image_executor.submit(write_image, target, output)] = target
+                for future in as_completed(write_futures):
+                    name = describe_target(write_futures[future])
+                    try:
+                        ok = future.result()
+                    except Exception as e:
+                        print(f'ERROR: Failed to pull {name}: {e}')
+                        ok = False
+                    print(f'{"✅" if ok else "❌"} {name}')
+                    image_results.append((name, ok))
+    finally:
+        close_pull_session()
+    run_elapsed = time.time() - run_start
+    failed_images = [name for name, ok in image_results if not ok]
+
+    if not failed_images:
+        print(f'\n🎉 下载完成！感谢使用 Docker Pull v{__version__}')
+        print(f'📦 开源项目: {__url__}')
 
     # Display cache statistics
     if use_cache and (cache_stats['hits'] > 0 or cache_stats['misses'] > 0):
@@ -973,4 +4881,269 @@ else:
                 print(f"   Data saved: {saved_mb/1024:.1f} GB")
             else:
                 print(f"   Data saved: {saved_mb:.1f} MB")
-        print(f"   Cache location: {cache_dir}")
\ No newline at end of file
+        print(f"   Cache location: {cache_dir}")
+
+    # Record this run's hits in the cache index, then keep the cache under --cache-max-size
+    maintain_cache()
+
+    # Display manifest cache statistics
+    if use_cache and (manifest_stats['cache_hits'] > 0 or manifest_stats['fetched'] > 0):
+        print(f"\n📋 Manifest Cache:")
+        print(f"   Served from cache: {manifest_stats['cache_hits']} ({manifest_stats['revalidated']} tag(s) revalidated with HEAD)")
+        print(f"   Fetched from registry: {manifest_stats['fetched']}")
+
+    # Display authentication statistics
+    if auth_stats['token_fetches'] > 0 or auth_stats['token_reuses'] > 0:
+        total_requests = auth_stats['token_fetches'] + auth_stats['token_reuses']
+        print(f"\n🔑 Auth Statistics:")
+        print(f"   Token fetches: {auth_stats['token_fetches']} (reused cached token for {auth_stats['token_reuses']}/{total_requests} requests)")
+    # Display aggregate transfer statistics for the whole run
+    print(f"\n📊 Transfer Summary:")
+    if len(image_results) > 1:
+        print(f"   Images: {len(image_results) - len(failed_images)}/{len(image_results)} pulled")
+        for image in failed_images:
+            print(f"   ❌ Failed: {image}")
+    if transfer_stats['layers_shared'] > 0:
+        print(f"   Layers: {transfer_stats['layers_referenced']} referenced, {transfer_stats['layers_shared']} shared with another image's download")
+    # Same layer records as --metrics-json: every byte received, retries included
+    with metrics_lock:
+        downloaded = sum(record['bytes'] for record in layer_metrics.values())
+        wasted = sum(record['wasted'] for record in layer_metrics.values())
+    speed = downloaded / run_elapsed if run_elapsed > 0 else 0
+    wasted_note = f", {format_speed(wasted)} of it discarded and downloaded again" if wasted else ''
+    print(f"   Downloaded: {format_speed(downloaded)} in {format_time(run_elapsed)} ({format_speed(speed)}/s{wasted_note})")
+    for mirror_set in mirror_sets.values():
+        served = [endpoint for endpoint in mirror_set.endpoints if endpoint.blobs]
+        if len(mirror_set.endpoints) > 1 and served:
+            print(f"   Served by: " + ', '.join(f"{endpoint.name} {endpoint.blobs} layers ({format_speed(endpoint.bytes)})" for endpoint in served))
+    with metrics_lock:
+        connections = dict(connection_stats)
+    if connections['requests']:
+        reused = max(0, connections['requests'] - connections['connections'])
+        http2_note = f", {connections['http2']} over HTTP/2" if connections['http2'] else ''
+        print(f"   Connections: {connections['connections']} opened for {connections['requests']} requests ({reused} reused{http2_note})")
+    if adaptive_concurrency:
+        best_rate = download_slots.observed_best_rate()
+        best_note = f", best {format_speed(best_rate)}/s" if best_rate else ''
+        print(f"   Concurrency: settled at {download_slots.limit} concurrent downloads (adaptive, peak {download_slots.peak}{best_note})")
+    report_metrics(image_results)
+
+    return not failed_images
+
+def prefetch_layers(target) -> bool:
+    """Download every layer of a target through the shared pool ahead of write_image, which takes over the claims;
+    returns True if all of them are available"""
+    parentid = 'sha256:' + hashlib.sha256(''.encode()).hexdigest()
+    held = target.setdefault('prefetched', {})
+    for image in target['images']:
+        for layer, diff_id in zip(image['layers'], image['diff_ids']):
+            if layer['digest'] not in held:
+                held[layer['digest']] = acquire_layer(target['ref'], layer, parentid, diff_id)
+    ok = True
+    for digest, future in held.items():
+        try:
+            ok = bool(future.result()) and ok
+        except Exception as e:
+            print('ERROR: Exception downloading layer {}: {}'.format(digest[7:19], str(e)))
+            ok = False
+    return ok
+
+def release_prefetched_layers(target):
+    """Give back the layer claims of a target prefetched but never written"""
+    for digest in target.pop('prefetched', {}):
+        release_layer(digest)
+
+class PullError(Exception):
+    """An image could not be resolved, downloaded or written (the details went to the output or the Puller's log)"""
+    pass
+
+# The Puller whose settings are in the module globals, until it is closed
+active_puller = None
+
+class Puller:
+    """Pull images from Python, reusing one HTTP session, the bearer tokens, registry probes and manifest cache and
+    the download pool across calls. Options are the long command line options as keyword arguments, e.g.
+    Puller(platform='linux/arm64', cache_dir='/data/cache', format='oci'). The settings live in module globals,
+    so there is one active Puller per process: creating another before close() raises RuntimeError.
+    Nothing is printed unless log is a text stream for the messages (e.g. sys.stderr); progress defaults to 'none'.
+
+        with Puller(cache_dir='/data/cache') as puller:
+            for target in puller.resolve('nginx:latest'):
+                puller.fetch_layers(target)
+                puller.write_archive(target, 'nginx.tar')
+    """
+
+    def __init__(self, log=None, **options):
+        global active_puller
+        defaults = {**vars(parser.parse_args([])), 'progress': 'none'}
+        unknown = sorted(set(options) - set(defaults))
+        if unknown:
+            raise TypeError(f"Unknown option(s): {', '.join(unknown)}")
+        if active_puller is not None:
+            raise RuntimeError('Another Puller is active in this process, close it first')
+        self.log = log
+        self.targets = []
+        self.results = []
+        active_puller = self
+        try:
+            configure(argparse.Namespace(**{**defaults, **options}))
+            open_pull_session()
+        except BaseException:
+            active_puller = None
+            raise
+
+    def resolve(self, image: str) -> list:
+        """Fetch the manifests and configs of an image; returns its targets, one per archive to write
+        (a docker-format pull of several platforms has one per platform)"""
+        targets = resolve_image(image_reference(image))
+        if targets is None:
+            self.results.append((image, False))
+            raise PullError(f'Cannot resolve {image}')
+        self.targets.extend(targets)
+        return targets
+
+    def fetch_layers(self, target):
+        """Download the layers of a target into the cache (or the work directory with no_cache=True)"""
+        if not prefetch_layers(target):
+            raise PullError(f'Cannot download the layers of {describe_target(target)}')
+
+    def write_archive(self, target, output: Optional[str] = None) -> str:
+        """Write the archive of a target, downloading what fetch_layers didn't; returns its path"""
+        try:
+            path = write_image(target, output)
+        finally:
+            release_prefetched_layers(target)
+            if target in self.targets:
+                self.targets.remove(target)
+        self.results.append((describe_target(target), bool(path)))
+        if not path:
+            raise PullError(f'Cannot pull {describe_target(target)}')
+        return path
+
+    def pull(self, image: str, output: Optional[str] = None) -> list:
+        """Resolve an image and write its archives; returns their paths"""
+        return [self.write_archive(target, output) for target in self.resolve(image)]
+
+    def metrics(self) -> Dict[str, Any]:
+        """Per-layer timings and run phases so far (the content of --metrics-json)"""
+        return collect_metrics(self.results)
+
+    def close(self):
+        """Release what was never written, stop the download pool, record the cache hits and write the
+        metrics files asked for"""
+        global active_puller
+        if active_puller is not self:
+            return
+        try:
+            for target in self.targets:
+                release_prefetched_layers(target)
+            self.targets = []
+            close_pull_session()
+            maintain_cache()
+            report_metrics(self.results)
+        finally:
+            active_puller = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_image_list(args) -> list:
+    """Images to pull: positional arguments plus one reference per line of --images-file"""
+    image_args = list(args.image)
+    if args.images_file:
+        with open(args.images_file, 'r') as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    image_args.append(line)
+    return image_args
+
+def main(argv=None) -> int:
+    """Command line entry point; returns the exit code"""
+    global archive_stdout_fd
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv[:1] == ['serve']:
+        # The pull options keep their defaults, the cache is always on
+        args = parser.parse_args([])
+        vars(args).update(vars(serve_parser.parse_args(argv[1:])))
+        args.serve = True
+    elif argv[:1] == ['cache']:
+        # Every pull option keeps its default in cache mode
+        args = parser.parse_args([])
+        vars(args).update(vars(cache_parser.parse_args(argv[1:])))
+        if not args.cache_command:
+            cache_parser.print_help()
+            return 1
+    else:
+        args = parser.parse_args(argv)
+    if args.format == 'oci' and args.output == '-':
+        parser.error('--format oci writes a directory, use --format oci-archive to stream to stdout')
+
+    # 输出到stdout时，图像tar独占原始stdout，所有日志改写到stderr
+    if args.output == '-':
+        archive_stdout_fd = os.dup(sys.stdout.fileno())
+        if sys.platform == 'win32':
+            import msvcrt
+            msvcrt.setmode(archive_stdout_fd, os.O_BINARY)
+        sys.stdout = sys.stderr
+
+    # 处理版本信息显示
+    if args.version:
+        show_version()
+        return 0
+
+    # 检查是否提供了镜像参数或导入tar文件
+    if not args.image and not args.images_file and not args.import_tar and not args.cache_command and not args.serve:
+        show_banner()
+        parser.print_help()
+        print(f"\n💡 示例用法:")
+        print(f"   python docker_pull.py nginx:latest")
+        print(f"   python docker_pull.py --platform linux/arm64 ubuntu:20.04")
+        print(f"   python docker_pull.py --images-file images.txt")
+        print(f"   python docker_pull.py --import-tar xxx.tar")
+        print(f"   python docker_pull.py cache gc --max-size 200G")
+        print(f"   python docker_pull.py serve --listen 0.0.0.0:5000")
+        print(f"   python docker_pull.py --version")
+        return 1
+
+    # 注册信号处理器
+    signal.signal(signal.SIGINT, signal_handler)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, signal_handler)
+
+    # 导入tar文件和cache子命令只需要缓存目录
+    if args.import_tar or args.cache_command:
+        configure_cache_dir(args.cache_dir)
+        if args.cache_command:
+            return run_cache_command(args)
+        print(f"\n🔄 Docker tar文件导入模式")
+        import_docker_tar_to_cache(args.import_tar)
+        return 0
+
+    show_banner()
+    try:
+        image_args = read_image_list(args)
+    except OSError as e:
+        print(f"❌ 错误: 无法读取镜像列表 {args.images_file}: {e}")
+        return 1
+    if not image_args and not args.serve:
+        print("❌ 错误: 没有要下载的镜像")
+        return 1
+    if len(image_args) > 1 and args.output and (args.output == '-' or args.format != 'oci'):
+        print("❌ 错误: 多个镜像时 -o 只能与 --format oci 一起使用（所有镜像写入同一个OCI目录）")
+        return 1
+    try:
+        configure(args)
+    except ValueError as e:
+        print(f"❌ 错误: {e}")
+        return 1
+
+    if args.serve:
+        return serve_registry(args.listen, args.upstream, args.tls_cert, args.tls_key, args.allow_registry)
+    return 0 if pull_images(image_args, args.output, args.max_concurrent_images) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地模拟镜像仓库 (Registry v2)
+提供确定性的合成镜像（相同参数的多个实例内容完全一致，可充当彼此的镜像源），
+可注入延迟、带宽限制、429限流、断流、损坏数据和缺失的层，用于离线测试镜像源切换、并发和断点续传
+"""
+
+import io
+import sys
+import json
+import gzip
+import time
+import random
+import hashlib
+import tarfile
+import argparse
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+MANIFEST_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
+TOKEN = 'mock-registry-token'
+
+def parse_size(value: str) -> int:
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def make_layer(index: int, size: int, seed: int):
+    """A gzip layer holding one file of size bytes, half random and half compressible; returns (blob, diff_id)"""
+    rnd = random.Random(seed * 1000003 + index)
+    random_part = size // 2
+    data = rnd.getrandbits(random_part * 8).to_bytes(random_part, 'little') if random_part else b''
+    data += (f'layer {index} '.encode() * (size // 8 + 1))[:size - random_part]
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        info = tarfile.TarInfo(f'layer{index}.bin')
+        info.size = len(data)
+        info.mtime = 0
+        tar.addfile(info, io.BytesIO(data))
+    raw = buf.getvalue()
+    return gzip.compress(raw, mtime=0), 'sha256:' + hashlib.sha256(raw).hexdigest()
+
+def build_image(layer_count: int, layer_size: int, seed: int):
+    """Synthetic single-platform image; returns (manifest bytes, {digest: blob bytes})"""
+    blobs = {}
+    layers = []
+    diff_ids = []
+    for index in range(layer_count):
+        blob, diff_id = make_layer(index, layer_size, seed)
+        digest = 'sha256:' + hashlib.sha256(blob).hexdigest()
+        blobs[digest] = blob
+        layers.append({'mediaType': 'application/vnd.docker.image.rootfs.diff.tar.gzip', 'size': len(blob), 'digest': digest})
+        diff_ids.append(diff_id)
+    config = json.dumps({'architecture': 'amd64', 'os': 'linux', 'config': {'Cmd': ['/bin/sh']},
+                         'rootfs': {'type': 'layers', 'diff_ids': diff_ids}}).encode()
+    config_digest = 'sha256:' + hashlib.sha256(config).hexdigest()
+    blobs[config_digest] = config
+    manifest = json.dumps({'schemaVersion': 2, 'mediaType': MANIFEST_TYPE,
+                           'config': {'mediaType': 'application/vnd.docker.container.image.v1+json', 'size': len(config), 'digest': config_digest},
+                           'layers': layers}).encode()
+    return manifest, blobs
+
+def self_signed_certificate():
+    """Create a throwaway certificate for 127.0.0.1/localhost with the openssl command; returns (certfile, keyfile)"""
+    directory = Path(tempfile.mkdtemp(prefix='mock_registry_'))
+    certfile, keyfile = directory / 'cert.pem', directory / 'key.pem'
+    try:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+                        '-keyout', str(keyfile), '-out', str(certfile), '-subj', '/CN=localhost'],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        print("❌ 错误: --tls 需要 openssl 命令生成自签名证书，或用 --certfile/--keyfile 指定证书")
+        sys.exit(1)
+    return str(certfile), str(keyfile)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class RegistryHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'MockRegistry/1.0'
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            sys.stderr.write('%s %s\n' % (self.command, self.path))
+
+    def count(self, key, amount=1):
+        with self.server.stats_lock:
+            self.server.stats[key] = self.server.stats.get(key, 0) + amount
+
+    def send(self, code, body=b'', headers=None):
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def challenge(self):
+        realm = f'{self.server.base_url}/token'
+        self.send(401, b'{"errors":[{"code":"UNAUTHORIZED"}]}', {'WWW-Authenticate': f'Bearer realm="{realm}",service="mock-registry"'})
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        options = self.server.options
+        path = self.path.split('?', 1)[0]
+        if path.startswith('/token'):
+            self.count('token')
+            return self.send(200, json.dumps({'token': TOKEN, 'expires_in': 300}).encode(), {'Content-Type': 'application/json'})
+        if path == '/stats':
+            with self.server.stats_lock:
+                return self.send(200, json.dumps(self.server.stats).encode(), {'Content-Type': 'application/json'})
+        if options.latency:
+            time.sleep(options.latency / 1000)
+        if path == '/v2/' or self.headers.get('Authorization') != f'Bearer {TOKEN}':
+            return self.challenge()
+        if options.throttle_rate and random.random() < options.throttle_rate:
+            self.count('throttled')
+            return self.send(429, b'{"errors":[{"code":"TOOMANYREQUESTS"}]}', {'Retry-After': f'{options.retry_after:g}'})
+
+        # /v2/<any repository>/manifests/<tag or digest> and /v2/<any repository>/blobs/<digest>
+        repository, _, reference = path[len('/v2/'):].rpartition('/')
+        repository, _, kind = repository.rpartition('/')
+        if kind == 'manifests':
+            self.count('manifests')
+            manifest = self.server.manifest
+            if reference.startswith('sha256:') and reference != self.server.manifest_digest:
+                return self.send(404, b'{"errors":[{"code":"MANIFEST_UNKNOWN"}]}')
+            return self.send(200, manifest, {'Content-Type': MANIFEST_TYPE, 'Docker-Content-Digest': self.server.manifest_digest})
+        if kind == 'blobs':
+            return self.serve_blob(reference)
+        self.send(404, b'{"errors":[{"code":"NAME_UNKNOWN"}]}')
+
+    def serve_blob(self, digest):
+        options = self.server.options
+        blob = self.server.blobs.get(digest)
+        self.count('blob_requests')
+        if blob is None or options.missing:
+            return self.send(404, b'{"errors":[{"code":"BLOB_UNKNOWN"}]}')
+
+        start, end = 0, len(blob) - 1
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            first, _, last = range_header[6:].partition('-')
+            start = int(first or 0)
+            end = min(int(last), len(blob) - 1) if last else len(blob) - 1
+            if start >= len(blob):
+                return self.send(416, b'', {'Content-Range': f'bytes */{len(blob)}'})
+            self.count('range_requests')
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(blob)}')
+        else:
+            self.send_response(200)
+        body = blob[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Docker-Content-Digest', digest)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        layer = digest != self.server.config_digest
+        cut = len(body)
+        if layer and options.fail_rate and random.random() < options.fail_rate:
+            # Drop the connection somewhere in the middle of the body
+            cut = random.randint(0, max(0, len(body) - 1))
+            self.count('disconnects')
+        if layer and options.corrupt_rate and len(body) > 1 and random.random() < options.corrupt_rate:
+            position = len(body) // 2
+            body = body[:position] + bytes([body[position] ^ 0xff]) + body[position + 1:]
+            self.count('corrupted')
+
+        sent = 0
+        started = time.monotonic()
+        while sent < cut:
+            piece = body[sent:min(cut, sent + 64 * 1024)]
+            self.wfile.write(piece)
+            sent += len(piece)
+            if options.rate:
+                # Per connection bandwidth cap
+                ahead = sent / options.rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        self.count('bytes_sent', sent)
+        if cut < len(body):
+            self.wfile.flush()
+            self.close_connection = True
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='本地模拟镜像仓库，用于离线测试 docker_pull.py（任意仓库名/任意tag都返回同一个合成镜像）',
+        epilog='Example: python mock_registry.py --port 5443 --tls & python docker_pull.py 127.0.0.1:5443/test/image:latest',
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址 (默认: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=5000, help='监听端口 (默认: 5000)')
+    parser.add_argument('--tls', action='store_true', help='使用HTTPS（docker_pull.py 访问镜像仓库本身时需要），未指定证书时用openssl生成自签名证书')
+    parser.add_argument('--certfile', help='TLS证书文件')
+    parser.add_argument('--keyfile', help='TLS私钥文件')
+    parser.add_argument('--layers', type=int, default=5, help='层数 (默认: 5)')
+    parser.add_argument('--layer-size', type=parse_size, default='4M', help='每层解压后的大小 (默认: 4M)')
+    parser.add_argument('--seed', type=int, default=0, help='内容随机种子，相同种子的实例提供相同的镜像 (默认: 0)')
+    parser.add_argument('--latency', type=float, default=0, help='每个请求的延迟，毫秒 (默认: 0)')
+    parser.add_argument('--rate', type=parse_size, default=0, help='每个连接的带宽上限，字节/秒，例如 2M (默认: 不限)')
+    parser.add_argument('--fail-rate', type=float, default=0, help='层下载中途断开连接的概率 0-1 (默认: 0)')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='清单和层请求返回429的概率 0-1 (默认: 0)')
+    parser.add_argument('--retry-after', type=float, default=1, help='429响应的Retry-After秒数 (默认: 1)')
+    parser.add_argument('--corrupt-rate', type=float, default=0, help='层数据被篡改一个字节的概率 0-1 (默认: 0)')
+    parser.add_argument('--missing', action='store_true', help='所有层都返回404（模拟没有该镜像的镜像源）')
+    parser.add_argument('--verbose', action='store_true', help='打印每个请求')
+    args = parser.parse_args()
+
+    manifest, blobs = build_image(args.layers, args.layer_size, args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), RegistryHandler)
+    server.options = args
+    server.manifest = manifest
+    server.manifest_digest = 'sha256:' + hashlib.sha256(manifest).hexdigest()
+    server.config_digest = json.loads(manifest)['config']['digest']
+    server.blobs = blobs
+    server.stats = {}
+    server.stats_lock = threading.Lock()
+
+    scheme = 'http'
+    if args.tls or args.certfile:
+        import ssl
+        certfile, keyfile = (args.certfile, args.keyfile) if args.certfile else self_signed_certificate()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = 'https'
+    server.base_url = f'{scheme}://{args.host}:{server.server_address[1]}'
+
+    total = sum(len(blob) for blob in blobs.values())
+    print(f"🐳 Mock registry on {server.base_url}: {args.layers} layers, {total / 1024 / 1024:.1f} MB compressed "
+          f"(manifest {server.manifest_digest[7:19]})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+共享缓存并发压力测试
+同时启动多个 docker_pull.py 进程拉取到同一个缓存目录，检查输出和缓存是否完整、每个层是否只下载一次
+"""
+
+import sys
+import json
+import time
+import random
+import hashlib
+import tarfile
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+try:
+    import zstandard  # only to verify --cache-storage zstd entries
+except ImportError:
+    zstandard = None
+
+DOCKER_PULL = Path(__file__).resolve().parent / 'docker_pull.py'
+
+def sha256_of(fileobj) -> str:
+    sha256_hash = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(1024 * 1024), b''):
+        sha256_hash.update(chunk)
+    return f"sha256:{sha256_hash.hexdigest()}"
+
+def verify_output(tar_path: Path) -> list:
+    """Check every layer of a docker or OCI archive (or OCI directory) against its digest; returns the problems found"""
+    problems = []
+    if tar_path.is_dir():
+        # OCI layout directory (--format oci)
+        for blob_file in (tar_path / 'blobs' / 'sha256').iterdir():
+            with open(blob_file, 'rb') as f:
+                if sha256_of(f) != 'sha256:' + blob_file.name:
+                    problems.append(f"{tar_path.name}: {blob_file.name} does not match its digest")
+        return problems
+    try:
+        with tarfile.open(tar_path) as tar:
+            names = tar.getnames()
+            if 'manifest.json' in names and 'oci-layout' not in names:
+                for image in json.load(tar.extractfile('manifest.json')):
+                    diff_ids = json.load(tar.extractfile(image['Config']))['rootfs']['diff_ids']
+                    for layer_name, diff_id in zip(image['Layers'], diff_ids):
+                        if sha256_of(tar.extractfile(layer_name)) != diff_id:
+                            problems.append(f"{tar_path.name}: {layer_name} does not match {diff_id[7:19]}")
+            else:
+                for name in names:
+                    if name.startswith('blobs/sha256/') and tar.getmember(name).isfile():
+                        if sha256_of(tar.extractfile(name)) != 'sha256:' + name.rsplit('/', 1)[1]:
+                            problems.append(f"{tar_path.name}: {name} does not match its digest")
+    except (OSError, tarfile.TarError, KeyError, ValueError) as e:
+        problems.append(f"{tar_path.name}: unreadable archive ({e})")
+    return problems
+
+def verify_cache(cache_dir: Path) -> list:
+    """Check that the cache holds only complete entries and no leftover locks; returns the problems found"""
+    problems = []
+    layers_dir = cache_dir / 'layers'
+    if layers_dir.exists():
+        for entry_dir in layers_dir.iterdir():
+            if entry_dir.name.startswith('.tmp-'):
+                problems.append(f"unfinished entry left behind: {entry_dir.name}")
+                continue
+            layer_file = entry_dir / 'layer.tar'
+            if not layer_file.exists():
+                layer_file = entry_dir / 'layer.tar.zst'
+            if not layer_file.exists():
+                problems.append(f"entry without layer.tar: {entry_dir.name}")
+                continue
+            try:
+                with open(entry_dir / 'metadata.json', 'r') as f:
+                    metadata = json.load(f)
+            except (OSError, ValueError):
+                problems.append(f"entry without metadata: {entry_dir.name}")
+                continue
+            with open(layer_file, 'rb') as f:
+                if layer_file.suffix == '.zst':
+                    if zstandard is None:
+                        continue
+                    diff_id = sha256_of(zstandard.ZstdDecompressor().stream_reader(f))
+                else:
+                    diff_id = sha256_of(f)
+            if diff_id != metadata.get('diff_id', entry_dir.name.replace('_', ':', 1)):
+                problems.append(f"corrupt layer.tar: {entry_dir.name}")
+    blobs_dir = cache_dir / 'blobs' / 'sha256'
+    if blobs_dir.exists():
+        for blob_file in blobs_dir.iterdir():
+            with open(blob_file, 'rb') as f:
+                if sha256_of(f) != 'sha256:' + blob_file.name:
+                    problems.append(f"corrupt blob: {blob_file.name}")
+    locks_dir = cache_dir / 'locks'
+    if locks_dir.exists():
+        problems.extend(f"lock left behind: {path.name}" for path in locks_dir.iterdir())
+    return problems
+
+def count_downloads(log_paths: list) -> dict:
+    """How many times each layer was downloaded, from the logs of every process"""
+    downloads = {}
+    for log_path in log_paths:
+        for line in log_path.read_text(errors='replace').splitlines():
+            if 'Download complete (digest verified)' in line:
+                short_digest = line.strip().split(':')[0]
+                downloads[short_digest] = downloads.get(short_digest, 0) + 1
+    return downloads
+
+def start_pull(images: list, index: int, cache_dir: Path, work_dir: Path, extra_args: list):
+    image = images[index % len(images)]
+    log_path = work_dir / f'pull_{index}.log'
+    output = work_dir / f'pull_{index}.tar'
+    cmd = [sys.executable, str(DOCKER_PULL), image, '--cache-dir', str(cache_dir), '-o', str(output)] + extra_args
+    log_file = open(log_path, 'w')
+    process = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT, cwd=work_dir)
+    return process, log_file, log_path, output
+
+def run_round(args, images: list, cache_dir: Path, work_dir: Path) -> list:
+    """Run one round of concurrent pulls, killing some of them mid-way if asked; returns the problems found"""
+    problems = []
+    pulls = [start_pull(images, i, cache_dir, work_dir, args.extra) for i in range(args.processes)]
+    killed = []
+    if args.kill:
+        time.sleep(args.kill_after)
+        for i in random.sample(range(args.processes), min(args.kill, args.processes)):
+            if pulls[i][0].poll() is None:
+                pulls[i][0].kill()
+                killed.append(i)
+        if killed:
+            print(f"💥 Killed {len(killed)} writers: {', '.join(f'#{i}' for i in killed)}")
+
+    for process, log_file, _, _ in pulls:
+        process.wait()
+        log_file.close()
+
+    # Killed pulls start over against what the crashed writers left in the cache
+    for i in killed:
+        pulls[i] = start_pull(images, i, cache_dir, work_dir, args.extra)
+        pulls[i][0].wait()
+        pulls[i][1].close()
+
+    for i, (process, _, log_path, output) in enumerate(pulls):
+        if process.returncode != 0:
+            problems.append(f"pull #{i} exited with {process.returncode}, see {log_path}")
+        elif output.exists():
+            problems.extend(verify_output(output))
+        else:
+            problems.append(f"pull #{i} wrote no archive, see {log_path}")
+
+    downloads = count_downloads([log_path for _, _, log_path, _ in pulls])
+    duplicated = {digest: count for digest, count in downloads.items() if count > 1}
+    print(f"⬇️  {len(downloads)} layers downloaded, {sum(downloads.values())} downloads in total")
+    if duplicated:
+        problems.append('downloaded more than once: ' + ', '.join(f'{digest} x{count}' for digest, count in duplicated.items()))
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='同时启动多个docker_pull.py进程共享一个缓存目录，检查缓存并发安全',
+        epilog='Arguments after -- are passed to docker_pull.py, e.g. -- --platform linux/amd64',
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('images', nargs='+', help='镜像名称，多个镜像时各进程轮流拉取')
+    parser.add_argument('-n', '--processes', type=int, default=4, help='并发进程数 (默认: 4)')
+    parser.add_argument('--rounds', type=int, default=1, help='轮数，后续轮次复用同一缓存 (默认: 1)')
+    parser.add_argument('--cache-dir', help='共享缓存目录 (默认: 临时目录)')
+    parser.add_argument('--kill', type=int, default=0, help='每轮强制结束的进程数，模拟崩溃的写入者')
+    parser.add_argument('--kill-after', type=float, default=2.0, help='启动后多少秒结束进程 (默认: 2)')
+
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        argv, extra = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+    args.extra = extra
+
+    work_dir = Path(tempfile.mkdtemp(prefix='docker_pull_stress_'))
+    cache_dir = Path(args.cache_dir).expanduser().resolve() if args.cache_dir else work_dir / 'cache'
+
+    print("="*60)
+    print("🐳 共享缓存并发压力测试")
+    print(f"📦 {args.processes} 个进程 × {args.rounds} 轮 → {cache_dir}")
+    print("="*60)
+
+    problems = []
+    for round_number in range(1, args.rounds + 1):
+        print(f"\n🔄 Round {round_number}/{args.rounds}")
+        start_time = time.time()
+        round_problems = run_round(args, args.images, cache_dir, work_dir)
+        round_problems.extend(verify_cache(cache_dir))
+        print(f"⏱️  {time.time() - start_time:.1f}s, {len(round_problems)} problems")
+        problems.extend(round_problems)
+
+    print()
+    if problems:
+        for problem in problems:
+            print(f"❌ {problem}")
+        print(f"\nLogs and archives kept in {work_dir}")
+        sys.exit(1)
+    print(f"🎉 All pulls verified, cache consistent (work directory: {work_dir})")
+
+if __name__ == '__main__':
+    main()